@@ -4,4 +4,4 @@ end
 
 state.calls = state.calls + 1
 
-python.coroutine(say("Great, you've called " .. state.calls .. " times now!"))
+say("Great, you've called " .. state.calls .. " times now!")
@@ -155,7 +155,9 @@
             daphne
             django_5
             django-health-check
+            httpx
             lupa
+            numpy
             pillow
             (pkgs.callPackage cartesia {})
             (pkgs.callPackage django-editor-widgets {})
@@ -7,9 +7,9 @@ from pathlib import Path
 from typing import Any, ClassVar
 
 import yaml
-from calls import models
+from calls import directory, eligibility, lua, models, pregenerate
 from django import forms
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.db.models import Sum
 from django.http import HttpRequest, HttpResponse
 from django.template.response import TemplateResponse
@@ -155,6 +155,16 @@ def load_from_repo_action(_: HttpRequest) -> None:
     actual_load_from_repo()
 
 
+@no_queryset_action(description="Generate missing speech")
+def pregenerate_speech_action(modeladmin: admin.ModelAdmin, request: HttpRequest) -> None:
+    """Generate TTS for all known game text in the background, as an admin action."""
+    utterances = pregenerate.start_in_background()
+    if utterances is None:
+        modeladmin.message_user(request, "Speech is already being generated, progress is logged", messages.WARNING)
+    else:
+        modeladmin.message_user(request, f"Generating speech for up to {utterances} utterances, progress is logged")
+
+
 def load_from_repo_page(_: HttpRequest) -> None:
     """Load missions from the repo, as an HTTP request."""
     actual_load_from_repo()
@@ -167,6 +177,12 @@ def actual_load_from_repo() -> HttpResponse:
     load_locations(source)
     load_npcs(source)
 
+    directory.invalidate_directory()
+    eligibility.invalidate_mission_graph()
+
+    # Compile the Lua missions now, rather than on the first call about each
+    lua.warm_chunks(models.Mission.objects.filter(type=models.MissionTypes.LUA))
+
     return HttpResponse("OK")
 
 
@@ -363,7 +379,7 @@ class MissionAdmin(NoQuerySetAdminActionsMixin, admin.ModelAdmin):
     inlines: ClassVar[list[str]] = [PrerequisiteInline]
     form = MissionAdminForm
 
-    actions: ClassVar = [load_from_repo_action]
+    actions: ClassVar = [load_from_repo_action, pregenerate_speech_action]
 
 
 custom_admin_site.register(models.Mission, MissionAdmin)
@@ -8,3 +8,7 @@ class CallsConfig(AppConfig):
 
     default_auto_field = "django.db.models.BigAutoField"
     name = "calls"
+
+    def ready(self) -> None:
+        """Connect signal handlers."""
+        from calls import directory, eligibility, speech  # noqa: F401, PLC0415
@@ -0,0 +1,138 @@
+"""Transcoding speech between the encodings telephony platforms play."""
+
+from __future__ import annotations
+
+import struct
+
+import numpy as np
+
+# Speech is kept as 8kHz signed 16-bit little-endian PCM, and every other
+# encoding is derived from that.
+SAMPLE_RATE = 8000
+MASTER_ENCODING = "sln"
+
+# Encodings, named by the file extension Asterisk recognises them by
+ENCODINGS = ("alaw", "ulaw", "sln", "sln16", "wav")
+
+# Encodings that can be transcoded a chunk at a time, for streaming
+STREAMABLE_ENCODINGS = ("alaw", "ulaw", "sln")
+
+_ALAW_SEGMENT_ENDS = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+_ULAW_SEGMENT_ENDS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+_ULAW_BIAS = 0x84
+_ULAW_CLIP = 8159
+
+
+def _alaw_encode_table() -> np.ndarray:
+    """Build the G.711 A-law code for every 16-bit sample."""
+    samples = np.arange(-32768, 32768, dtype=np.int32) >> 3
+    mask = np.where(samples >= 0, 0xD5, 0x55)
+    magnitude = np.where(samples >= 0, samples, -samples - 1)
+
+    segment = np.searchsorted(_ALAW_SEGMENT_ENDS, magnitude)
+    shift = np.where(segment < 2, 1, segment)  # noqa: PLR2004
+    code = (np.minimum(segment, 7) << 4) | ((magnitude >> shift) & 0xF)
+    code = np.where(segment >= 8, 0x7F, code)  # noqa: PLR2004
+
+    # Indexed by the sample's bits as an unsigned 16-bit number
+    return np.roll((code ^ mask).astype(np.uint8), 32768)
+
+
+def _alaw_decode_table() -> np.ndarray:
+    """Build the 16-bit sample for every G.711 A-law code."""
+    code = np.arange(256, dtype=np.int32) ^ 0x55
+    segment = (code & 0x70) >> 4
+    value = ((code & 0xF) << 4) + np.where(segment == 0, 8, 0x108)
+    value = np.where(segment > 1, value << np.maximum(segment - 1, 0), value)
+    return np.where(code & 0x80, value, -value).astype(np.int16)
+
+
+def _ulaw_encode_table() -> np.ndarray:
+    """Build the G.711 μ-law code for every 16-bit sample."""
+    samples = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(samples < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(samples), _ULAW_CLIP) + (_ULAW_BIAS >> 2)
+
+    segment = np.searchsorted(_ULAW_SEGMENT_ENDS, magnitude)
+    code = (np.minimum(segment, 7) << 4) | ((magnitude >> (np.minimum(segment, 7) + 1)) & 0xF)
+    code = np.where(segment >= 8, 0x7F, code)  # noqa: PLR2004
+
+    return np.roll((code ^ mask).astype(np.uint8), 32768)
+
+
+def _ulaw_decode_table() -> np.ndarray:
+    """Build the 16-bit sample for every G.711 μ-law code."""
+    code = ~np.arange(256, dtype=np.int32) & 0xFF
+    value = (((code & 0xF) << 3) + _ULAW_BIAS) << ((code & 0x70) >> 4)
+    return np.where(code & 0x80, _ULAW_BIAS - value, value - _ULAW_BIAS).astype(np.int16)
+
+
+ALAW_ENCODE = _alaw_encode_table()
+ALAW_DECODE = _alaw_decode_table()
+ULAW_ENCODE = _ulaw_encode_table()
+ULAW_DECODE = _ulaw_decode_table()
+
+
+def pcm_samples(data: bytes) -> np.ndarray:
+    """Read signed 16-bit little-endian PCM, ignoring any trailing odd byte."""
+    return np.frombuffer(data, dtype="<i2", count=len(data) // 2)
+
+
+def alaw_to_pcm(data: bytes) -> bytes:
+    """Decode A-law to signed 16-bit little-endian PCM."""
+    return ALAW_DECODE[np.frombuffer(data, dtype=np.uint8)].astype("<i2").tobytes()
+
+
+def upsample(samples: np.ndarray, factor: int) -> np.ndarray:
+    """Raise the sample rate by a whole factor, interpolating between samples."""
+    if len(samples) == 0:
+        return samples
+    positions = np.arange(len(samples) * factor) / factor
+    return np.interp(positions, np.arange(len(samples)), samples).round().astype(np.int16)
+
+
+def wav_header(data_size: int, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """Build the header for a mono 16-bit PCM WAV file."""
+    return (
+        b"RIFF"
+        + struct.pack("<I", 36 + data_size)
+        + b"WAVEfmt "
+        + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+        + b"data"
+        + struct.pack("<I", data_size)
+    )
+
+
+def transcode(pcm: bytes, encoding: str) -> bytes:
+    """Encode master PCM in another encoding, all at once."""
+    samples = pcm_samples(pcm)
+    if encoding == "alaw":
+        return ALAW_ENCODE[samples.view(np.uint16)].tobytes()
+    if encoding == "ulaw":
+        return ULAW_ENCODE[samples.view(np.uint16)].tobytes()
+    if encoding == "sln":
+        return samples.astype("<i2").tobytes()
+    if encoding == "sln16":
+        return upsample(samples, 2).astype("<i2").tobytes()
+    if encoding == "wav":
+        data = samples.astype("<i2").tobytes()
+        return wav_header(len(data)) + data
+    raise ValueError(encoding)
+
+
+class ChunkTranscoder:
+    """Encodes master PCM as it arrives, carrying any half sample over to the next chunk."""
+
+    def __init__(self, encoding: str) -> None:
+        """Prepare the transcoder."""
+        if encoding not in STREAMABLE_ENCODINGS:
+            raise ValueError(encoding)
+        self.encoding = encoding
+        self._remainder = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Encode the next chunk of PCM."""
+        data = self._remainder + chunk
+        whole = len(data) - len(data) % 2
+        self._remainder = data[whole:]
+        return transcode(data[:whole], self.encoding)
@@ -0,0 +1,34 @@
+"""Helpers for the benchmark management commands."""
+
+from __future__ import annotations
+
+import contextlib
+import statistics
+from typing import TYPE_CHECKING
+
+from django.db import connection
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+
+@contextlib.contextmanager
+def benchmark_database() -> Iterator[None]:
+    """Run against a throwaway test database, so benchmarks never touch game data."""
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Get a percentile of some samples."""
+    ordered = sorted(samples)
+    return ordered[max(0, round(len(ordered) * pct / 100) - 1)]
+
+
+def summarise(samples: list[float]) -> str:
+    """Summarise timing samples in milliseconds."""
+    return f"mean {statistics.mean(samples) * 1000:8.3f} ms   p50 {percentile(samples, 50) * 1000:8.3f} ms   p95 {percentile(samples, 95) * 1000:8.3f} ms"
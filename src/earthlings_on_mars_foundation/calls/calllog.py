@@ -0,0 +1,118 @@
+"""Write-behind buffer for call log updates."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from calls import models
+
+logger = logging.getLogger("eomf.calls.calllog")
+
+# Seconds between writes of a call that is still in progress
+FLUSH_INTERVAL = 60
+
+
+@dataclass
+class WriteCounts:
+    """How many call log writes were asked for, and how many were actually made."""
+
+    requested: int = 0
+    performed: int = 0
+
+    @property
+    def saved(self) -> int:
+        """Get the number of writes that were coalesced away."""
+        return self.requested - self.performed
+
+
+# Totals for every call handled by this process
+total_counts = WriteCounts()
+
+
+class CallLogBuffer:
+    """Keeps a call's log in memory, and writes out the changed fields together.
+
+    Changes are written periodically while the call is in progress, and once more when the buffer is closed at the end of the call.
+    """
+
+    def __init__(self, call_log: models.CallLog, interval: float = FLUSH_INTERVAL) -> None:
+        """Prepare the buffer."""
+        self.call_log = call_log
+        self.interval = interval
+        self.counts = WriteCounts()
+
+        self._dirty: set[str] = set()
+        self._lock = asyncio.Lock()
+        self._flusher: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start writing changes periodically."""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    def update(self, **fields: Any) -> None:  # noqa: ANN401
+        """Change fields of the call log, to be written on the next flush."""
+        changed = False
+        for name, value in fields.items():
+            if getattr(self.call_log, name) != value:
+                setattr(self.call_log, name, value)
+                self._dirty.add(name)
+                changed = True
+
+        # Each update that changed anything used to be written straight away
+        if changed:
+            self.counts.requested += 1
+            total_counts.requested += 1
+
+    @property
+    def dirty(self) -> bool:
+        """Check if there are changes that have not been written."""
+        return bool(self._dirty)
+
+    async def aflush(self) -> None:
+        """Write any changed fields to the database."""
+        async with self._lock:
+            if not self._dirty:
+                return
+
+            fields = self._dirty
+            self._dirty = set()
+            try:
+                await self.call_log.asave(update_fields=fields)
+            except BaseException:
+                # Try again on the next flush
+                self._dirty |= fields
+                raise
+
+            self.counts.performed += 1
+            total_counts.performed += 1
+
+    async def aclose(self) -> None:
+        """Stop the periodic writes and write any remaining changes."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.wait({self._flusher})
+            self._flusher = None
+
+        await self.aflush()
+
+        logger.info(
+            "%s: %s log updates in %s writes, %s writes saved by this process",
+            self.call_log,
+            self.counts.requested,
+            self.counts.performed,
+            total_counts.saved,
+        )
+
+    async def _flush_periodically(self) -> None:
+        """Write changes every interval until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.aflush()
+            except Exception:
+                logger.exception("Failed to write %s", self.call_log)
@@ -2,19 +2,48 @@
 
 import asyncio
 import datetime
-import io
 import json
 import logging
-import threading
 
 from asgiref.sync import sync_to_async
-from calls import models
-from calls.lua import AsyncLuaRuntime
+from calls import audio, eligibility, models, speech
+from calls import lua as lua_module
+from calls.calllog import CallLogBuffer
+from calls.context import RecruitContext
+from calls.prefetch import PromptPrefetcher
+from calls.prompts import PromptTemplate
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.db.models import Count, Exists, F, OuterRef, Q
+from lupa import LuaError
 
 request_logger = logging.getLogger("eomf.calls.consumer")
 
+# NPC that answers before the caller is connected to who they dialled
+OPERATOR_NPC_ID = 2
+
+# Fixed prompts spoken by the operator
+AUTHENTICATE_PROMPT = "Please enter your recruit number to connect your call. If you've lost your multipass and need a replacement recruit number, press 0"
+RECRUIT_NOT_RECOGNISED_PROMPT = "Sorry, that number was not recognised."
+CALLER_VERIFIED_PROMPT = "Caller verified!"
+CALLER_UNIDENTIFIED_PROMPT = "Unable to identify caller."
+NPC_UNIDENTIFIED_PROMPT = "Unable to identify which NPC you are calling."
+NEW_RECRUIT_PROMPT = PromptTemplate("OK let's see, scanner says you're recruit {recruit:04}. You got that? {recruit:04}, don't forget it!")
+OPERATOR_PROMPTS = (
+    AUTHENTICATE_PROMPT,
+    RECRUIT_NOT_RECOGNISED_PROMPT,
+    CALLER_VERIFIED_PROMPT,
+    CALLER_UNIDENTIFIED_PROMPT,
+    NPC_UNIDENTIFIED_PROMPT,
+    *NEW_RECRUIT_PROMPT.clips(),
+)
+
+# Fixed prompts spoken by whichever NPC was called
+ERROR_PROMPT = "Sorry, something went wrong"
+NO_MORE_WORK_PROMPT = "I don't have any more work for you at the moment, give me a call back later."
+NPC_PROMPTS = (
+    ERROR_PROMPT,
+    NO_MORE_WORK_PROMPT,
+)
+
 
 class InvalidMessageError(Exception):
     """Unknown message type recieved."""
@@ -31,14 +60,21 @@ class InvalidMessageError(Exception):
 class CallConsumer(AsyncJsonWebsocketConsumer):
     """Manage websocket connections."""
 
+    # Whether speech without a recording is synthesised for the call, rather than spoken by the telephony platform
+    synthesise_missing_speech = False
+
+    # Encoding speech recordings are played in
+    speech_encoding = audio.MASTER_ENCODING
+
     def __init__(self) -> None:
         super().__init__()
-        self.incomingMessage = None
-        self.newMessage = threading.Event()
         self.callLog: models.CallLog | None = None
+        self.log_buffer: CallLogBuffer | None = None
         self.active_message = None
         self.ack_done = False
-        self.action_thread = None
+        self.call_task: asyncio.Task | None = None
+        self.recruit_context: RecruitContext | None = None
+        self.prefetcher = PromptPrefetcher(self.synthesise_missing_speech, self.speech_encoding)
         self.call_connected = False
 
     async def connect(self) -> None:
@@ -49,14 +85,28 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
     async def disconnect(self, _: str) -> None:
         """Handle a disconnect."""
         self.call_hungup("websocket disconnct()")
-        if self.callLog is not None:
-            self.callLog.completed = True
-            await self.callLog.asave()
+        if self.call_task is not None:
+            # Let the call logic finish updating the log before it is closed
+            await asyncio.wait({self.call_task})
+        if self.log_buffer is not None:
+            self.log_buffer.update(completed=True)
+            await self.log_buffer.aclose()
+
+    async def _open_log(self, call_id: str) -> None:
+        """Find or start the log for this call, and start buffering updates to it."""
+        self.callLog, _ = await models.CallLog.objects.aget_or_create(
+            call_id=call_id,
+            defaults={"duration": 0, "digits": 0},
+        )
+        self.log_buffer = CallLogBuffer(self.callLog)
+        self.log_buffer.start()
 
     def call_hungup(self, reason: str) -> None:
         """Call when call is over and need to teardown, may be called multiple times."""
+        if self.call_connected and self.call_task is not None:
+            # Only cancel once, so the call logic can finish writing its log
+            self.call_task.cancel()
         self.call_connected = False
-        # TODO: Stop thread
         request_logger.info(f"Call hungup: {reason}")
 
     async def receive(self, text_data: str) -> None:
@@ -70,7 +120,7 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
 
         while recruit is None and self.call_connected:
             recruit_id, reason = await self._gather(
-                "Please enter your recruit number to connect your call. If you've lost your multipass and need a replacement recruit number, press 0",
+                AUTHENTICATE_PROMPT,
                 min_digits=1,
                 max_digits=4,
                 npc=npc
@@ -84,12 +134,7 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
                 recruit = models.Recruit()
                 await recruit.asave()
 
-                number = " ".join(f"{recruit.id:04}")
-
-                await self._say(
-                    f"OK let's see, scanner says you're recruit {number}. You got that? {number}, don't forget it!",
-                    npc=npc
-                )
+                await self._say_clips(NEW_RECRUIT_PROMPT.render(recruit=recruit.id), npc=npc)
             else:
                 # Existing recruit
                 try:
@@ -97,34 +142,28 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
                     recruit = await models.Recruit.objects.aget(id=recruit_id)
                 except (models.Recruit.DoesNotExist, TypeError):
                     # Verify the recruit number
-                    await self._say("Sorry, that number was not recognised.", npc=npc)
+                    await self._say(RECRUIT_NOT_RECOGNISED_PROMPT, npc=npc)
                     continue
 
         if not recruit:
             return None
 
-        self.callLog.recruit = recruit
-        await self._say("Caller verified!", npc=npc)
+        self.log_buffer.update(recruit=recruit)
+        await self._say(CALLER_VERIFIED_PROMPT, npc=npc)
         return recruit
 
-    async def _check_existing_missions(self, recruit: models.Recruit) -> bool:
+    async def _check_existing_missions(self) -> bool:
         """Check if the player has existing missions for this NPC, and process their completion states."""
         has_uncompleted = False
-        recruit_missions = (
-            models.RecruitMission.objects.filter(recruit=recruit, finished=None)
-            .select_related("mission")
-            .select_related("mission__issued_by")
-            .select_related("mission__call_back_from")
-        )
 
-        async for recruit_mission in recruit_missions.aiterator():
-            if recruit_mission.mission.cancel_after_time is not None and recruit_mission.mission.cancel_after_time >= datetime.datetime.now(tz=datetime.UTC):
+        for recruit_mission in self.recruit_context.open_missions():
+            if recruit_mission.mission.cancel_after_time is not None and recruit_mission.mission.cancel_after_time <= datetime.datetime.now(tz=datetime.UTC):
                 await self._cancel_mission(recruit_mission)
                 continue
 
-            if recruit_mission.mission.issued_by == self.callLog.NPC:
+            if recruit_mission.mission.issued_by_id == self.callLog.NPC_id:
                 if recruit_mission.mission.type == models.MissionTypes.LOCATION:
-                    if recruit_mission.mission.call_back_from == self.callLog.location:
+                    if recruit_mission.mission.call_back_from_id == self.callLog.location_id:
                         # Complete "go to location" mission
                         await self._complete_mission(recruit_mission)
                     else:
@@ -137,7 +176,7 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
                     has_uncompleted |= await self._check_count_mission(recruit_mission)
                 elif recruit_mission.mission.type == models.MissionTypes.LUA:
                     has_uncompleted |= await self._check_lua_mission(recruit_mission)
-            elif recruit_mission.mission.type == models.MissionTypes.NPC and recruit_mission.mission.call_another == self.callLog.NPC:
+            elif recruit_mission.mission.type == models.MissionTypes.NPC and recruit_mission.mission.call_another_id == self.callLog.NPC_id:
                 # Complete "call NPC" mission
                 await self._complete_mission(recruit_mission)
 
@@ -145,8 +184,6 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
 
     async def _check_lua_mission(self, recruit_mission: models.RecruitMission) -> bool:
         """Run Lua to check a mission."""
-        lua = AsyncLuaRuntime(unpack_returned_tuples=True)
-
         uncomplete = True
 
         async def complete_mission() -> None:
@@ -159,21 +196,32 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
             uncomplete = False
             await self._cancel_mission(recruit_mission)
 
-        lua.globals().recruit_mission = recruit_mission
-        lua.globals().state = lua.table_from(recruit_mission.state)
-        lua.globals().complete_mission = complete_mission
-        lua.globals().cancel_mission = cancel_mission
-        lua.globals().say = self._say
-        lua.globals().gather = self._gather
-
-        request_logger.info("State is: %s", recruit_mission.state)
-
-        await lua.execute(recruit_mission.mission.lua)
-        recruit_mission.state = dict(lua.globals().state)
-
-        request_logger.info("State is: %s", recruit_mission.state)
-
-        await recruit_mission.asave()
+        try:
+            chunk = await lua_module.aget_chunk(recruit_mission.mission.id, recruit_mission.mission.lua)
+            async with lua_module.get_runtime_pool().lease() as lua:
+                lua.globals().recruit_mission = recruit_mission
+                lua.globals().state = lua_module.table_from_state(lua, recruit_mission.state)
+                lua.globals().complete_mission = lua.bridge(complete_mission)
+                lua.globals().cancel_mission = lua.bridge(cancel_mission)
+                lua.globals().say = lua.bridge(self._say)
+                lua.globals().gather = lua.bridge(self._gather)
+
+                request_logger.info("State is: %s", recruit_mission.state)
+
+                await lua.run_chunk(chunk)
+                state = lua_module.state_from_table(lua, lua.globals().state) or {}
+                if not isinstance(state, dict):
+                    raise LuaError("state must be a table with named keys")
+        except LuaError:
+            # Only this mission's check fails, its state is left as it was
+            request_logger.exception("Lua for mission %s failed", recruit_mission.mission.id)
+            return uncomplete
+
+        # Only written back if the script changed it
+        if state != recruit_mission.state:
+            recruit_mission.state = state
+            self.recruit_context.changed(recruit_mission, "state")
+            request_logger.info("State is: %s", recruit_mission.state)
 
         return uncomplete
 
@@ -199,10 +247,10 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
         # Incorrect code
 
         # Increment fail counter
-        recruit_mission.code_tries += 1
-        await recruit_mission.asave()
+        recruit_mission.code_tries = (recruit_mission.code_tries or 0) + 1
+        self.recruit_context.changed(recruit_mission, "code_tries")
 
-        if recruit_mission.code_tries >= recruit_mission.mission.cancel_after_tries:
+        if recruit_mission.mission.cancel_after_tries is not None and recruit_mission.code_tries >= recruit_mission.mission.cancel_after_tries:
             await self._cancel_mission(recruit_mission)
             return False
 
@@ -224,41 +272,26 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
                 continue
 
         recruit_mission.count_value = code
-        await recruit_mission.asave()
+        # Written together with the mission's outcome
+        self.recruit_context.changed(recruit_mission, "count_value")
         await self._complete_mission(recruit_mission)
         return False
 
     async def _cancel_mission(self, recruit_mission: models.RecruitMission) -> None:
         """Cancel or fail a mission."""
-        recruit_mission.finished = datetime.datetime.now(tz=datetime.UTC)
-        await recruit_mission.asave()
-
-        recruit_npc = await models.RecruitNPC.objects.aget(
-            recruit=recruit_mission.recruit,
-            NPC=recruit_mission.mission.NPC,
-        )
-
-        recruit_npc.score -= recruit_mission.mission.points
-        await recruit_npc.asave()
+        await self.recruit_context.afinish_mission(recruit_mission, completed=False)
 
         await self._say(recruit_mission.mission.cancel_text)
 
     async def _complete_mission(self, recruit_mission: models.RecruitMission) -> None:
         """Successfully complete a mission."""
-        recruit_mission.completed = True
-        recruit_mission.finished = datetime.datetime.now(tz=datetime.UTC)
-        await recruit_mission.asave()
-
-        recruit_npc = await models.RecruitNPC.objects.aget(
-            recruit=recruit_mission.recruit,
-            NPC=recruit_mission.mission.NPC,
-        )
-
-        recruit_npc.score += recruit_mission.missionn.points
-        await recruit_npc.asave()
+        followup = await self.recruit_context.afinish_mission(recruit_mission, completed=True)
 
         await self._say(recruit_mission.mission.completion_text)
 
+        if followup is not None:
+            await self._say(followup.mission.give_text)
+
     async def _send(self) -> None:
         """Send a command to Jambonz."""
         if self.ack_done:
@@ -278,133 +311,96 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
 
     async def _session_new(self) -> None:
         """Start processing a new call."""
-        # Start a second thread to actually execute the call logic
-        self.action_thread = threading.Thread(
-            target=asyncio.run,
-            args=(self._new_call(),),
-        )
-        self.action_thread.start()
+        # Run the call logic as a task on this consumer's event loop, so that
+        # incoming messages can still be handled while it waits on the caller.
+        self.call_task = asyncio.create_task(self._new_call())
 
     async def _new_call(self) -> None:
         """Prepare new call logic."""
         try:
-            npc = await models.NPC.objects.aget(pk=2)
+            npc = await models.NPC.objects.aget(pk=OPERATOR_NPC_ID)
+            self.prefetcher.prefetch(npc.id, OPERATOR_PROMPTS)
+
+            if self.callLog.NPC_id is not None:
+                # Only the ID is known from the directory, load the rest of the NPC for this call
+                self.callLog.NPC = await models.NPC.objects.aget(pk=self.callLog.NPC_id)
+
+                # Get what the NPC might say ready while the caller authenticates
+                self.prefetcher.prefetch(self.callLog.NPC_id, [self.callLog.NPC.introduction, *NPC_PROMPTS])
 
             recruit = await self._authenticate(npc=npc)
             if not self.call_connected:
                 return
             if not recruit:
-                await self._say("Unable to identify caller.", npc=npc)
+                await self._say(CALLER_UNIDENTIFIED_PROMPT, npc=npc)
                 await self._hangup()
                 return
 
-            if self.callLog.NPC is None:
+            if self.callLog.NPC_id is None:
                 request_logger.warning("NPC is none")
-                await self._say("Unable to identify which NPC you are calling.", npc=npc)
+                await self._say(NPC_UNIDENTIFIED_PROMPT, npc=npc)
                 self._send()
                 return
 
-            recruit_npc, created = await models.RecruitNPC.objects.aget_or_create(
-                recruit=recruit,
-                NPC=self.callLog.NPC,
-            )
+            if not models.CallLog.NPC.is_cached(self.callLog):
+                # The NPC was only found while the caller authenticated
+                self.callLog.NPC = await models.NPC.objects.aget(pk=self.callLog.NPC_id)
 
-            if created or not recruit_npc.contacted:
+            self.recruit_context = await RecruitContext.aload(recruit)
+            self.prefetcher.prefetch_for_recruit(self.callLog.NPC_id, self.callLog.location_id, self.recruit_context)
+
+            recruit_npc = self.recruit_context.recruit_npc(self.callLog.NPC_id)
+            if not recruit_npc.contacted:
                 await self._say(self.callLog.NPC.introduction)
                 recruit_npc.contacted = True
-                await recruit_npc.asave()
+                self.recruit_context.changed(recruit_npc, "contacted")
 
-            if self.callLog.location is None:
+            if self.callLog.location_id is None:
                 request_logger.warning("Location is none")
 
-            all_finished = await self._check_existing_missions(recruit)
+            all_finished = await self._check_existing_missions()
+            await self.recruit_context.asave()
 
             if not all_finished:
-                await self._find_new_mission(recruit)
+                await self._find_new_mission()
+
+            self.log_buffer.update(success=True)
 
             # Send hangup
             await self._hangup()
-
-            if self.callLog is not None:
-                self.callLog.completed = True
-                self.callLog.success = True
-                await self.callLog.asave()
+        except asyncio.CancelledError:
+            request_logger.info("Call logic cancelled.")
+            raise
         except Exception:
-            await self._say("Sorry, something went wrong")
+            await self._say(ERROR_PROMPT)
             await self._hangup()
 
-            if self.callLog is not None:
-                self.callLog.completed = True
-                self.callLog.success = False
-                await self.callLog.asave()
+            self.log_buffer.update(success=False)
 
             request_logger.exception("Error during call processing")
         finally:
-            request_logger.info("END THREAD.")
-
-    async def _find_new_mission(self, recruit: models.Recruit) -> None:
+            request_logger.info("END CALL.")
+            self.prefetcher.cancel()
+            if self.recruit_context is not None:
+                # Also shielded, so progress is kept if the caller hangs up mid-call
+                await asyncio.shield(self.recruit_context.asave())
+            # Written when the call ends, by `disconnect`
+            self.log_buffer.update(completed=True)
+
+    async def _find_new_mission(self) -> None:
         """Find a new mission for the player to start."""
-        mission = (
-            await models.Mission.objects.annotate(
-                total_prerequisites=Count(
-                    "prerequisites",
-                ),  # Calculate total number of prerequisites
-                completed_prerequisites=Count(  # And completed number of prerequisites
-                    models.MissionPrerequisite.objects.filter(
-                        Q(mission=OuterRef("pk")),
-                        Q(
-                            Exists(
-                                models.RecruitMission.objects.filter(
-                                    mission=OuterRef("prerequisite__id"),
-                                    recruit=recruit,
-                                    completed=True,
-                                ),
-                            ),
-                        ),
-                    ).values("id"),
-                ),
-                followup_to=Count("mission"),
-            )
-            .filter(
-                Q(
-                    issued_by=self.callLog.NPC,
-                )  # Issued by the user the NPC is talking to
-                & (
-                    Q(
-                        only_start_from=self.callLog.location,
-                    )  # Issued from the location the user is calling from
-                    | Q(only_start_from=None)  # Or from any location
-                )
-                & Q(
-                    ~Exists(
-                        models.RecruitMission.objects.filter(
-                            mission=OuterRef("pk"),
-                            recruit=recruit,
-                            finished__isnull=False,
-                        ),
-                    )
-                    | Q(repeatable=True),
-                )  # User has not already completed, or the mission is repeatable
-                & Q(
-                    total_prerequisites=F("completed_prerequisites"),
-                )  # All prerequisites are complete
-                & (Q(not_before__lte=datetime.datetime.now(tz=datetime.UTC)) | Q(not_before=None))  # not before is before now (or unset)
-                & (Q(not_after__gte=datetime.datetime.now(tz=datetime.UTC)) | Q(not_after=None)),  # Not after is after now (or unset)
-            )
-            .order_by("-followup_to", "-priority")
-            .afirst()
-        )
+        graph = await sync_to_async(eligibility.get_mission_graph)()
+
+        node = graph.next_mission(self.callLog.NPC_id, self.callLog.location_id, self.recruit_context.progress())
+        mission = None if node is None else await models.Mission.objects.aget(pk=node.id)
 
         if mission is None:
-            await self._say(
-                "I don't have any more work for you at the moment, give me a call back later.",
-            )
+            await self._say(NO_MORE_WORK_PROMPT)
             return
 
         recruit_mission = models.RecruitMission()
-        recruit_mission.recruit = recruit
         recruit_mission.mission = mission
-        await recruit_mission.asave()
+        self.recruit_context.add_mission(recruit_mission)
 
         await self._say(mission.give_text)
         return
@@ -414,21 +410,14 @@ class CallConsumer(AsyncJsonWebsocketConsumer):
         # TODO(Me): Implement https://github.com/girlpunk/Earthlings-On-Mars-Foundation/issues/3
         raise NotImplementedError
 
-    @sync_to_async
-    def speech_get_or_create(self, npc: models.NPC, text: str):
-        # TODO handle NPC being null, fall back to defalt for error msgs etc
-        return models.Speech.objects.get_or_create(
-            NPC=npc,
-            text=text,
-        )
+    async def _say_clips(self, texts: list[str], npc: models.NPC | None = None) -> None:
+        """Read a sequence of separately recorded clips to the player, as one prompt."""
+        for text in texts:
+            await self._say(text, npc=npc)
 
-    @sync_to_async
-    def speech_store_recording(self, speech: models.Speech, data: bytes, is_tts: bool):
-        speech.tts = is_tts
-        speech.recording.save(
-                name=f"speech-{speech.id}",
-                content=io.BytesIO(data),
-                save=True)
+    async def speech_get_or_create(self, npc: models.NPC, text: str) -> tuple[speech.SpeechEntry, bool]:
+        # TODO handle NPC being null, fall back to defalt for error msgs etc
+        return await speech.aget_or_create(npc.id, text)
 
 
 # vim: tw=0 ts=4 sw=4
@@ -2,65 +2,157 @@ import asyncio
 import contextlib
 import datetime
 import logging
-import time
-import threading
 import uuid
+from typing import Any
 
-from asgiref.sync import sync_to_async
 from calls import models
 from calls.consumers import CallConsumer, InvalidMessageError
-from calls.tts import Tts
+from calls.directory import aget_directory
+from calls.speech import start_synthesis
+from calls.tts import get_tts
+from django.conf import settings
 from django.urls import reverse
 
 # TODO prefix with some sort of call identifier.
 request_logger = logging.getLogger("eomf.calls.consumer.asterisk")
 
+# Seconds to wait for more digits once the minimum has been entered
+INTER_DIGIT_TIMEOUT = 5
+
+# Seconds to wait for digits after the prompt has finished playing
+PROMPT_TIMEOUT = 20
+
+# Key that ends a gather early, as Jambonz's finishOnKey does
+TERMINATOR = "#"
+
+# Seconds to wait for Asterisk to respond to a REST request
+REST_TIMEOUT = 5
+
+# Times to try starting a playback before skipping the prompt
+PLAY_ATTEMPTS = 2
+
+
+class RESTRequestError(Exception):
+    """Asterisk rejected a REST request."""
+
+    def __init__(self, method: str, uri: str, response: dict[str, Any]) -> None:
+        """Prepare the request exception."""
+        super().__init__(f"{method} {uri} failed: {response['status_code']} {response.get('reason_phrase', '')}")
+        self.response = response
+
+
+class DigitCollector:
+    """Collect DTMF digits for a single gather, as ChannelDtmfReceived events arrive."""
+
+    def __init__(
+        self,
+        min_digits: int,
+        max_digits: int,
+        inter_digit_timeout: float = INTER_DIGIT_TIMEOUT,
+        prompt_timeout: float = PROMPT_TIMEOUT,
+        terminator: str = TERMINATOR,
+    ) -> None:
+        """Prepare to collect digits."""
+        self.loop = asyncio.get_running_loop()
+        self.min_digits = min_digits
+        self.max_digits = max_digits
+        self.inter_digit_timeout = inter_digit_timeout
+        self.prompt_timeout = prompt_timeout
+        self.terminator = terminator
+        self.digits = ""
+        self.result: asyncio.Future[tuple[str, str]] = self.loop.create_future()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def add(self, digit: str) -> None:
+        """Record a digit from the player."""
+        if self.result.done():
+            return
+
+        if digit == self.terminator:
+            # Ends the gather, if enough digits have been entered, without being one of them
+            if len(self.digits) >= self.min_digits:
+                self._finish("dtmfDetected")
+            return
+
+        self.digits += digit
+        if len(self.digits) >= self.max_digits:
+            self._finish("dtmfDetected")
+        elif len(self.digits) >= self.min_digits:
+            self._start_timer(self.inter_digit_timeout, "dtmfDetected")
+
+    def prompt_finished(self) -> None:
+        """Start the prompt timeout, once the prompt has finished playing."""
+        if not self.result.done() and len(self.digits) < self.min_digits:
+            self._start_timer(self.prompt_timeout, "timeout")
+
+    def cancel(self) -> None:
+        """Stop collecting digits."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self.result.cancel()
+
+    def _start_timer(self, delay: float, reason: str) -> None:
+        """Finish collecting after a delay, replacing any existing timer."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(delay, self._finish, reason)
+
+    def _finish(self, reason: str) -> None:
+        """Wake the gather with the collected digits."""
+        if self._timer is not None:
+            self._timer.cancel()
+        if not self.result.done():
+            self.result.set_result((self.digits if reason == "dtmfDetected" else "", reason))
+
 
 class AsteriskCallConsumer(CallConsumer):
 
+    synthesise_missing_speech = True
+    speech_encoding = settings.ASTERISK_SPEECH_ENCODING
+
     def __init__(self) -> None:
         super().__init__()
-        self.tts = Tts()
-        self.playback_trackers = {}
-        self.gathered_digits = ""
-        self.last_digit_time = None
+        self.playback_trackers: dict[str, asyncio.Future[None]] = {}
+        self.digit_collector: DigitCollector | None = None
+        self.pending_requests: dict[str, asyncio.Future[dict[str, Any]]] = {}
+        # Set once the websocket has closed, after which Asterisk can't be sent anything or reply
+        self.websocket_closed = False
 
     async def connect(self) -> None:
         await super().connect()
         request_logger.info("Asterisk connect()")
         await self.accept()
 
-    @sync_to_async
-    def _update_log(self, message: str) -> None:
+    async def disconnect(self, reason: str) -> None:
+        """Fail any REST requests still waiting for a reply, which can no longer arrive, then tear down the call."""
+        self.websocket_closed = True
+        for response in list(self.pending_requests.values()):
+            if not response.done():
+                response.set_exception(ConnectionError("Websocket closed before Asterisk replied"))
+        await super().disconnect(reason)
+
+    async def _update_log(self, message: str) -> None:
         """Update the log for an in-progress call."""
         if self.callLog is None:
-            self.callLog, created = models.CallLog.objects.get_or_create(
-                call_id=message["channel"]["id"],
-                defaults={"duration": 0, "digits": 0},
-            )
-
-        if self.callLog.NPC is None:
-            with contextlib.suppress(models.NPC.DoesNotExist, ValueError):
-                extension = int(message["channel"]["dialplan"]["exten"])
-                self.callLog.NPC = models.NPC.objects.get(
-                    extension=extension,
-                )
-
-        if self.callLog.location is None:
-            with contextlib.suppress(ValueError, models.Location.DoesNotExist):
-                self.callLog.location = models.Location.objects.get(
-                    extension=message["channel"]["caller"]["number"],
-                )
+            await self._open_log(message["channel"]["id"])
+
+        directory = await aget_directory()
+
+        if self.callLog.NPC_id is None:
+            with contextlib.suppress(KeyError, ValueError):
+                self.log_buffer.update(NPC_id=directory.npc_id(message["channel"]["dialplan"]["exten"]))
+
+        if self.callLog.location_id is None:
+            with contextlib.suppress(KeyError, ValueError):
+                self.log_buffer.update(location_id=directory.location_id(message["channel"]["caller"]["number"]))
 
         # if "duration" in message["data"]:
         stamp = datetime.datetime.fromisoformat(message["timestamp"])
         created = datetime.datetime.fromisoformat(message["channel"]["creationtime"])
-        self.callLog.duration = (stamp - created).total_seconds()
+        self.log_buffer.update(duration=(stamp - created).total_seconds())
 
         if message["channel"]["state"] != "Up":
-            self.callLog.completed = True
-
-        self.callLog.asave()
+            self.log_buffer.update(completed=True)
 
     async def receive_json(self, data: str) -> None:
         """Decode message data from JSON, and sent to the relevent handler."""
@@ -95,32 +187,42 @@ class AsteriskCallConsumer(CallConsumer):
             await self._update_log(data)
         elif mtype == "ChannelDtmfReceived":
             digit = data["digit"]
-            self.gathered_digits += digit
-            request_logger.info("TONE digit: %s   [%s]", digit, self.gathered_digits)
-            self.last_digit_time = time.monotonic()
+            request_logger.info("TONE digit: %s", digit)
+            if self.digit_collector is not None:
+                self.digit_collector.add(digit)
         elif mtype == "RESTResponse":
-            if data["status_code"] < 200 or data["status_code"] >= 300:
-                request_logger.error(f"Failed REST request: {data}")
+            response = self.pending_requests.pop(data.get("request_id"), None)
+            if response is None:
+                request_logger.warning("Untracked REST response: %s", data)
+            elif not response.done():
+                response.set_result(data)
         elif mtype == "PlaybackStarted":
             pass
         elif mtype == "PlaybackFinished":
             playback_id = data["playback"]["id"]
-            tracker = self.playback_trackers.get(playback_id)
-            if tracker:
-                tracker.set()
+            finished = self.playback_trackers.get(playback_id)
+            if finished is not None:
+                if not finished.done():
+                    finished.set_result(None)
                 request_logger.info("Playback finished: %s", playback_id)
             else:
                 request_logger.warning("Untracked playback finished: %s", playback_id)
         else:
             raise InvalidMessageError(mtype, data)
 
-    async def _send(self, method: str | None, uri: str, **kwargs: dict[str, str]) -> None:
-        if method is None:
-            pass
+    async def _request(self, method: str, uri: str, **kwargs: str | int) -> asyncio.Future[dict[str, Any]]:
+        """Send a REST request to Asterisk, returning a future for its response.
+
+        Any number of requests can be in flight at once, responses are matched up by request ID.
+        """
+        request_id = str(uuid.uuid4())
+        response = asyncio.get_running_loop().create_future()
+        self.pending_requests[request_id] = response
+        response.add_done_callback(lambda done: self._forget_request(request_id, done))
 
         request = {
             "type": "RESTRequest",
-            "request_id": str(uuid.uuid4()),
+            "request_id": request_id,
             "method": method,
             "uri": uri,
             "query_strings": [{"name": name, "value": value} for (name, value) in kwargs.items()],
@@ -128,24 +230,36 @@ class AsteriskCallConsumer(CallConsumer):
 
         request_logger.info("OUT: %s %s - %s", method, uri, request)
         await self.send_json(request)
+        return response
+
+    async def _send_without_reply(self, method: str, uri: str, **kwargs: str | int) -> None:
+        """Send a REST request to Asterisk without waiting for its response, unless the websocket has closed."""
+        if self.websocket_closed:
+            return
+        await self._request(method, uri, **kwargs)
+
+    def _forget_request(self, request_id: str, response: asyncio.Future[dict[str, Any]]) -> None:
+        """Stop tracking a request once it has its response, or failed."""
+        self.pending_requests.pop(request_id, None)
+        # Whatever was waiting for it may have gone, so don't warn about an unretrieved error
+        if not response.cancelled():
+            response.exception()
+
+    async def _send(self, method: str, uri: str, *, reply_timeout: float = REST_TIMEOUT, **kwargs: str | int) -> dict[str, Any]:
+        """Send a REST request to Asterisk, and wait for a successful response."""
+        response = await asyncio.wait_for(await self._request(method, uri, **kwargs), reply_timeout)
+
+        if response["status_code"] < 200 or response["status_code"] >= 300:
+            raise RESTRequestError(method, uri, response)
 
-        # return_object = {"result": ""}
-        # if wait_for_response:
-        #    return_object['event'] = asyncio.Event()
-
-        # self.requests[uuidstr] = rtnobj
-        # await self.websocket.send(msg.encode('utf-8'), text=True)
-        # if wait_for_response:
-        #    await rtnobj['event'].wait()
-        # del self.requests[uuidstr]
-        # resp = rtnobj['result']
-        # self.log(INFO, f"RESTResponse: {method} {uri} {resp['status_code']} {resp['reason_phrase']}")
-        # if callback is not None:
-        #    return callback(self.websocket, uuidstr, req, rtnobj['result'])
-        # return rtnobj['result']
+        return response
 
     async def _say(self, text: str, npc: models.NPC | None = None) -> None:
         """Read text to the player."""
+        await self._say_clips([text], npc=npc)
+
+    async def _say_clips(self, texts: list[str], npc: models.NPC | None = None) -> None:
+        """Read a sequence of separately recorded clips to the player, as one playback."""
         if npc is None and self.callLog.NPC is None:
             request_logger.warning("Say with unknown NPC!")
             # self.outbound.append({"say": {"text": text}})
@@ -153,38 +267,59 @@ class AsteriskCallConsumer(CallConsumer):
         if npc is None:
             npc = self.callLog.NPC
 
-        speech, created = await self.speech_get_or_create(npc=npc, text=text)
-
-        if not speech.recording:
-            request_logger.warning("Generating TTS for missing text for %s: %s", npc.name, text)
-            audio_bytes = await self.tts.audio_bytes(text)
-            await self.speech_store_recording(speech, audio_bytes, True)
-
         headers = self.scope['headers']
         host = next(iter([h[1].decode('ascii') for h in headers if h[0] == b'host']))
         # TODO detect http/https using request.build_absolute_uri()
-        media = "sound:https://%s%s" % (host, reverse("speech", kwargs={"recording_id": speech.id}))
+        # Asterisk plays a comma separated list of media one after another
+        media = ",".join(["sound:https://%s%s" % (host, await self._speech_url(text, npc)) for text in texts])
+        text = " ".join(texts)
 
-        playback_id = str(uuid.uuid4())
-        tracker = threading.Event()
-        self.playback_trackers[playback_id] = tracker
+        for attempt in range(1, PLAY_ATTEMPTS + 1):
+            if await self._play(media, text):
+                return
+            request_logger.warning("Playback failed to start, attempt %s of %s: \"%s\"", attempt, PLAY_ATTEMPTS, text)
 
-        await self._send("POST", f"channels/{self.callLog.call_id}/play", media=media, playbackId=playback_id)
-        request_logger.info("Waiting for playback %s: \"%s\"", playback_id, text)
+        request_logger.error("Skipping prompt that could not be played: \"%s\"", text)
 
-        cancelled = False
-        while not tracker.is_set():
-            try:
-                await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                cancelled = True
-                break
+    async def _speech_url(self, text: str, npc: models.NPC) -> str:
+        """Get the URL of the speech for an NPC saying some text, synthesising it if it hasn't been recorded."""
+        speech, created = await self.speech_get_or_create(npc=npc, text=text)
+
+        if speech.recording:
+            return reverse("speech", kwargs={"recording_id": speech.id, "encoding": self.speech_encoding})
+
+        # Play the audio as it is synthesised, rather than waiting for all of it
+        request_logger.warning("Streaming TTS for missing text for %s: %s", npc.name, text)
+        start_synthesis(get_tts(), speech, text)
+        return reverse("speech_stream", kwargs={"recording_id": speech.id, "encoding": self.speech_encoding})
 
-        if cancelled:
+    async def _play(self, media: str, text: str) -> bool:
+        """Play media to the player and wait for it to finish, returning False if it could not be started."""
+        playback_id = str(uuid.uuid4())
+        finished = asyncio.get_running_loop().create_future()
+        self.playback_trackers[playback_id] = finished
+
+        try:
+            try:
+                await self._send("POST", f"channels/{self.callLog.call_id}/play", media=media, playbackId=playback_id)
+            except (RESTRequestError, TimeoutError, ConnectionError):
+                request_logger.exception("Failed to start playback %s", playback_id)
+                return False
+
+            request_logger.info("Waiting for playback %s: \"%s\"", playback_id, text)
+            await finished
+        except asyncio.CancelledError:
             request_logger.info("Playback %s cancelled.", playback_id)
-            await self._send("DELETE", f"playbacks/{playback_id}")
-        else:
-            request_logger.info("Done waiting for playback %s.", playback_id)
+            # The call may be being torn down, so don't wait for a reply that may never come. If the playback has
+            # already finished Asterisk rejects this, which doesn't matter.
+            with contextlib.suppress(ConnectionError):
+                await self._send_without_reply("DELETE", f"playbacks/{playback_id}")
+            raise
+        finally:
+            del self.playback_trackers[playback_id]
+
+        request_logger.info("Done waiting for playback %s.", playback_id)
+        return True
 
     async def _gather(
         self,
@@ -210,31 +345,32 @@ class AsteriskCallConsumer(CallConsumer):
             wanted_max = max_digits
         request_logger.info("Waiting for %s to %s digits...", wanted_min, wanted_max)
 
-        self.gathered_digits = ""
-        say_task = asyncio.create_task(self._say(text, npc=npc))
+        collector = DigitCollector(wanted_min, wanted_max)
+        self.digit_collector = collector
 
-        say_end_time = None
-        def on_say_done(_):
-            nonlocal say_end_time
-            say_end_time = time.monotonic()
-        say_task.add_done_callback(on_say_done)
+        say_task = asyncio.create_task(self._say(text, npc=npc))
+        say_task.add_done_callback(lambda _: collector.prompt_finished())
 
-        while len(self.gathered_digits) < wanted_max:
-            if len(self.gathered_digits) >= wanted_min and self.last_digit_time is not None and time.monotonic() - self.last_digit_time > 5:
-                break
-            elif say_end_time is not None and time.monotonic() - say_end_time > 20:
-                say_task.cancel()
-                return ("", "timeout")
-            await asyncio.sleep(1)
+        try:
+            digits, reason = await collector.result
+        finally:
+            say_task.cancel()
+            collector.cancel()
+            self.digit_collector = None
 
-        say_task.cancel()
-        request_logger.info("Returning gathered digits: %s", self.gathered_digits)
-        return (self.gathered_digits, "dtmfDetected")
+        request_logger.info("Returning gathered digits: %s (%s)", digits, reason)
+        return (digits, reason)
 
     async def _hangup(self) -> None:
         # https://docs.asterisk.org/Configuration/Miscellaneous/Hangup-Cause-Mappings/#asterisk-hangup-cause-code-mappings
         # 16 = Normal Clearing
-        await self._send("DELETE", f"channels/{self.callLog.call_id}", reason_code=16)
+        if self.websocket_closed:
+            # Asterisk has already gone
+            return
+        try:
+            await self._send("DELETE", f"channels/{self.callLog.call_id}", reason_code=16)
+        except (RESTRequestError, TimeoutError, ConnectionError):
+            request_logger.exception("Failed to hang up channel %s", self.callLog.call_id)
 
 
 # vim: tw=0 ts=4 sw=4
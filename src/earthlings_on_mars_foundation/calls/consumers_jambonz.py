@@ -1,51 +1,54 @@
+import asyncio
 import contextlib
 import logging
+import uuid
 from typing import Any, List
 
 from calls import models
 from calls.consumers import CallConsumer, InvalidMessageError
+from calls.directory import aget_directory
+from django.conf import settings
 from django.urls import reverse
 
 request_logger = logging.getLogger("eomf.calls.consumer.jambonz")
 
+# Seconds to wait for Jambonz to return the result of a gather
+GATHER_TIMEOUT = 20
+
 
 class JambonzCallConsumer(CallConsumer):
+    speech_encoding = settings.JAMBONZ_SPEECH_ENCODING
+
     def __init__(self) -> None:
         self.callLog: models.CallLog | None = None
         super().__init__()
+        self.outbound: List[dict[str, Any]] = []
+        self.hook_waiters: dict[str, asyncio.Future[dict[str, Any]]] = {}
 
     async def connect(self) -> None:
-        self.outbound: List[dict[str, Any]] = []
-        super().connect()
+        await super().connect()
         await self.accept("ws.jambonz.org")
 
     async def _update_log(self, message: dict[str, Any]) -> None:
         """Update the log for an in-progress call."""
         if self.callLog is None:
-            self.callLog, created = await models.CallLog.objects.aget_or_create(
-                call_id=message["call_sid"],
-                defaults={"duration": 0, "digits": 0},
-            )
+            await self._open_log(message["call_sid"])
+
+        directory = await aget_directory()
 
-        if self.callLog.NPC is None:
-            with contextlib.suppress(models.NPC.DoesNotExist):
-                self.callLog.NPC = await models.NPC.objects.aget(
-                    extension=message["data"]["to"],
-                )
+        if self.callLog.NPC_id is None:
+            with contextlib.suppress(KeyError, ValueError):
+                self.log_buffer.update(NPC_id=directory.npc_id(message["data"]["to"]))
 
-        if self.callLog.location is None:
-            with contextlib.suppress(ValueError, models.Location.DoesNotExist):
-                self.callLog.location = await models.Location.objects.aget(
-                    extension=message["data"]["from"],
-                )
+        if self.callLog.location_id is None:
+            with contextlib.suppress(KeyError, ValueError):
+                self.log_buffer.update(location_id=directory.location_id(message["data"]["from"]))
 
         if "duration" in message["data"]:
-            self.callLog.duration = message["data"]["duration"]
+            self.log_buffer.update(duration=message["data"]["duration"])
 
         if message["data"]["call_status"] == "completed":
-            self.callLog.completed = True
-
-        await self.callLog.asave()
+            self.log_buffer.update(completed=True)
 
     async def receive_json(self, data: dict[str, Any]) -> None:
         """Decode message data from JSON, and send to the relevent handler."""
@@ -65,9 +68,12 @@ class JambonzCallConsumer(CallConsumer):
             request_logger.info("OUT: %s", message)
             await self.send_json(message)
         elif data["type"] == "verb:hook":
-            self.incomingMessage = data
             self.active_message = data["msgid"]
-            self.newMessage.set()
+            waiter = self.hook_waiters.pop(data.get("hook"), None)
+            if waiter is None:
+                request_logger.warning("Untracked hook: %s", data)
+            elif not waiter.done():
+                waiter.set_result(data)
         else:
             raise InvalidMessageError(
                 data["type"],
@@ -76,6 +82,11 @@ class JambonzCallConsumer(CallConsumer):
 
     async def _say(self, text: str, npc: models.NPC | None = None) -> None:
         """Read text to the player."""
+        await self._say_clips([text], npc=npc)
+
+    async def _say_clips(self, texts: list[str], npc: models.NPC | None = None) -> None:
+        """Read a sequence of separately recorded clips to the player, as one play verb."""
+        text = " ".join(texts)
         if npc is None and self.callLog.NPC is None:
             request_logger.warning("Say with unknown NPC!")
             self.outbound.append({"say": {"text": text}})
@@ -83,19 +94,24 @@ class JambonzCallConsumer(CallConsumer):
         if npc is None:
             npc = self.callLog.NPC
 
-        recording, created = await self.speech_get_or_create(npc=npc, text=text)
-
-        if created or recording.recording is None:
-            request_logger.warning("Missing text for %s: %s", npc.name, text)
-            self.outbound.append({"say": {"text": text}})
-        else:
-            self.outbound.append(
-                {
-                    "play": {
-                        "url": reverse("speech", kwargs={"id": recording.id}),
-                    },
+        urls = []
+        for clip in texts:
+            recording, created = await self.speech_get_or_create(npc=npc, text=clip)
+            if created or not recording.recording:
+                # Let Jambonz say the whole prompt rather than leave a gap
+                request_logger.warning("Missing text for %s: %s", npc.name, clip)
+                self.outbound.append({"say": {"text": text}})
+                return
+            urls.append(reverse("speech", kwargs={"recording_id": recording.id, "encoding": self.speech_encoding}))
+
+        self.outbound.append(
+            {
+                "play": {
+                    # Jambonz plays a list of URLs one after another
+                    "url": urls[0] if len(urls) == 1 else urls,
                 },
-            )
+            },
+        )
 
     async def _gather(
         self,
@@ -103,11 +119,15 @@ class JambonzCallConsumer(CallConsumer):
         digits: int | None = None,
         min_digits: int | None = None,
         max_digits: int | None = None,
+        npc: models.NPC | None = None,
     ) -> tuple[str | None, str]:
         """Gather DTMF digits from the player."""
+        # Jambonz assigns its own msgids, so each gather gets a unique hook to match up the result
+        hook = f"/gather/{uuid.uuid4()}"
+
         command = {
             "input": ["digits"],  # Can also include "speech"
-            "actionHook": "wss://fa8340b16a8854.lhr.life/ws/call/",
+            "actionHook": hook,
             "bargein": False,
             "dtmfBargein": True,
             "finishOnKey": "#",
@@ -122,31 +142,38 @@ class JambonzCallConsumer(CallConsumer):
         if max_digits is not None:
             command["maxDigits"] = max_digits
 
-        recording, created = await self.speech_get_or_create(npc=self.callLog.NPC, text=text)
+        if npc is None:
+            npc = self.callLog.NPC
+
+        recording, created = await self.speech_get_or_create(npc=npc, text=text)
 
-        if created or recording.recording is None:
-            request_logger.warning("Missing text for %s: %s", self.callLog.NPC.name, text)
+        if created or not recording.recording:
+            request_logger.warning("Missing text for %s: %s", npc.name, text)
             command["say"] = {"text": text}
         else:
             command["play"] = {
-                "url": reverse("speech", kwargs={"recording_id": recording.id}),
+                "url": reverse("speech", kwargs={"recording_id": recording.id, "encoding": self.speech_encoding}),
             }
 
         self.outbound.append({"gather": command})
 
-        await self._send()
+        waiter = asyncio.get_running_loop().create_future()
+        self.hook_waiters[hook] = waiter
 
-        self.newMessage.wait(20)
-        value = self.incomingMessage
-        self.newMessage.clear()
-        self.incomingMessage = None
+        try:
+            await self._send()
+            value = await asyncio.wait_for(waiter, GATHER_TIMEOUT)
+        except TimeoutError:
+            request_logger.warning("No result for gather %s", hook)
+            return (None, "timeout")
+        finally:
+            self.hook_waiters.pop(hook, None)
 
         digits = None
 
         if "digits" in value["data"]:
             digits = value["data"]["digits"]
-            self.callLog.digits += len(digits)
-            await self.callLog.asave()
+            self.log_buffer.update(digits=self.callLog.digits + len(digits))
 
         return (digits, value["data"]["reason"])
 
@@ -0,0 +1,173 @@
+"""Per-call snapshot of a recruit's game state."""
+
+from __future__ import annotations
+
+import datetime
+import logging
+
+from asgiref.sync import sync_to_async
+from calls import eligibility, models
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger("eomf.calls.context")
+
+# Fields the call logic may change on an existing row. Mission outcomes and
+# scores are only ever written by `afinish_mission`, so concurrent calls by the
+# same recruit can't overwrite each other's.
+RECRUIT_MISSION_FIELDS = ["code_tries", "count_value", "state"]
+RECRUIT_NPC_FIELDS = ["contacted"]
+
+
+class RecruitContext:
+    """A recruit's missions and NPC relationships, loaded once after authentication.
+
+    The call logic reads and changes these in memory, then writes all changes back together with `asave`.
+    """
+
+    def __init__(self, recruit: models.Recruit, missions: list[models.RecruitMission], npcs: list[models.RecruitNPC]) -> None:
+        """Prepare the context."""
+        self.recruit = recruit
+        self.missions = missions
+        self.npcs = {recruit_npc.NPC_id: recruit_npc for recruit_npc in npcs}
+
+        self._new: list[models.RecruitMission | models.RecruitNPC] = []
+        # Changed rows, and the fields changed on each
+        self._changed: dict[models.RecruitMission | models.RecruitNPC, set[str]] = {}
+
+    @classmethod
+    async def aload(cls, recruit: models.Recruit) -> RecruitContext:
+        """Load all of a recruit's missions and NPC relationships, in two queries."""
+        missions = [
+            recruit_mission
+            async for recruit_mission in models.RecruitMission.objects.filter(recruit=recruit).select_related(
+                "mission",
+                "mission__issued_by",
+                "mission__call_back_from",
+                "mission__call_another",
+                "mission__followup_mission",
+            )
+        ]
+        for recruit_mission in missions:
+            recruit_mission.recruit = recruit
+
+        npcs = [recruit_npc async for recruit_npc in models.RecruitNPC.objects.filter(recruit=recruit)]
+
+        return cls(recruit, missions, npcs)
+
+    def open_missions(self) -> list[models.RecruitMission]:
+        """Get the recruit's unfinished missions."""
+        return [recruit_mission for recruit_mission in self.missions if recruit_mission.finished is None]
+
+    def progress(self) -> eligibility.RecruitProgress:
+        """Get the missions the recruit has finished, for finding a new mission."""
+        return eligibility.RecruitProgress.from_rows(
+            (recruit_mission.mission_id, recruit_mission.completed, recruit_mission.finished) for recruit_mission in self.missions
+        )
+
+    def recruit_npc(self, npc_id: int) -> models.RecruitNPC:
+        """Get the recruit's relationship with an NPC, starting one if needed."""
+        recruit_npc = self.npcs.get(npc_id)
+        if recruit_npc is None:
+            recruit_npc = models.RecruitNPC(recruit=self.recruit, NPC_id=npc_id)
+            self.npcs[npc_id] = recruit_npc
+            self._new.append(recruit_npc)
+        return recruit_npc
+
+    def add_mission(self, recruit_mission: models.RecruitMission) -> None:
+        """Start a new mission for the recruit."""
+        recruit_mission.recruit = self.recruit
+        self.missions.append(recruit_mission)
+        self._new.append(recruit_mission)
+
+    def changed(self, row: models.RecruitMission | models.RecruitNPC, *fields: str) -> None:
+        """Mark fields of a row as changed, so they are written back on the next save.
+
+        Without any fields, every field the call logic may change is written.
+        """
+        allowed = RECRUIT_MISSION_FIELDS if isinstance(row, models.RecruitMission) else RECRUIT_NPC_FIELDS
+        if not set(fields) <= set(allowed):
+            raise ValueError(fields)
+        if row not in self._new:
+            self._changed.setdefault(row, set()).update(fields or allowed)
+
+    @property
+    def dirty(self) -> bool:
+        """Check if there are changes that have not been written back."""
+        return bool(self._new or self._changed)
+
+    async def asave(self) -> None:
+        """Write all changes back to the database."""
+        if self.dirty:
+            await sync_to_async(self._save)()
+
+    async def afinish_mission(self, recruit_mission: models.RecruitMission, *, completed: bool) -> models.RecruitMission | None:
+        """Record the outcome of a mission, starting its followup mission if it was completed.
+
+        Returns the followup mission, if one was started.
+        """
+        return await sync_to_async(self._finish_mission)(recruit_mission, completed)
+
+    @transaction.atomic
+    def _finish_mission(self, recruit_mission: models.RecruitMission, completed: bool) -> models.RecruitMission | None:  # noqa: FBT001
+        """Record the outcome of a mission, in a single transaction."""
+        mission = recruit_mission.mission
+        recruit_npc = self.recruit_npc(mission.issued_by_id)
+
+        # Write anything pending first, including rows this needs to exist
+        self._save()
+
+        recruit_mission.finished = datetime.datetime.now(tz=datetime.UTC)
+        recruit_mission.completed = completed
+
+        # Only the first call to finish a mission gets to score it
+        updated = models.RecruitMission.objects.filter(pk=recruit_mission.pk, finished__isnull=True).update(
+            finished=recruit_mission.finished,
+            completed=completed,
+        )
+        if not updated:
+            logger.warning("%s was already finished", recruit_mission)
+            return None
+
+        points = mission.points if completed else -mission.points
+        models.RecruitNPC.objects.filter(pk=recruit_npc.pk).update(score=F("score") + points)
+        recruit_npc.refresh_from_db(fields=["score"])
+
+        if not completed or mission.followup_mission is None:
+            return None
+
+        followup = models.RecruitMission.objects.create(recruit=self.recruit, mission=mission.followup_mission)
+        self.missions.append(followup)
+        logger.info("Started followup %s", followup)
+        return followup
+
+    @transaction.atomic
+    def _save(self) -> None:
+        """Write all changes back, in a single transaction."""
+        if not self.dirty:
+            return
+
+        new = self._new
+        changed = self._changed
+        self._new = []
+        self._changed = {}
+
+        for recruit_npc in [row for row in new if isinstance(row, models.RecruitNPC)]:
+            # Another call by this recruit may have met the NPC since this one loaded
+            existing, created = models.RecruitNPC.objects.get_or_create(recruit=self.recruit, NPC_id=recruit_npc.NPC_id, defaults={"contacted": recruit_npc.contacted})
+            recruit_npc.pk = existing.pk
+            recruit_npc.score = existing.score
+            if not created:
+                recruit_npc.contacted |= existing.contacted
+                changed[recruit_npc] = set(RECRUIT_NPC_FIELDS)
+
+        models.RecruitMission.objects.bulk_create([row for row in new if isinstance(row, models.RecruitMission)])
+
+        # Rows are updated in batches by the fields changed on them, so that only those columns are written
+        batches: dict[tuple[type[models.RecruitMission | models.RecruitNPC], tuple[str, ...]], list[models.RecruitMission | models.RecruitNPC]] = {}
+        for row, fields in changed.items():
+            batches.setdefault((type(row), tuple(sorted(fields))), []).append(row)
+        for (model, fields), rows in batches.items():
+            model.objects.bulk_update(rows, fields)
+
+        logger.info("Saved %s new and %s changed rows for %s", len(new), len(changed), self.recruit)
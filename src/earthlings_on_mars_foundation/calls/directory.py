@@ -0,0 +1,94 @@
+"""In-process routing table from extensions to NPCs and locations."""
+
+from __future__ import annotations
+
+import logging
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any
+
+from asgiref.sync import sync_to_async
+from calls import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+logger = logging.getLogger("eomf.calls.directory")
+
+
+@dataclass(frozen=True)
+class ExtensionDirectory:
+    """Immutable snapshot of which NPC and location each extension belongs to."""
+
+    # Dialled extension (B-Number) to NPC ID
+    npcs: Mapping[int, int]
+
+    # Calling extension (A-Number) to location ID
+    locations: Mapping[int, int]
+
+    @classmethod
+    def load(cls) -> ExtensionDirectory:
+        """Load the directory from the database."""
+        npcs: dict[int, int] = {}
+        for pk, extension in models.NPC.objects.order_by("pk").values_list("pk", "extension"):
+            npcs.setdefault(extension, pk)
+
+        locations: dict[int, int] = {}
+        for pk, extension in models.Location.objects.order_by("pk").values_list("pk", "extension"):
+            locations.setdefault(extension, pk)
+
+        return cls(npcs=MappingProxyType(npcs), locations=MappingProxyType(locations))
+
+    def npc_id(self, extension: str | int) -> int | None:
+        """Find the NPC reached by dialling an extension."""
+        return self.npcs.get(int(extension))
+
+    def location_id(self, extension: str | int) -> int | None:
+        """Find the location a call from an extension was placed from."""
+        return self.locations.get(int(extension))
+
+
+_directory: ExtensionDirectory | None = None
+_directory_lock = threading.Lock()
+
+
+def get_directory() -> ExtensionDirectory:
+    """Get the current directory, loading it if needed."""
+    global _directory  # noqa: PLW0603
+
+    directory = _directory
+    if directory is None:
+        with _directory_lock:
+            if _directory is None:
+                _directory = ExtensionDirectory.load()
+                logger.info("Loaded %s NPC and %s location extensions", len(_directory.npcs), len(_directory.locations))
+            directory = _directory
+    return directory
+
+
+async def aget_directory() -> ExtensionDirectory:
+    """Get the current directory, only leaving the event loop if it needs loading."""
+    directory = _directory
+    if directory is None:
+        directory = await sync_to_async(get_directory)()
+    return directory
+
+
+def invalidate_directory() -> None:
+    """Discard the directory, so it is reloaded on next use."""
+    global _directory  # noqa: PLW0603
+
+    with _directory_lock:
+        _directory = None
+
+
+@receiver(post_save, sender=models.NPC)
+@receiver(post_delete, sender=models.NPC)
+@receiver(post_save, sender=models.Location)
+@receiver(post_delete, sender=models.Location)
+def _extensions_changed(**_: Any) -> None:  # noqa: ANN401
+    """Reload extensions after they are edited."""
+    invalidate_directory()
@@ -0,0 +1,236 @@
+"""In-memory mission eligibility engine."""
+
+from __future__ import annotations
+
+import datetime
+import heapq
+import logging
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any
+
+from calls import models
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from django.db.models import QuerySet
+
+logger = logging.getLogger("eomf.calls.eligibility")
+
+
+@dataclass(frozen=True)
+class MissionNode:
+    """The parts of a mission needed to decide if it can be started."""
+
+    id: int
+    issued_by_id: int
+    only_start_from_id: int | None
+    prerequisites: frozenset[int]
+    repeatable: bool
+    not_before: datetime.datetime | None
+    not_after: datetime.datetime | None
+
+    # Number of missions this one is a followup to
+    followup_to: int
+    priority: int
+
+    @property
+    def rank(self) -> tuple[int, int, int]:
+        """Sort key, most preferred missions first."""
+        return (-self.followup_to, -self.priority, self.id)
+
+    def available(self, now: datetime.datetime) -> bool:
+        """Check if the mission can be started at the given time."""
+        return (self.not_before is None or self.not_before <= now) and (self.not_after is None or self.not_after >= now)
+
+
+@dataclass(frozen=True)
+class RecruitProgress:
+    """Missions a recruit has started and finished."""
+
+    completed: frozenset[int]
+    finished: frozenset[int]
+    in_progress: frozenset[int]
+
+    @staticmethod
+    def query(recruit: models.Recruit | int) -> QuerySet:
+        """Get the (mission ID, completed, finished) rows for a recruit."""
+        return models.RecruitMission.objects.filter(recruit=recruit).values_list("mission_id", "completed", "finished")
+
+    @classmethod
+    def load(cls, recruit: models.Recruit | int) -> RecruitProgress:
+        """Load a recruit's progress with a single query."""
+        return cls.from_rows(cls.query(recruit))
+
+    @classmethod
+    async def aload(cls, recruit: models.Recruit | int) -> RecruitProgress:
+        """Load a recruit's progress with a single query."""
+        return cls.from_rows([row async for row in cls.query(recruit)])
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[int, bool, datetime.datetime | None]]) -> RecruitProgress:
+        """Build progress from (mission ID, completed, finished) rows."""
+        completed = set()
+        finished = set()
+        in_progress = set()
+        for mission_id, was_completed, finished_at in rows:
+            if was_completed:
+                completed.add(mission_id)
+            if finished_at is not None:
+                finished.add(mission_id)
+            else:
+                in_progress.add(mission_id)
+        return cls(frozenset(completed), frozenset(finished), frozenset(in_progress))
+
+
+@dataclass(frozen=True)
+class MissionGraph:
+    """Immutable snapshot of all missions and their prerequisites."""
+
+    missions: Mapping[int, MissionNode]
+
+    # Missions by (issued by NPC ID, only start from location ID), in preference order
+    by_start: Mapping[tuple[int, int | None], tuple[MissionNode, ...]]
+
+    @classmethod
+    def load(cls) -> MissionGraph:
+        """Load the mission graph from the database."""
+        prerequisites: dict[int, set[int]] = {}
+        for mission_id, prerequisite_id in models.MissionPrerequisite.objects.values_list("mission_id", "prerequisite_id"):
+            prerequisites.setdefault(mission_id, set()).add(prerequisite_id)
+
+        followup_to: dict[int, int] = {}
+        for followup_id in models.Mission.objects.filter(followup_mission__isnull=False).values_list("followup_mission_id", flat=True):
+            followup_to[followup_id] = followup_to.get(followup_id, 0) + 1
+
+        missions = {}
+        by_start: dict[tuple[int, int | None], list[MissionNode]] = {}
+        fields = ("id", "issued_by_id", "only_start_from_id", "repeatable", "not_before", "not_after", "priority")
+        for row in models.Mission.objects.values(*fields):
+            node = MissionNode(
+                prerequisites=frozenset(prerequisites.get(row["id"], ())),
+                followup_to=followup_to.get(row["id"], 0),
+                **row,
+            )
+            missions[node.id] = node
+            by_start.setdefault((node.issued_by_id, node.only_start_from_id), []).append(node)
+
+        return cls(
+            missions=MappingProxyType(missions),
+            by_start=MappingProxyType({key: tuple(sorted(nodes, key=lambda node: node.rank)) for key, nodes in by_start.items()}),
+        )
+
+    def next_mission(
+        self,
+        npc_id: int,
+        location_id: int | None,
+        progress: RecruitProgress,
+        now: datetime.datetime | None = None,
+    ) -> MissionNode | None:
+        """Find the most preferred mission the recruit can start with this NPC, from this location.
+
+        Missions the recruit has started but not finished are never offered, even if they are repeatable, so a recruit can't hold two copies of the same mission.
+        The SQL query this replaced did offer them.
+        """
+        if now is None:
+            now = datetime.datetime.now(tz=datetime.UTC)
+
+        candidates = self.by_start.get((npc_id, None), ())
+        if location_id is not None:
+            candidates = heapq.merge(candidates, self.by_start.get((npc_id, location_id), ()), key=lambda node: node.rank)
+
+        for node in candidates:
+            if node.id in progress.in_progress or (node.id in progress.finished and not node.repeatable):
+                continue
+            if node.prerequisites <= progress.completed and node.available(now):
+                return node
+
+        return None
+
+
+def query_next_mission(recruit_id: int, npc_id: int, location_id: int | None) -> models.Mission | None:
+    """Find a new mission with the single SQL query the mission graph replaced, to compare the two.
+
+    Unlike the mission graph, this offers missions the recruit already has in progress, and miscounts the completed prerequisites of
+    missions with more than one.
+    """
+    return (
+        models.Mission.objects.annotate(
+            total_prerequisites=Count("prerequisites"),
+            completed_prerequisites=Count(
+                models.MissionPrerequisite.objects.filter(
+                    Q(mission=OuterRef("pk")),
+                    Q(
+                        Exists(
+                            models.RecruitMission.objects.filter(
+                                mission=OuterRef("prerequisite__id"),
+                                recruit=recruit_id,
+                                completed=True,
+                            ),
+                        ),
+                    ),
+                ).values("id"),
+            ),
+            followup_to=Count("mission"),
+        )
+        .filter(
+            Q(issued_by=npc_id)
+            & (Q(only_start_from=location_id) | Q(only_start_from=None))
+            & Q(
+                ~Exists(
+                    models.RecruitMission.objects.filter(
+                        mission=OuterRef("pk"),
+                        recruit=recruit_id,
+                        finished__isnull=False,
+                    ),
+                )
+                | Q(repeatable=True),
+            )
+            & Q(total_prerequisites=F("completed_prerequisites"))
+            & (Q(not_before__lte=datetime.datetime.now(tz=datetime.UTC)) | Q(not_before=None))
+            & (Q(not_after__gte=datetime.datetime.now(tz=datetime.UTC)) | Q(not_after=None)),
+        )
+        .order_by("-followup_to", "-priority")
+        .first()
+    )
+
+
+_graph: MissionGraph | None = None
+_graph_lock = threading.Lock()
+
+
+def get_mission_graph() -> MissionGraph:
+    """Get the current mission graph, loading it if needed."""
+    global _graph  # noqa: PLW0603
+
+    graph = _graph
+    if graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = MissionGraph.load()
+                logger.info("Loaded %s missions", len(_graph.missions))
+            graph = _graph
+    return graph
+
+
+def invalidate_mission_graph() -> None:
+    """Discard the mission graph, so it is reloaded on next use."""
+    global _graph  # noqa: PLW0603
+
+    with _graph_lock:
+        _graph = None
+
+
+@receiver(post_save, sender=models.Mission)
+@receiver(post_delete, sender=models.Mission)
+@receiver(post_save, sender=models.MissionPrerequisite)
+@receiver(post_delete, sender=models.MissionPrerequisite)
+@receiver(m2m_changed, sender=models.MissionPrerequisite)
+def _missions_changed(**_: Any) -> None:  # noqa: ANN401
+    """Reload missions after they are edited."""
+    invalidate_mission_graph()
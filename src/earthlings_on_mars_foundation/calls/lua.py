@@ -1,37 +1,550 @@
 """Lua helper functions."""
 
+from __future__ import annotations
+
 import asyncio
-from collections.abc import Coroutine
-from typing import Any
+import concurrent.futures
+import contextlib
+import hashlib
+import inspect
+import logging
+import math
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+import lupa
+from django.conf import settings
+from lupa import LuaError, LuaMemoryError, LuaRuntime, LuaSyntaxError
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Callable, Iterable
+
+    from calls import models
+
+logger = logging.getLogger("eomf.calls.lua")
+
+# Globals missions can use in a sandboxed runtime, anything else is removed
+SANDBOX_GLOBALS = (
+    "_G", "_VERSION", "assert", "coroutine", "error", "getmetatable", "ipairs", "math", "next", "os", "pairs", "pcall", "print", "python",
+    "rawequal", "rawget", "rawlen", "rawset", "select", "setmetatable", "string", "table", "tonumber", "tostring", "type", "utf8", "xpcall",
+)  # fmt: skip
+
+# Of the os library, only telling the time is allowed
+SANDBOX_OS = ("clock", "date", "difftime", "time")
+
+# Instructions run between checks of a script's budget
+BUDGET_STEP = 1000
+
+# Installs a hook on a script's coroutine that stops it once it has run too
+# many instructions, or for too long, and returns a function that gives the
+# reason the script was stopped, if it was. Once stopped the hook runs on every
+# instruction, so that the script can't carry on by catching the error.
+# Coroutines the script starts inherit the hook.
+_LIMIT = """
+local sethook, error = debug.sethook, error
+
+return function(thread, instructions, seconds, step, elapsed)
+    local count, reason = 0, nil
+    local function hook()
+        count = count + step
+        if reason == nil then
+            if count > instructions then
+                reason = "instruction limit"
+            elseif elapsed() > seconds then
+                reason = "time limit"
+            end
+            if reason ~= nil then
+                step = 1
+                sethook(hook, "", 1)
+            end
+        end
+        if reason ~= nil then
+            error(reason .. " exceeded", 0)
+        end
+    end
+
+    sethook(thread, hook, "", step)
+    return function() return reason end
+end
+"""
+
+# Tables in a mission's state can be nested this deep, which also stops tables that contain themselves
+MAX_STATE_DEPTH = 32
+
+# Marks tables made from lists in a mission's state, so that they are still
+# lists if they are empty when the state is stored again. The mark is a
+# protected metatable, so scripts can't change it for later missions.
+_LISTS = """
+local setmetatable, getmetatable = setmetatable, debug.getmetatable
+local mark = {__metatable = "list"}
+return function(t) return setmetatable(t, mark) end, function(t) return getmetatable(t) == mark end
+"""
+
+# What Lua gives as the error when it runs out of memory
+_MEMORY_ERROR = "not enough memory"
+
+# Runs a script as a coroutine, a step at a time, for the runtime to drive
+# from Python. Each step gives whether the script has finished, and what
+# coroutine.resume did. Python async functions are wrapped so that calling them
+# yields what they return to the runtime, which awaits it on the event loop and
+# resumes the script with the result. Only the script's own coroutine can do
+# that, not any it starts.
+_DRIVER = """
+local create, resume, status, running, yield = coroutine.create, coroutine.resume, coroutine.status, coroutine.running, coroutine.yield
+local sethook, pack, unpack, error = debug.sethook, table.pack, table.unpack, error
+local limit = ...
+local driven
+
+local function start(func, ...)
+    driven = create(func)
+    return limit(driven, ...)
+end
+
+local function step(...)
+    local results = pack(resume(driven, ...))
+    return status(driven) == "dead", unpack(results, 1, results.n)
+end
+
+local function stop()
+    if driven ~= nil then
+        sethook(driven)
+    end
+    driven = nil
+end
+
+local function bridge(func)
+    return function(...)
+        if driven == nil or running() ~= driven then
+            error("can only be called by the mission itself, not from a coroutine it started", 2)
+        end
+        return yield(func(...))
+    end
+end
+
+return start, step, stop, bridge
+"""
+
+# Removes anything not allowed from the globals, and returns a function that
+# puts the globals, the libraries in them, and the metatable all strings
+# share, back to how they were left.
+_SANDBOX = """
+local allowed, allowed_os = ...
+local pairs, type, setmetatable, getmetatable = pairs, type, debug.setmetatable, getmetatable
+
+local keep, keep_os = {}, {}
+for _, name in ipairs(allowed) do keep[name] = true end
+for _, name in ipairs(allowed_os) do keep_os[name] = true end
+for name in pairs(_G) do
+    if not keep[name] then _G[name] = nil end
+end
+for name in pairs(os) do
+    if not keep_os[name] then os[name] = nil end
+end
+
+local baseline, libraries = {}, {}
+for name, value in pairs(_G) do
+    baseline[name] = value
+    if type(value) == "table" and value ~= _G then
+        local contents = {}
+        for k, v in pairs(value) do contents[k] = v end
+        libraries[value] = contents
+    end
+end
+local string_metatable = {}
+for k, v in pairs(getmetatable("")) do string_metatable[k] = v end
+libraries[getmetatable("")] = string_metatable
+
+return function()
+    setmetatable(_G, nil)
+    for name in pairs(_G) do
+        if baseline[name] == nil then _G[name] = nil end
+    end
+    for name, value in pairs(baseline) do _G[name] = value end
+
+    for library, contents in pairs(libraries) do
+        setmetatable(library, nil)
+        for k in pairs(library) do
+            if contents[k] == nil then library[k] = nil end
+        end
+        for k, v in pairs(contents) do library[k] = v end
+    end
+end
+"""
+
+
+class LuaBudgetExceededError(LuaError):
+    """A script ran over its budget, and was stopped."""
+
+
+@dataclass(frozen=True)
+class LuaBudget:
+    """How much a script can do before it is stopped."""
+
+    instructions: int
+    seconds: float
+
+    @classmethod
+    def from_settings(cls) -> LuaBudget:
+        """Get the budget for checking a mission."""
+        return cls(settings.LUA_INSTRUCTION_LIMIT, settings.LUA_TIME_LIMIT)
+
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Get the threads Lua is run on, so that a slow script can't hold up the ones Django uses for the database."""
+    global _executor  # noqa: PLW0603
+
+    executor = _executor
+    if executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(settings.LUA_EXECUTOR_THREADS, thread_name_prefix="lua")
+            executor = _executor
+    return executor
+
+
+def _attribute_filter(_: object, name: str, __: bool) -> str:  # noqa: FBT001
+    """Keep Lua away from private attributes of Python objects, such as a model's `_meta` or `__class__`."""
+    if not isinstance(name, str) or name.startswith("_"):
+        raise AttributeError(name)
+    return name
+
+
+@dataclass(frozen=True)
+class CompiledChunk:
+    """A mission's Lua, compiled to bytecode that any runtime can load without parsing it again."""
+
+    mission_id: int
+    source_hash: str
+    bytecode: bytes
+
+    @property
+    def key(self) -> tuple[int, str]:
+        """Get what the chunk is cached by."""
+        return (self.mission_id, self.source_hash)
+
+
+class ChunkCache:
+    """Compiled Lua for each mission, keyed by a hash of its script so that edits are picked up."""
+
+    def __init__(self) -> None:
+        """Prepare the cache."""
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.0
+
+        self._chunks: dict[tuple[int, str], CompiledChunk] = {}
+        self._lock = threading.Lock()
+
+        # Only ever used to compile, nothing is run in it. Without an encoding
+        # Lua strings come back as bytes, which bytecode needs.
+        self._compiler = LuaRuntime(encoding=None)
+
+    def get(self, mission_id: int, source: str) -> CompiledChunk:
+        """Get a mission's compiled Lua, compiling it if this version hasn't been seen before."""
+        key = (mission_id, hashlib.sha256(source.encode()).hexdigest())
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self.hits += 1
+                return chunk
+
+            self.misses += 1
+            start = time.perf_counter()
+            try:
+                chunk = CompiledChunk(mission_id, key[1], self._compile(mission_id, source))
+            finally:
+                self.compile_seconds += time.perf_counter() - start
 
-from lupa import LuaRuntime
+            # Older versions of the script won't be run again
+            for old in [old for old in self._chunks if old[0] == mission_id]:
+                del self._chunks[old]
+            self._chunks[key] = chunk
+            return chunk
+
+    def peek(self, mission_id: int, source: str) -> CompiledChunk | None:
+        """Get a mission's compiled Lua if it is cached, without compiling it."""
+        key = (mission_id, hashlib.sha256(source.encode()).hexdigest())
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self.hits += 1
+            return chunk
+
+    def stats(self) -> dict[str, float]:
+        """Get the cache counters."""
+        return {"chunks": len(self._chunks), "hits": self.hits, "misses": self.misses, "compile_seconds": self.compile_seconds}
+
+    def _compile(self, mission_id: int, source: str) -> bytes:
+        """Compile Lua to bytecode, naming the chunk after its mission for error messages."""
+        function = self._compiler.globals()[b"load"](source.encode(), f"=mission {mission_id}".encode(), b"t")
+        if isinstance(function, tuple):
+            # Lua returns nil and the error instead
+            raise LuaSyntaxError(function[1].decode(errors="replace"))
+        return self._compiler.globals()[b"string"][b"dump"](function)
+
+
+chunk_cache = ChunkCache()
+
+
+async def aget_chunk(mission_id: int, source: str) -> CompiledChunk:
+    """Get a mission's compiled Lua, only leaving the event loop to compile it."""
+    chunk = chunk_cache.peek(mission_id, source)
+    if chunk is None:
+        chunk = await asyncio.get_running_loop().run_in_executor(get_executor(), chunk_cache.get, mission_id, source)
+    return chunk
+
+
+def warm_chunks(missions: Iterable[models.Mission]) -> None:
+    """Compile missions' Lua ahead of calls, logging any that can't be."""
+    for mission in missions:
+        try:
+            chunk_cache.get(mission.id, mission.lua)
+        except LuaError:
+            logger.exception("Failed to compile Lua for mission %s", mission.id)
+    logger.info("Compiled Lua chunks: %s", chunk_cache.stats())
+
+
+def table_from_state(runtime: AsyncLuaRuntime, state: Any) -> Any:  # noqa: ANN401
+    """Convert a mission's stored state to a Lua table, including any lists and objects in it."""
+    if isinstance(state, list):
+        return runtime.list_from([table_from_state(runtime, value) for value in state])
+    if isinstance(state, dict):
+        return runtime.table_from({key: table_from_state(runtime, value) for key, value in state.items()})
+    return state
+
+
+def state_from_table(runtime: AsyncLuaRuntime, table: Any, path: str = "state", depth: int = 0) -> Any:  # noqa: ANN401
+    """Convert a Lua value a mission left in its state to something that can be stored as JSON.
+
+    Tables with only the keys 1 to n become lists, as do empty tables that were lists in the stored state, and any others objects, with
+    their keys as strings. Anything that can't be stored, such as a function or a table that contains itself, raises a LuaError naming
+    where it was.
+    """
+    if depth > MAX_STATE_DEPTH:
+        raise LuaError(f"{path} is nested more than {MAX_STATE_DEPTH} tables deep")
+    if table is None or isinstance(table, (bool, int, str)):
+        return table
+    if isinstance(table, float):
+        if not math.isfinite(table):
+            raise LuaError(f"{path} is {table}, which can't be stored")
+        return table
+    if lupa.lua_type(table) != "table":
+        raise LuaError(f"{path} is a {lupa.lua_type(table) or type(table).__name__}, which can't be stored")
+
+    items = list(table.items())
+    if not items and runtime.is_list(table):
+        return []
+    if items and all(isinstance(key, int) and not isinstance(key, bool) for key, _ in items) and {key for key, _ in items} == set(range(1, len(items) + 1)):
+        return [state_from_table(runtime, value, f"{path}[{key}]", depth + 1) for key, value in sorted(items, key=lambda item: item[0])]
+
+    converted = {}
+    for key, value in items:
+        if isinstance(key, bool) or not isinstance(key, (int, float, str)):
+            raise LuaError(f"{path} has a {lupa.lua_type(key) or type(key).__name__} key, which can't be stored")
+        converted[str(key)] = state_from_table(runtime, value, f"{path}.{key}", depth + 1)
+    return converted
 
 
 class AsyncLuaRuntime(LuaRuntime):
     """Asynchronous helpers for Lua runtime."""
 
-    def __init__(self, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
-        """Prepare the runtime."""
-        self.loop = asyncio.get_event_loop()
+    def __init__(self, *_: Any, **__: Any) -> None:  # noqa: ANN401
+        """Prepare the runtime.
+
+        The runtime itself is set up from the same arguments by lupa before this is called.
+        """
+        self.loop = asyncio.get_running_loop()
+
+        # Functions loaded from compiled chunks, by chunk
+        self._functions: dict[tuple[int, str], Any] = {}
 
+        # Kept for the runtime's own use, as sandboxing removes them from the globals
+        self._load = self.globals().load
+        self._collectgarbage = self.globals().collectgarbage
+        self._scrub: Any = None
+        self._start, self._step, self._stop, self._bridge = LuaRuntime.execute(self, _DRIVER, LuaRuntime.execute(self, _LIMIT))
+        self._mark_list, self._is_list = LuaRuntime.execute(self, _LISTS)
+
+        # How long the running script has spent in earlier steps, and when the current step started
+        self._ran = 0.0
+        self._step_started = 0.0
+
+        # Bridged functions give their result rather than a Python coroutine, so
+        # these are only kept for missions written when they had to be awaited
+        identity = LuaRuntime.eval(self, "function(...) return ... end")
         setattr(self.globals()["python"], "async", asyncio.coroutines)
-        setattr(self.globals()["python"], "await", self.coroutine)
+        setattr(self.globals()["python"], "await", identity)
+        self.globals().python.coroutine = identity
+
+    @classmethod
+    def sandboxed(cls) -> AsyncLuaRuntime:
+        """Create a runtime that missions can only use the standard library and what they are given in."""
+        runtime = cls(
+            unpack_returned_tuples=True,
+            register_eval=False,
+            register_builtins=False,
+            attribute_filter=_attribute_filter,
+            max_memory=settings.LUA_MAX_MEMORY,
+        )
+        runtime._scrub = LuaRuntime.execute(runtime, _SANDBOX, runtime.table_from(SANDBOX_GLOBALS), runtime.table_from(SANDBOX_OS))  # noqa: SLF001
+
+        # lupa only leaves out the standard libraries, so leave out what setting up the runtime used too
+        runtime.set_max_memory(settings.LUA_MAX_MEMORY + runtime.get_memory_used())
+        return runtime
+
+    def memory_used(self) -> int:
+        """Get the bytes the Lua state is using."""
+        return round(self._collectgarbage("count") * 1024)
+
+    def scrub(self) -> None:
+        """Put a sandboxed runtime's globals back to how they were when it was created."""
+        self._scrub()
 
-        super().__init__(*args, **kwargs)
+    def list_from(self, items: list[Any]) -> Any:  # noqa: ANN401
+        """Make a Lua table from a list, marked so that it is still a list if it is emptied."""
+        return self._mark_list(self.table_from(items))
 
-    async def execute(self, lua_code: str, *args: Any) -> Any:  # noqa: ANN401
-        """Execute lua code."""
-        return await self.loop.run_in_executor(None, super().execute, lua_code, *args)
+    def is_list(self, table: Any) -> bool:  # noqa: ANN401
+        """Check if a Lua table was made from a list."""
+        return self._is_list(table)
+
+    def bridge(self, async_func: Callable[..., Any]) -> Any:  # noqa: ANN401
+        """Make a Python async function callable from a script run by this runtime, as if it were an ordinary function."""
+        return self._bridge(async_func)
+
+    async def execute(self, lua_code: str, *args: Any, budget: LuaBudget | None = None) -> Any:  # noqa: ANN401
+        """Execute lua code, see `run_chunk`."""
+        function = await self.loop.run_in_executor(get_executor(), super().compile, lua_code)
+        return await self._run(function, args, budget or LuaBudget.from_settings())
 
     async def compile(self, lua_code: str) -> Any:  # noqa: ANN401
         """Compile Lua code."""
-        return await self.loop.run_in_executor(None, super().compile, lua_code)
+        return await self.loop.run_in_executor(get_executor(), super().compile, lua_code)
 
     async def eval(self, lua_code: str, *args: Any) -> Any:  # noqa: ANN401
         """Evaluate Lua code."""
-        return await self.loop.run_in_executor(None, super().eval, lua_code, *args)
+        return await self.loop.run_in_executor(get_executor(), super().eval, lua_code, *args)
+
+    def load_chunk(self, chunk: CompiledChunk) -> Any:  # noqa: ANN401
+        """Get the function for a compiled chunk in this runtime, loading its bytecode the first time."""
+        function = self._functions.get(chunk.key)
+        if function is None:
+            function = self._load(chunk.bytecode, f"=mission {chunk.mission_id}", "b")
+            if lupa.lua_type(function) != "function":
+                raise LuaError(function[1] if isinstance(function, tuple) else "Failed to load chunk")
+
+            # Older versions of the script won't be run again, and would count against the memory limit
+            for old in [old for old in self._functions if old[0] == chunk.mission_id]:
+                del self._functions[old]
+            self._functions[chunk.key] = function
+        return function
+
+    async def run_chunk(self, chunk: CompiledChunk, *args: Any, budget: LuaBudget | None = None) -> Any:  # noqa: ANN401
+        """Run a compiled chunk, stopping it if it runs over its budget.
+
+        The chunk runs as a coroutine, on the Lua executor. Whenever it calls a bridged function the coroutine yields, and what the
+        function returned is awaited on the event loop before the chunk is resumed, so no thread is held while it waits.
+        """
+        return await self._run(self.load_chunk(chunk), args, budget or LuaBudget.from_settings())
+
+    def _elapsed(self) -> float:
+        """Get how long the running script has spent running Lua, only called by its budget hook during a step."""
+        return self._ran + time.monotonic() - self._step_started
+
+    def _timed_step(self, *resume: Any) -> tuple[Any, ...]:  # noqa: ANN401
+        """Run a step of the script on the executor, timing only the step itself.
+
+        Time spent waiting for an executor thread, or for the event loop between steps, isn't the script's doing so isn't counted.
+        """
+        self._step_started = time.monotonic()
+        try:
+            return self._step(*resume)
+        finally:
+            self._ran += time.monotonic() - self._step_started
+
+    async def _run(self, function: Any, args: tuple[Any, ...], budget: LuaBudget) -> Any:  # noqa: ANN401
+        """Drive a function as a coroutine, awaiting what it yields, with a budget."""
+        executor = get_executor()
+        reason = self._start(function, budget.instructions, budget.seconds, BUDGET_STEP, self._elapsed)
+        self._ran = 0.0
+
+        stepping = False
+        try:
+            resume = args
+            while True:
+                stepping = True
+                done, ok, *values = await self.loop.run_in_executor(executor, self._timed_step, *resume)
+                stepping = False
+                if not ok:
+                    if reason() is not None:
+                        raise LuaBudgetExceededError(f"Script ran over its {reason()}")
+                    # Python exceptions raised in the script come back as they were
+                    if isinstance(values[0], BaseException):
+                        raise values[0]
+                    raise (LuaMemoryError if values[0] == _MEMORY_ERROR else LuaError)(values[0])
+                if done:
+                    return values[0] if len(values) == 1 else tuple(values) or None
+                if len(values) != 1 or not inspect.isawaitable(values[0]):
+                    raise LuaError("Missions can only yield by calling the functions they are given")
+
+                result = await values[0]
+                resume = result if isinstance(result, tuple) else (result,)
+        finally:
+            # If cancelled mid-step the script is still running on the executor, and stopping it would wait for
+            # it on the event loop. It is left to run out its budget instead, and the runtime isn't reused.
+            if not stepping:
+                self._stop()
+
+
+class LuaRuntimePool:
+    """Sandboxed runtimes for checking Lua missions, reused rather than created for each check.
+
+    Runtimes belong to the event loop they were created on, so there is a pool per loop.
+    """
+
+    def __init__(self, size: int) -> None:
+        """Prepare the pool."""
+        self.size = size
+        self.created = 0
+        self.leases = 0
+
+        self._idle: list[AsyncLuaRuntime] = []
+
+    @contextlib.asynccontextmanager
+    async def lease(self) -> AsyncIterator[AsyncLuaRuntime]:
+        """Borrow a runtime, to put a mission's globals in and run it.
+
+        The runtime is scrubbed when it is returned. If anything went wrong it is thrown away instead, as Lua may still be running in it.
+        """
+        if self._idle:
+            runtime = self._idle.pop()
+        else:
+            runtime = AsyncLuaRuntime.sandboxed()
+            self.created += 1
+        self.leases += 1
+
+        yield runtime
+
+        runtime.scrub()
+        if len(self._idle) < self.size:
+            self._idle.append(runtime)
+
+
+_pools: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, LuaRuntimePool] = weakref.WeakKeyDictionary()
+
 
-    def coroutine(self, async_func: Coroutine) -> Any:  # noqa: ANN401
-        """Await a python function from inside Lua."""
-        future = asyncio.run_coroutine_threadsafe(async_func, self.loop)
-        return future.result()
+def get_runtime_pool() -> LuaRuntimePool:
+    """Get the runtime pool for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = LuaRuntimePool(settings.LUA_RUNTIME_POOL_SIZE)
+        _pools[loop] = pool
+    return pool
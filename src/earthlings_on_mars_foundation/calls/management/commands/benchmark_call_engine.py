@@ -0,0 +1,132 @@
+"""Benchmark the call engine with many simulated concurrent calls."""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import tracemalloc
+from typing import Any
+
+from calls.benchmarks import percentile
+from calls.consumers import CallConsumer
+from django.core.management.base import BaseCommand, CommandParser
+
+
+class SimulatedCallConsumer(CallConsumer):
+    """Call consumer with the game logic replaced by a fixed script of prompts."""
+
+    def __init__(self, prompts: int, prompt_time: float) -> None:
+        """Prepare the simulated call."""
+        super().__init__()
+        self.loop = asyncio.get_running_loop()
+        self.prompts = prompts
+        self.prompt_time = prompt_time
+        self.started: float | None = None
+        self.first_prompt: float | None = None
+        self.finished = asyncio.Event()
+
+    async def send_json(self, content: dict[str, Any], close: bool = False) -> None:  # noqa: ARG002, FBT001, FBT002
+        """Receive a prompt on the consumer's loop, as the websocket would."""
+        if asyncio.get_running_loop() is not self.loop:
+            future = asyncio.run_coroutine_threadsafe(self._record(content), self.loop)
+            await asyncio.wrap_future(future)
+        else:
+            await self._record(content)
+
+    async def _record(self, content: dict[str, Any]) -> None:
+        """Record timings for a sent message."""
+        if self.first_prompt is None:
+            self.first_prompt = time.perf_counter()
+        if content.get("type") == "hangup":
+            self.finished.set()
+
+    async def _say(self, text: str, npc: None = None) -> None:  # noqa: ARG002
+        """Pretend to play a prompt."""
+        await self.send_json({"type": "say", "text": text})
+        await asyncio.sleep(self.prompt_time)
+
+    async def _hangup(self) -> None:
+        """Pretend to hang up."""
+        await self.send_json({"type": "hangup"})
+
+    async def _new_call(self) -> None:
+        """Play the scripted prompts, then hang up."""
+        for prompt in range(self.prompts):
+            await self._say(f"Prompt {prompt}")
+        await self._hangup()
+
+
+class ThreadedCallConsumer(SimulatedCallConsumer):
+    """Simulated call using the previous thread and event loop per call."""
+
+    async def _session_new(self) -> None:
+        """Start processing a new call on its own thread."""
+        thread = threading.Thread(target=asyncio.run, args=(self._new_call(),))
+        thread.start()
+
+
+ENGINES = {
+    "task": SimulatedCallConsumer,
+    "thread": ThreadedCallConsumer,
+}
+
+
+class Command(BaseCommand):
+    """Benchmark the call engine."""
+
+    help = "Measure memory and setup latency per concurrent call for each call engine"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--calls", type=int, nargs="+", default=[10, 100, 1000], help="Numbers of concurrent calls to simulate")
+        parser.add_argument("--engine", choices=[*ENGINES, "all"], default="all", help="Call engine to benchmark")
+        parser.add_argument("--prompts", type=int, default=3, help="Prompts played by each call")
+        parser.add_argument("--prompt-time", type=float, default=0.05, help="Seconds each prompt takes to play")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the benchmark."""
+        engines = list(ENGINES) if options["engine"] == "all" else [options["engine"]]
+
+        self.stdout.write(f"{'engine':<8} {'calls':>6} {'threads':>8} {'KiB/call':>10} {'setup p50 ms':>13} {'setup p95 ms':>13} {'total s':>9}")
+        for calls in options["calls"]:
+            for engine in engines:
+                result = asyncio.run(self._run(ENGINES[engine], calls, options["prompts"], options["prompt_time"]))
+                self.stdout.write(
+                    f"{engine:<8} {calls:>6} {result['threads']:>8} {result['memory'] / calls / 1024:>10.1f} "
+                    f"{result['p50'] * 1000:>13.2f} {result['p95'] * 1000:>13.2f} {result['total']:>9.2f}",
+                )
+
+    async def _run(self, engine: type[SimulatedCallConsumer], calls: int, prompts: int, prompt_time: float) -> dict[str, float]:
+        """Run a number of concurrent calls with a single engine."""
+        consumers = [engine(prompts, prompt_time) for _ in range(calls)]
+        threads = set(threading.enumerate())
+
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+
+        for consumer in consumers:
+            consumer.call_connected = True
+            consumer.started = time.perf_counter()
+            await consumer._session_new()  # noqa: SLF001
+
+        peak_threads = threading.active_count()
+        await asyncio.gather(*(consumer.finished.wait() for consumer in consumers))
+        total = time.perf_counter() - start
+
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Let any remaining call threads exit before the next run
+        for thread in set(threading.enumerate()) - threads:
+            await asyncio.to_thread(thread.join)
+
+        setup = [consumer.first_prompt - consumer.started for consumer in consumers]
+        return {
+            "threads": peak_threads - len(threads),
+            "memory": peak - baseline,
+            "p50": percentile(setup, 50),
+            "p95": percentile(setup, 95),
+            "total": total,
+        }
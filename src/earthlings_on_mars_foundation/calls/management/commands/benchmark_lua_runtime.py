@@ -0,0 +1,93 @@
+"""Benchmark running Lua missions."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+import tracemalloc
+from typing import Any
+
+from calls.benchmarks import summarise
+from calls.lua import AsyncLuaRuntime, ChunkCache, LuaRuntimePool
+from django.core.management.base import BaseCommand, CommandParser
+
+# Like the example mission, keeping count of calls and saying something each time
+MISSION = """
+if state.calls == nil then
+    state.calls = 0
+end
+
+state.calls = state.calls + 1
+
+say("Great, you've called " .. state.calls .. " times now!")
+"""
+
+
+async def say(text: str, seconds: float) -> None:
+    """Stand in for saying something on a call."""
+    if seconds:
+        await asyncio.sleep(seconds)
+
+
+class Command(BaseCommand):
+    """Benchmark Lua mission runtimes."""
+
+    help = "Compare checking a Lua mission with pooled runtimes and compiled chunks against a new runtime and script each time"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--checks", type=int, default=2000, help="Mission checks to run each way")
+        parser.add_argument("--concurrency", type=int, default=8, help="Checks running at once")
+        parser.add_argument("--say-ms", type=float, default=0, help="Milliseconds saying something takes")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the benchmark."""
+        self.stdout.write(f"{'runtime':<10} {'checks/s':>9} {'runtimes':>9} {'Lua KiB':>9} {'Python KiB':>11}   latency")
+        for name, check in (("new", self._check_new), ("pooled", self._check_pooled)):
+            asyncio.run(self._run(name, check, options["checks"], options["concurrency"], options["say_ms"] / 1000))
+
+    async def _run(self, name: str, check: Any, checks: int, concurrency: int, say_seconds: float) -> None:  # noqa: ANN401
+        """Run mission checks, a number at a time, and report how they went."""
+        self.pool = LuaRuntimePool(concurrency)
+        self.chunk = ChunkCache().get(1, MISSION)
+        self.runtimes = 0
+        self.lua_kib = 0.0
+        self.say = functools.partial(say, seconds=say_seconds)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def timed(calls: int) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                await check(calls)
+                latencies.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(i) for i in range(checks)))
+        elapsed = time.perf_counter() - start
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        runtimes = self.runtimes or self.pool.created
+        self.stdout.write(f"{name:<10} {checks / elapsed:>9.0f} {runtimes:>9} {self.lua_kib:>9.0f} {python_peak / 1024:>11.0f}   {summarise(latencies)}")
+
+    async def _check_new(self, calls: int) -> None:
+        """Check the mission as it was, in a new runtime from source."""
+        lua = AsyncLuaRuntime(unpack_returned_tuples=True)
+        self.runtimes += 1
+        lua.globals().state = lua.table_from({"calls": calls})
+        lua.globals().say = lua.bridge(self.say)
+        await lua.execute(MISSION)
+        self.lua_kib += lua.memory_used() / 1024
+
+    async def _check_pooled(self, calls: int) -> None:
+        """Check the mission in a pooled runtime, from its compiled chunk."""
+        async with self.pool.lease() as lua:
+            if self.pool.leases <= self.pool.size:
+                self.lua_kib += lua.memory_used() / 1024
+            lua.globals().state = lua.table_from({"calls": calls})
+            lua.globals().say = lua.bridge(self.say)
+            await lua.run_chunk(self.chunk)
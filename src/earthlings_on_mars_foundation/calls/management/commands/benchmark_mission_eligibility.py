@@ -0,0 +1,124 @@
+"""Benchmark finding a new mission for a recruit."""
+
+from __future__ import annotations
+
+import datetime
+import random
+import time
+from typing import Any
+
+from calls import models
+from calls.benchmarks import benchmark_database, summarise
+from calls.eligibility import MissionGraph, RecruitProgress, query_next_mission
+from django.core.management.base import BaseCommand, CommandParser
+
+
+def graph_next_mission(graph: MissionGraph, recruit_id: int, npc_id: int, location_id: int | None) -> models.Mission | None:
+    """Find a new mission with the in-memory mission graph."""
+    node = graph.next_mission(npc_id, location_id, RecruitProgress.load(recruit_id))
+    return None if node is None else models.Mission.objects.get(pk=node.id)
+
+
+class Command(BaseCommand):
+    """Benchmark mission eligibility."""
+
+    help = "Compare the in-memory mission eligibility engine with the SQL query it replaced, on a generated game"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--missions", type=int, default=1000, help="Missions to generate")
+        parser.add_argument("--recruits", type=int, default=50000, help="Recruits to generate")
+        parser.add_argument("--npcs", type=int, default=10, help="NPCs to generate")
+        parser.add_argument("--locations", type=int, default=15, help="Locations to generate")
+        parser.add_argument("--missions-per-recruit", type=int, default=8, help="Average missions started by each recruit")
+        parser.add_argument("--samples", type=int, default=200, help="Mission lookups to time")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the benchmark."""
+        rng = random.Random(options["seed"])  # noqa: S311
+
+        with benchmark_database():
+            self.stdout.write("Generating game data...")
+            self._generate(rng, options)
+
+            start = time.perf_counter()
+            graph = MissionGraph.load()
+            self.stdout.write(f"Loaded mission graph in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+            recruit_ids = list(models.Recruit.objects.values_list("id", flat=True))
+            npc_ids = list(models.NPC.objects.values_list("id", flat=True))
+            location_ids = [*models.Location.objects.values_list("id", flat=True), None]
+            lookups = [(rng.choice(recruit_ids), rng.choice(npc_ids), rng.choice(location_ids)) for _ in range(options["samples"])]
+
+            query_times = []
+            graph_times = []
+            mismatches = 0
+            for recruit_id, npc_id, location_id in lookups:
+                start = time.perf_counter()
+                expected = query_next_mission(recruit_id, npc_id, location_id)
+                query_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                actual = graph_next_mission(graph, recruit_id, npc_id, location_id)
+                graph_times.append(time.perf_counter() - start)
+
+                # Ties between equally preferred missions may be broken differently
+                if (expected is None) != (actual is None) or (expected is not None and graph.missions[expected.id].rank[:2] != graph.missions[actual.id].rank[:2]):
+                    mismatches += 1
+
+            self.stdout.write(f"SQL query     {summarise(query_times)}")
+            self.stdout.write(f"Mission graph {summarise(graph_times)}")
+            self.stdout.write(f"Lookups where the SQL query picked a differently ranked mission: {mismatches} of {len(lookups)}")
+
+    def _generate(self, rng: random.Random, options: dict[str, Any]) -> None:
+        """Generate a game with random missions and recruit progress."""
+        npcs = models.NPC.objects.bulk_create(models.NPC(name=f"NPC {i}", extension=1000 + i, introduction="Hello") for i in range(options["npcs"]))
+        locations = models.Location.objects.bulk_create(models.Location(name=f"Location {i}", extension=2000 + i) for i in range(options["locations"]))
+
+        missions = models.Mission.objects.bulk_create(
+            models.Mission(
+                name=f"Mission {i}",
+                give_text=f"Mission {i}",
+                reminder_text="Reminder",
+                completion_text="Done",
+                issued_by=rng.choice(npcs),
+                type=models.MissionTypes.LOCATION,
+                call_back_from=rng.choice(locations),
+                points=10,
+                priority=rng.randint(1, 10),
+                only_start_from=rng.choice(locations) if rng.random() < 0.2 else None,  # noqa: PLR2004
+                repeatable=rng.random() < 0.1,  # noqa: PLR2004
+            )
+            for i in range(options["missions"])
+        )
+
+        followups = []
+        prerequisites = []
+        for i, mission in enumerate(missions[1:], start=1):
+            earlier = missions[:i]
+            if i + 1 < len(missions) and rng.random() < 0.1:  # noqa: PLR2004
+                mission.followup_mission = rng.choice(missions[i + 1 :])
+                followups.append(mission)
+            picked = rng.sample(earlier, min(len(earlier), rng.randint(0, 3)))
+            prerequisites.extend(models.MissionPrerequisite(mission=mission, prerequisite=prerequisite) for prerequisite in picked)
+        models.Mission.objects.bulk_update(followups, ["followup_mission"])
+        models.MissionPrerequisite.objects.bulk_create(prerequisites)
+
+        recruits = models.Recruit.objects.bulk_create(models.Recruit() for _ in range(options["recruits"]))
+
+        now = datetime.datetime.now(tz=datetime.UTC)
+        recruit_missions = []
+        for recruit in recruits:
+            for mission in rng.sample(missions, rng.randint(0, options["missions_per_recruit"] * 2)):
+                finished = rng.random() < 0.8  # noqa: PLR2004
+                recruit_missions.append(
+                    models.RecruitMission(
+                        recruit=recruit,
+                        mission=mission,
+                        finished=now if finished else None,
+                        completed=finished and rng.random() < 0.9,  # noqa: PLR2004
+                    ),
+                )
+        models.RecruitMission.objects.bulk_create(recruit_missions, batch_size=5000)
+        self.stdout.write(f"Generated {len(missions)} missions, {len(recruits)} recruits and {len(recruit_missions)} recruit missions")
@@ -0,0 +1,108 @@
+"""Benchmark serving speech recordings."""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import tempfile
+import time
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from calls import audio, models, speech, views
+from calls.benchmarks import benchmark_database, summarise
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandParser
+from django.http import FileResponse, HttpRequest, HttpResponse, HttpResponseNotFound
+from django.test import AsyncRequestFactory, override_settings
+
+
+def legacy_speech(request: HttpRequest, recording_id: int) -> HttpResponse:  # noqa: ARG001
+    """Serve speech with the previous sync view."""
+    try:
+        recording = models.Speech.objects.get(id=recording_id)
+        return FileResponse(recording.recording)
+    except models.Recruit.DoesNotExist:
+        return HttpResponseNotFound()
+
+
+async def fetch(response: HttpResponse) -> int:
+    """Read a whole response, as the server would, and get its length."""
+    if not response.streaming:
+        return len(response.content)
+    return sum(len(chunk) for chunk in await sync_to_async(list)(response.streaming_content))
+
+
+class Command(BaseCommand):
+    """Benchmark the speech view."""
+
+    help = "Compare the throughput of the speech media view with the sync view it replaced"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--recordings", type=int, default=200, help="Recordings to generate")
+        parser.add_argument("--seconds", type=float, default=3.0, help="Length of each recording")
+        parser.add_argument("--requests", type=int, default=2000, help="Requests to make to each view")
+        parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at once")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the benchmark."""
+        rng = random.Random(options["seed"])  # noqa: S311
+
+        with benchmark_database(), tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, SPEECH_SENDFILE_HEADER=""):
+            pcm = bytes(rng.getrandbits(8) for _ in range(round(options["seconds"] * audio.SAMPLE_RATE * 2)))
+            ids = []
+            legacy_ids = {}
+            for i in range(options["recordings"]):
+                # Each recording differs, so they aren't all packed as one
+                data = pcm[:-2] + i.to_bytes(2, "little")
+                entry, _ = speech.get_or_create(None, f"Recording {i}")
+                ids.append(speech.store_recording(entry, data, is_tts=True).id)
+
+                # And is stored in its own file, as the previous view served
+                loose = models.Speech.objects.create(text=f"Loose recording {i}")
+                loose.recording.save(f"speech-{loose.id}", ContentFile(data))
+                legacy_ids[entry.id] = loose.id
+            self.stdout.write(f"Generated {len(ids)} recordings of {len(pcm)} bytes")
+
+            lookups = [rng.choice(ids) for _ in range(options["requests"])]
+            factory = AsyncRequestFactory()
+
+            async def legacy(recording_id: int) -> int:
+                request = factory.get(f"/speech/{recording_id}.alaw")
+                return await fetch(await sync_to_async(legacy_speech)(request, legacy_ids[recording_id]))
+
+            async def current(recording_id: int) -> int:
+                request = factory.get(f"/speech/{recording_id}.alaw")
+                return await fetch(await views.speech(request, str(recording_id), audio.MASTER_ENCODING))
+
+            etags = {}
+            for recording_id in ids:
+                etags[recording_id] = asyncio.run(views.speech(factory.get("/"), str(recording_id), audio.MASTER_ENCODING))["ETag"]
+
+            async def revalidate(recording_id: int) -> int:
+                request = factory.get(f"/speech/{recording_id}.alaw", headers={"If-None-Match": etags[recording_id]})
+                return await fetch(await views.speech(request, str(recording_id), audio.MASTER_ENCODING))
+
+            self.stdout.write(f"{'view':<22} {'req/s':>9} {'MiB/s':>8}   latency")
+            for name, view in (("legacy", legacy), ("media", current), ("media, revalidated", revalidate)):
+                rate, throughput, latencies = asyncio.run(self._run(view, lookups, options["concurrency"]))
+                self.stdout.write(f"{name:<22} {rate:>9.0f} {throughput / 1024 / 1024:>8.1f}   {summarise(latencies)}")
+
+    async def _run(self, view: Any, lookups: list[int], concurrency: int) -> tuple[float, float, list[float]]:  # noqa: ANN401
+        """Make requests to a view, a number at a time."""
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def request(recording_id: int) -> int:
+            async with semaphore:
+                start = time.perf_counter()
+                size = await view(recording_id)
+                latencies.append(time.perf_counter() - start)
+                return size
+
+        start = time.perf_counter()
+        sizes = await asyncio.gather(*(request(recording_id) for recording_id in lookups))
+        elapsed = time.perf_counter() - start
+        return len(lookups) / elapsed, sum(sizes) / elapsed, latencies
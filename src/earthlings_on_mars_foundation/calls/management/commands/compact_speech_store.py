@@ -0,0 +1,43 @@
+"""Pack loose speech recordings and reclaim space from audio that is no longer used."""
+
+from __future__ import annotations
+
+from typing import Any
+
+from calls import models, packstore, speech
+from django.core.management.base import BaseCommand, CommandParser
+
+
+class Command(BaseCommand):
+    """Compact the speech audio store."""
+
+    help = "Move speech recordings kept in their own files into packs, forget audio nothing uses and rewrite packs that are mostly unused"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--threshold", type=float, default=0.25, help="Fraction of a pack that must be unused for it to be rewritten")
+        parser.add_argument("--keep-files", action="store_true", help="Keep recording files after packing them")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the command."""
+        packed = 0
+        for model in (models.Speech, models.SpeechRendition):
+            for source in model.objects.filter(blob=None).exclude(recording=""):
+                name = source.recording.name
+                try:
+                    source.blob = packstore.put(speech.read_recording(source))
+                except FileNotFoundError:
+                    self.stderr.write(f"Missing recording {name} for {model.__name__} {source.pk}")
+                    continue
+                source.recording = ""
+                source.save(update_fields=["blob", "recording"])
+                if not options["keep_files"]:
+                    speech.recording_storage().delete(name)
+                packed += 1
+        self.stdout.write(f"Packed {packed} recordings")
+
+        report = packstore.compact(options["threshold"])
+        self.stdout.write(
+            f"Removed {report.blobs_removed} unused recordings, rewrote {report.packs_rewritten} packs and removed {report.packs_removed}, "
+            f"reclaiming {report.bytes_reclaimed / 1024 / 1024:.1f} MiB",
+        )
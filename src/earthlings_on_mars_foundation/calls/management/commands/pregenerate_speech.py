@@ -0,0 +1,55 @@
+"""Generate speech for all known game text."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any
+
+from calls.benchmarks import summarise
+from calls.pregenerate import DEFAULT_CONCURRENCY, PregenerationReport, Utterance, apregenerate, game_utterances
+from calls.tts import Tts
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+
+class Command(BaseCommand):
+    """Generate speech ahead of calls."""
+
+    help = "Generate TTS recordings for every NPC introduction, mission text and fixed prompt that doesn't have one yet"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        """Define command line arguments."""
+        parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Utterances to synthesise at once")
+        parser.add_argument("--dry-run", action="store_true", help="Only list what would be generated")
+
+    def handle(self, *_: Any, **options: Any) -> None:  # noqa: ANN401
+        """Run the command."""
+        utterances = game_utterances()
+        self.stdout.write(f"Found {len(utterances)} utterances")
+
+        if options["dry_run"]:
+            for utterance in utterances:
+                self.stdout.write(f"NPC {utterance.npc_id}: {utterance.text}")
+            return
+
+        try:
+            tts = Tts.from_settings()
+        except Exception as e:
+            raise CommandError(str(e)) from e
+
+        start = time.perf_counter()
+        report = asyncio.run(apregenerate(tts, utterances, options["concurrency"], self._progress))
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"Generated {report.generated}, already had {report.existing}, failed {report.failed}, in {elapsed:.1f} s",
+        )
+        if report.durations:
+            self.stdout.write(f"Synthesis time {summarise(report.durations)}")
+        if report.failed:
+            raise CommandError(f"{report.failed} utterances failed, run again to retry them")
+
+    def _progress(self, report: PregenerationReport, utterance: Utterance, outcome: str) -> None:
+        """Report each utterance as it is dealt with."""
+        if outcome != "existing":
+            self.stdout.write(f"[{report.done}/{report.total}] {outcome} NPC {utterance.npc_id}: {utterance.text}")
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-17 12:00
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_speech_text(apps, schema_editor):
+    """Fill in the text hash of existing speech."""
+    Speech = apps.get_model("calls", "Speech")
+
+    speeches = list(Speech.objects.only("id", "text"))
+    for speech in speeches:
+        speech.text_hash = hashlib.sha256(" ".join(speech.text.split()).encode()).hexdigest()
+    Speech.objects.bulk_update(speeches, ["text_hash"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0015_remove_recruit_score_recruitnpc_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='speech',
+            name='text_hash',
+            field=models.CharField(default='', editable=False, help_text='SHA-256 of the normalised text, for looking up speech', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_speech_text, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='speech',
+            index=models.Index(fields=['NPC', 'text_hash'], name='calls_speec_NPC_id_10555d_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2 on 2026-10-17 12:00
+
+import struct
+
+import django.db.models.deletion
+from django.core.files.base import ContentFile
+from django.db import migrations, models
+
+# 16-bit sample for every G.711 A-law code, kept here so the migration doesn't change with calls.audio
+ALAW_DECODE = (
+    -5504, -5248, -6016, -5760, -4480, -4224, -4992, -4736, -7552, -7296, -8064, -7808, -6528, -6272, -7040, -6784,
+    -2752, -2624, -3008, -2880, -2240, -2112, -2496, -2368, -3776, -3648, -4032, -3904, -3264, -3136, -3520, -3392,
+    -22016, -20992, -24064, -23040, -17920, -16896, -19968, -18944, -30208, -29184, -32256, -31232, -26112, -25088, -28160, -27136,
+    -11008, -10496, -12032, -11520, -8960, -8448, -9984, -9472, -15104, -14592, -16128, -15616, -13056, -12544, -14080, -13568,
+    -344, -328, -376, -360, -280, -264, -312, -296, -472, -456, -504, -488, -408, -392, -440, -424,
+    -88, -72, -120, -104, -24, -8, -56, -40, -216, -200, -248, -232, -152, -136, -184, -168,
+    -1376, -1312, -1504, -1440, -1120, -1056, -1248, -1184, -1888, -1824, -2016, -1952, -1632, -1568, -1760, -1696,
+    -688, -656, -752, -720, -560, -528, -624, -592, -944, -912, -1008, -976, -816, -784, -880, -848,
+    5504, 5248, 6016, 5760, 4480, 4224, 4992, 4736, 7552, 7296, 8064, 7808, 6528, 6272, 7040, 6784,
+    2752, 2624, 3008, 2880, 2240, 2112, 2496, 2368, 3776, 3648, 4032, 3904, 3264, 3136, 3520, 3392,
+    22016, 20992, 24064, 23040, 17920, 16896, 19968, 18944, 30208, 29184, 32256, 31232, 26112, 25088, 28160, 27136,
+    11008, 10496, 12032, 11520, 8960, 8448, 9984, 9472, 15104, 14592, 16128, 15616, 13056, 12544, 14080, 13568,
+    344, 328, 376, 360, 280, 264, 312, 296, 472, 456, 504, 488, 408, 392, 440, 424,
+    88, 72, 120, 104, 24, 8, 56, 40, 216, 200, 248, 232, 152, 136, 184, 168,
+    1376, 1312, 1504, 1440, 1120, 1056, 1248, 1184, 1888, 1824, 2016, 1952, 1632, 1568, 1760, 1696,
+    688, 656, 752, 720, 560, 528, 624, 592, 944, 912, 1008, 976, 816, 784, 880, 848,
+)
+
+
+def alaw_to_pcm(alaw):
+    """Decode A-law to signed 16-bit little-endian PCM."""
+    return struct.pack(f"<{len(alaw)}h", *(ALAW_DECODE[code] for code in alaw))
+
+
+def convert_to_pcm(apps, schema_editor):
+    """Keep existing A-law recordings as a rendition, and decode them into the master recording."""
+    Speech = apps.get_model("calls", "Speech")
+    SpeechRendition = apps.get_model("calls", "SpeechRendition")
+
+    for speech in Speech.objects.exclude(recording=""):
+        try:
+            with speech.recording.open("rb") as f:
+                alaw = f.read()
+        except FileNotFoundError:
+            continue
+
+        SpeechRendition.objects.create(speech=speech, encoding="alaw", recording=speech.recording.name)
+        speech.recording.save(f"speech-{speech.id}.sln", ContentFile(alaw_to_pcm(alaw)), save=False)
+        speech.save(update_fields=["recording"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0016_speech_text_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='speech',
+            name='recording',
+            field=models.FileField(help_text='Master recording, as 8kHz signed 16-bit little-endian PCM', upload_to=''),
+        ),
+        migrations.CreateModel(
+            name='SpeechRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encoding', models.CharField(help_text='Name of the encoding, which is also the file extension it is served with', max_length=8)),
+                ('recording', models.FileField(upload_to='')),
+                ('speech', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='calls.speech')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('speech', 'encoding'), name='speech_rendition')],
+            },
+        ),
+        migrations.RunPython(convert_to_pcm, migrations.RunPython.noop),
+    ]
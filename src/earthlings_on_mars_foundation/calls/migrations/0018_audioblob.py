@@ -0,0 +1,48 @@
+# Generated by Django 5.2 on 2026-10-17 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0017_speechrendition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('pack', models.CharField(help_text='Name of the pack file the audio is in', max_length=64)),
+                ('offset', models.PositiveBigIntegerField(help_text='Where the audio starts in the pack, in bytes')),
+                ('size', models.PositiveIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='speech',
+            name='recording',
+            field=models.FileField(blank=True, help_text="Master recording, as 8kHz signed 16-bit little-endian PCM, if it isn't packed", upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='speechrendition',
+            name='recording',
+            field=models.FileField(blank=True, help_text="Recording, if it isn't packed", upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='speech',
+            name='blob',
+            field=models.ForeignKey(
+                blank=True, help_text='Packed master recording', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='speech', to='calls.audioblob',
+            ),
+        ),
+        migrations.AddField(
+            model_name='speechrendition',
+            name='blob',
+            field=models.ForeignKey(
+                blank=True, help_text='Packed recording', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='renditions', to='calls.audioblob',
+            ),
+        ),
+    ]
@@ -2,8 +2,9 @@
 
 from __future__ import annotations
 
+import hashlib
 from enum import IntEnum
-from typing import ClassVar
+from typing import Any, ClassVar
 
 from django.db import models
 
@@ -307,10 +308,75 @@ class CallLog(models.Model):
         return self.call_id
 
 
+class AudioBlob(models.Model):
+    """Audio stored once by its content, in a pack file."""
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    pack = models.CharField(max_length=64, help_text="Name of the pack file the audio is in")
+    offset = models.PositiveBigIntegerField(help_text="Where the audio starts in the pack, in bytes")
+    size = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        """Get the hash."""
+        return self.sha256
+
+
 class Speech(models.Model):
     """Pre-recorded speech."""
 
     NPC = models.ForeignKey(NPC, on_delete=models.CASCADE, null=True, blank=True)
     text = models.TextField()
-    recording = models.FileField()
+    text_hash = models.CharField(max_length=64, editable=False, help_text="SHA-256 of the normalised text, for looking up speech")
+    recording = models.FileField(blank=True, help_text="Master recording, as 8kHz signed 16-bit little-endian PCM, if it isn't packed")
+    blob = models.ForeignKey(AudioBlob, on_delete=models.PROTECT, null=True, blank=True, related_name="speech", help_text="Packed master recording")
     tts = models.BooleanField(default=True)
+
+    class Meta:
+        """Database table metadata."""
+
+        indexes: ClassVar[list[models.Index]] = [
+            models.Index(fields=["NPC", "text_hash"]),
+        ]
+
+    def __str__(self) -> str:
+        """Get the text."""
+        return self.text
+
+    @staticmethod
+    def normalise_text(text: str) -> str:
+        """Normalise text, so the same words are always spoken by the same recording."""
+        return " ".join(text.split())
+
+    @classmethod
+    def hash_text(cls, text: str) -> str:
+        """Get the hash speech is looked up by."""
+        return hashlib.sha256(cls.normalise_text(text).encode()).hexdigest()
+
+    def save(self, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+        """Keep the text hash up to date."""
+        self.text_hash = self.hash_text(self.text)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "text" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "text_hash"}
+        super().save(*args, **kwargs)
+
+
+class SpeechRendition(models.Model):
+    """Speech recording transcoded into another encoding."""
+
+    speech = models.ForeignKey(Speech, on_delete=models.CASCADE, related_name="renditions")
+    encoding = models.CharField(max_length=8, help_text="Name of the encoding, which is also the file extension it is served with")
+    recording = models.FileField(blank=True, help_text="Recording, if it isn't packed")
+    blob = models.ForeignKey(AudioBlob, on_delete=models.PROTECT, null=True, blank=True, related_name="renditions", help_text="Packed recording")
+
+    class Meta:
+        """Database table metadata."""
+
+        constraints: ClassVar[list[models.UniqueConstraint]] = [
+            models.UniqueConstraint(fields=["speech", "encoding"], name="speech_rendition"),
+        ]
+
+    def __str__(self) -> str:
+        """Get the speech and encoding."""
+        return f"{self.speech_id}.{self.encoding}"
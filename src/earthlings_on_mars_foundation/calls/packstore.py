@@ -0,0 +1,172 @@
+"""Content-addressed store for speech audio, in append-only pack files."""
+
+from __future__ import annotations
+
+import datetime
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from calls import models
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger("eomf.calls.packstore")
+
+PACK_SUFFIX = ".pack"
+
+# Blobs and packs newer than this are left alone by compaction, as they may
+# be in the middle of being stored
+COMPACTION_GRACE = datetime.timedelta(hours=1)
+
+# Read-only maps of packs and the inode they map, by path. Packs are only
+# ever appended to, and compaction writes new packs rather than changing
+# them, so a map stays valid for whatever it covers even after its pack has
+# been removed. A pack created again under the same name is a different
+# file, so is mapped again.
+_maps: dict[Path, tuple[int, mmap.mmap]] = {}
+_maps_lock = threading.Lock()
+
+
+def pack_dir() -> Path:
+    """Get the directory packs are kept in."""
+    return Path(settings.SPEECH_PACK_DIR or Path(settings.MEDIA_ROOT) / "packs")
+
+
+def put(data: bytes) -> models.AudioBlob:
+    """Store audio, unless identical audio already is, and get its blob."""
+    sha256 = hashlib.sha256(data).hexdigest()
+    blob = models.AudioBlob.objects.filter(pk=sha256).first()
+    if blob is not None:
+        return blob
+
+    pack, offset = _append(data)
+    # Anyone storing the same audio at once wins, and what was appended here is reclaimed by compaction
+    blob, _ = models.AudioBlob.objects.get_or_create(sha256=sha256, defaults={"pack": pack, "offset": offset, "size": len(data)})
+    return blob
+
+
+def pack_map(pack: str, end: int) -> mmap.mmap:
+    """Get a map of a pack that covers at least up to `end`, mapping it again if it has grown."""
+    path = pack_dir() / pack
+    try:
+        inode = path.stat().st_ino
+    except FileNotFoundError:
+        # Compacted away, but an earlier map still has what was in it
+        inode = None
+
+    with _maps_lock:
+        cached = _maps.get(path)
+        if cached is not None and inode in (None, cached[0]) and len(cached[1]) >= end:
+            return cached[1]
+
+        with path.open("rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[path] = (os.fstat(f.fileno()).st_ino, mapped)
+
+        # Stop holding on to compacted packs, so their space is freed once nothing is reading them
+        for old in [old for old in _maps if not old.exists()]:
+            del _maps[old]
+        return mapped
+
+
+def read(blob: models.AudioBlob) -> bytes:
+    """Read a blob's audio."""
+    return pack_map(blob.pack, blob.offset + blob.size)[blob.offset : blob.offset + blob.size]
+
+
+def _append(data: bytes) -> tuple[str, int]:
+    """Append audio to the current pack, and get where it was written."""
+    directory = pack_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        name = _current_pack(directory)
+        with (directory / name).open("ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_nlink == 0:
+                # Compacted away since it was chosen
+                continue
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return name, offset
+
+
+def _current_pack(directory: Path) -> str:
+    """Get the name of the pack to append to, starting a new one if the newest is full."""
+    packs = sorted(directory.glob(f"*{PACK_SUFFIX}"))
+    if packs and packs[-1].stat().st_size < settings.SPEECH_PACK_SIZE:
+        return packs[-1].name
+    return _new_pack_name()
+
+
+def _new_pack_name() -> str:
+    """Name a new pack, so that newer packs sort after older ones."""
+    return f"{time.time_ns():016x}{PACK_SUFFIX}"
+
+
+@dataclass
+class CompactionReport:
+    """What compaction did."""
+
+    blobs_removed: int = 0
+    packs_rewritten: int = 0
+    packs_removed: int = 0
+    bytes_reclaimed: int = 0
+
+
+def compact(threshold: float) -> CompactionReport:
+    """Forget audio nothing refers to, and rewrite packs where at least `threshold` of the space is no longer used."""
+    report = CompactionReport()
+    cutoff = timezone.now() - COMPACTION_GRACE
+
+    report.blobs_removed, _ = models.AudioBlob.objects.filter(speech=None, renditions=None, created__lt=cutoff).delete()
+
+    for path in sorted(pack_dir().glob(f"*{PACK_SUFFIX}")):
+        size = path.stat().st_size
+        if datetime.datetime.fromtimestamp(path.stat().st_mtime, tz=datetime.UTC) >= cutoff:
+            continue
+
+        blobs = list(models.AudioBlob.objects.filter(pack=path.name).order_by("offset"))
+        unused = size - sum(blob.size for blob in blobs)
+        if blobs and unused < size * threshold:
+            continue
+
+        with path.open("ab") as f:
+            # Wait for anyone appending to finish, anyone after sees the pack is gone and moves on
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if blobs:
+                _rewrite(path, blobs)
+                report.packs_rewritten += 1
+            else:
+                report.packs_removed += 1
+            path.unlink()
+        report.bytes_reclaimed += unused
+        logger.info("Compacted %s, reclaiming %s bytes", path.name, unused)
+
+    return report
+
+
+def _rewrite(path: Path, blobs: list[models.AudioBlob]) -> None:
+    """Copy blobs from a pack into a new one."""
+    source = pack_map(path.name, path.stat().st_size)
+    target = _new_pack_name()
+
+    with (pack_dir() / target).open("ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        for blob in blobs:
+            data = source[blob.offset : blob.offset + blob.size]
+            blob.pack, blob.offset = target, f.seek(0, os.SEEK_END)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    models.AudioBlob.objects.bulk_update(blobs, ["pack", "offset"], batch_size=1000)
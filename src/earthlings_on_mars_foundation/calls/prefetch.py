@@ -0,0 +1,99 @@
+"""Getting the speech for a call's likely prompts ready before they are said."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from asgiref.sync import sync_to_async
+from calls import audio, eligibility, models, speech
+from calls.tts import get_tts
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from calls.context import RecruitContext
+
+logger = logging.getLogger("eomf.calls.prefetch")
+
+
+def recruit_prompts(npc_id: int, context: RecruitContext) -> list[str]:
+    """List what an NPC may say about a recruit's open missions, in roughly the order it would be said."""
+    texts = []
+    for recruit_mission in context.open_missions():
+        mission = recruit_mission.mission
+        followup = [] if mission.followup_mission is None else [mission.followup_mission.give_text]
+
+        if mission.issued_by_id == npc_id:
+            texts.extend([mission.reminder_text, mission.completion_text, mission.incorrect_text, mission.cancel_text, *followup])
+        elif mission.type == models.MissionTypes.NPC and mission.call_another_id == npc_id:
+            texts.extend([mission.completion_text, *followup])
+    return texts
+
+
+class PromptPrefetcher:
+    """Looks up, and optionally synthesises, speech for lines a call is likely to say.
+
+    This runs in the background while the call carries on, so that when a line is said its speech is already cached, or on its way.
+    """
+
+    def __init__(self, synthesise: bool, encoding: str = audio.MASTER_ENCODING) -> None:  # noqa: FBT001
+        """Prepare the prefetcher, for a call that plays speech in an encoding."""
+        self.synthesise = synthesise
+        self.encoding = encoding
+        self.prefetched = 0
+
+        self._seen: set[tuple[int, str]] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def prefetch(self, npc_id: int, texts: Iterable[str]) -> None:
+        """Start getting the speech for an NPC saying some lines ready."""
+        for text in texts:
+            if not text or not text.strip() or (npc_id, text) in self._seen:
+                continue
+            self._seen.add((npc_id, text))
+            self._track(asyncio.create_task(self._prefetch(npc_id, text)))
+
+    def prefetch_for_recruit(self, npc_id: int, location_id: int | None, context: RecruitContext) -> None:
+        """Start getting the lines for a recruit's open missions, and the mission they'd be given next, ready."""
+        self.prefetch(npc_id, recruit_prompts(npc_id, context))
+        self._track(asyncio.create_task(self._prefetch_next_mission(npc_id, location_id, context.progress())))
+
+    def cancel(self) -> None:
+        """Stop prefetching, when the call is over.
+
+        Synthesis that has already started carries on, as its recording is stored for future calls.
+        """
+        for task in list(self._tasks):
+            task.cancel()
+        logger.info("Prefetched speech for %s lines", self.prefetched)
+
+    def _track(self, task: asyncio.Task) -> None:
+        """Keep a task until it is done."""
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _prefetch_next_mission(self, npc_id: int, location_id: int | None, progress: eligibility.RecruitProgress) -> None:
+        """Get the introduction of the mission the recruit would be given next ready."""
+        try:
+            graph = await sync_to_async(eligibility.get_mission_graph)()
+            node = graph.next_mission(npc_id, location_id, progress)
+            if node is not None:
+                mission = await models.Mission.objects.only("give_text").aget(pk=node.id)
+                self.prefetch(npc_id, [mission.give_text])
+        except Exception:
+            logger.exception("Failed to prefetch the next mission for NPC %s", npc_id)
+
+    async def _prefetch(self, npc_id: int, text: str) -> None:
+        """Get the speech for a line ready."""
+        try:
+            entry, _ = await speech.aget_or_create(npc_id, text)
+            if entry.recording:
+                # Also have the recording ready to serve
+                await speech.aget_recording(entry.id, self.encoding)
+            elif self.synthesise:
+                speech.start_synthesis(get_tts(), entry, text)
+            self.prefetched += 1
+        except Exception:
+            logger.exception("Failed to prefetch speech for NPC %s: %s", npc_id, text)
@@ -0,0 +1,151 @@
+"""Generating speech for game text ahead of calls."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from calls import consumers, models, speech
+from calls.tts import Tts
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+
+logger = logging.getLogger("eomf.calls.pregenerate")
+
+# Utterances synthesised at once by default
+DEFAULT_CONCURRENCY = 4
+
+
+@dataclass(frozen=True)
+class Utterance:
+    """Something an NPC says."""
+
+    npc_id: int
+    text: str
+
+
+@dataclass
+class PregenerationReport:
+    """What happened while generating speech."""
+
+    total: int = 0
+    existing: int = 0
+    generated: int = 0
+    failed: int = 0
+
+    # Seconds spent synthesising each generated utterance
+    durations: list[float] = field(default_factory=list)
+
+    @property
+    def done(self) -> int:
+        """Get the number of utterances dealt with so far."""
+        return self.existing + self.generated + self.failed
+
+
+def game_utterances() -> list[Utterance]:
+    """List everything NPCs can say that is known before a call starts.
+
+    Text from Lua missions is only known during a call, so isn't included. Prompts including a recruit number are said with clips, which are.
+    """
+    utterances: dict[tuple[int, str], Utterance] = {}
+
+    def add(npc_id: int | None, *texts: str) -> None:
+        for text in texts:
+            if npc_id is not None and text and text.strip():
+                utterances.setdefault((npc_id, models.Speech.hash_text(text)), Utterance(npc_id, text))
+
+    for npc_id, introduction in models.NPC.objects.values_list("id", "introduction"):
+        add(npc_id, introduction, *consumers.NPC_PROMPTS)
+
+    if models.NPC.objects.filter(pk=consumers.OPERATOR_NPC_ID).exists():
+        add(consumers.OPERATOR_NPC_ID, *consumers.OPERATOR_PROMPTS)
+
+    for mission in models.Mission.objects.select_related("followup_mission"):
+        add(mission.issued_by_id, mission.give_text, mission.reminder_text, mission.incorrect_text, mission.cancel_text)
+
+        # Missions are completed by calling whoever they ask for, who then gives any followup
+        completed_by = mission.call_another_id if mission.type == models.MissionTypes.NPC and mission.call_another_id else mission.issued_by_id
+        add(completed_by, mission.completion_text)
+        if mission.followup_mission is not None:
+            add(completed_by, mission.followup_mission.give_text)
+
+    return list(utterances.values())
+
+
+async def apregenerate(
+    tts: Tts,
+    utterances: Iterable[Utterance],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    progress: Callable[[PregenerationReport, Utterance, str], None] | None = None,
+) -> PregenerationReport:
+    """Generate speech for any utterances without a recording.
+
+    Each recording is stored as soon as it is generated, so an interrupted run picks up where it left off.
+    """
+    utterances = list(utterances)
+    report = PregenerationReport(total=len(utterances))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate(utterance: Utterance) -> None:
+        entry, _ = await speech.aget_or_create(utterance.npc_id, utterance.text)
+        if entry.recording:
+            report.existing += 1
+            outcome = "existing"
+        else:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await speech.asynthesise(tts, entry, utterance.text)
+                except Exception:
+                    logger.exception("Failed to generate speech for NPC %s: %s", utterance.npc_id, utterance.text)
+                    report.failed += 1
+                    outcome = "failed"
+                else:
+                    report.durations.append(time.perf_counter() - start)
+                    report.generated += 1
+                    outcome = "generated"
+
+        if outcome == "generated":
+            logger.info("[%s/%s] Generated speech for NPC %s: %s", report.done, report.total, utterance.npc_id, utterance.text)
+        if progress is not None:
+            progress(report, utterance, outcome)
+
+    await asyncio.gather(*(generate(utterance) for utterance in utterances))
+    logger.info("Generated %s, already had %s, failed %s utterances", report.generated, report.existing, report.failed)
+    return report
+
+
+_background: threading.Thread | None = None
+_background_lock = threading.Lock()
+
+
+def start_in_background() -> int | None:
+    """Generate speech for all game text on a background thread, unless that is already happening.
+
+    Returns the number of utterances that will be looked at, or None if generation was already running.
+    """
+    global _background  # noqa: PLW0603
+
+    with _background_lock:
+        if _background is not None and _background.is_alive():
+            return None
+        utterances = game_utterances()
+        _background = threading.Thread(target=_run_in_background, args=(utterances,), name="pregenerate-speech", daemon=True)
+        _background.start()
+    return len(utterances)
+
+
+def _run_in_background(utterances: list[Utterance]) -> None:
+    """Generate speech on its own event loop, logging anything that goes wrong.
+
+    If the process exits first, recordings already made are kept, and the next run carries on from them.
+    """
+    try:
+        asyncio.run(apregenerate(Tts.from_settings(), utterances))
+    except Exception:
+        logger.exception("Failed to generate speech")
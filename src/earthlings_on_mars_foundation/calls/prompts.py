@@ -0,0 +1,57 @@
+"""Prompts said as a sequence of separately recorded clips, so values in them don't need new speech."""
+
+from __future__ import annotations
+
+import string
+from dataclasses import dataclass
+from typing import Any
+
+# Clip said for each digit of a value
+DIGIT_CLIPS = ("zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine")
+
+# Punctuation left at the edges of the text around a value, which isn't worth a clip of its own
+_FRAGMENT_EDGES = string.whitespace + ".,;:-"
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """Text with placeholders for values, which are said digit by digit.
+
+    Placeholders use `str.format` syntax, so `"You're recruit {recruit:04}"` says the recruit number padded to four digits. The text around
+    placeholders and each digit is its own clip, so an NPC only ever needs one recording of each, however many values it says.
+    """
+
+    template: str
+
+    def fragments(self) -> list[str]:
+        """List the fixed text of the prompt."""
+        return [fragment for fragment, _ in self._parts() if fragment]
+
+    def clips(self) -> list[str]:
+        """List every clip the prompt can be said with, for recording ahead of time."""
+        return [*self.fragments(), *DIGIT_CLIPS]
+
+    def render(self, **values: Any) -> list[str]:  # noqa: ANN401
+        """Get the clips that say the prompt with some values, in order."""
+        clips = []
+        for fragment, field in self._parts():
+            if fragment:
+                clips.append(fragment)
+            if field is not None:
+                name, spec = field
+                clips.extend(DIGIT_CLIPS[int(c)] for c in format(values[name], spec) if c.isdigit())
+        return clips
+
+    def _parts(self) -> list[tuple[str, tuple[str, str] | None]]:
+        """Split the template into fixed text, and the name and format of the value after it."""
+        parts = []
+        for text, name, spec, _ in string.Formatter().parse(self.template):
+            fragment = text.strip(_FRAGMENT_EDGES)
+            if not any(c.isalnum() for c in fragment):
+                fragment = ""
+            parts.append((fragment, None if name is None else (name, spec or "")))
+        return parts
+
+    def __str__(self) -> str:
+        """Get the template."""
+        return self.template
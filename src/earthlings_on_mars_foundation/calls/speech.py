@@ -0,0 +1,346 @@
+"""Looking up the recorded speech for what an NPC says."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Generic, TypeVar
+
+from asgiref.sync import sync_to_async
+from calls import audio, models, packstore
+from calls.streaming import GrowingRecording
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+if TYPE_CHECKING:
+    import datetime
+    import mmap
+    from collections.abc import Callable
+
+    from calls.tts import Tts
+    from django.core.files import File
+    from django.core.files.storage import Storage
+
+logger = logging.getLogger("eomf.calls.speech")
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+@dataclass(frozen=True)
+class SpeechEntry:
+    """What the call logic needs to know about a speech recording."""
+
+    id: int
+
+    # Hash of the packed recording, or name of its file, empty if it hasn't been recorded yet
+    recording: str
+
+    @classmethod
+    def from_speech(cls, speech: models.Speech) -> SpeechEntry:
+        """Get the entry for a speech row."""
+        return cls(id=speech.id, recording=speech.blob_id or speech.recording.name or "")
+
+
+@dataclass(frozen=True)
+class StoredRecording:
+    """Where a speech recording is stored in an encoding, and the validators for serving it.
+
+    Packed recordings are read from a map of their pack, anything else from its own file.
+    """
+
+    name: str
+    encoding: str
+    size: int
+    modified: datetime.datetime
+    etag: str
+
+    # Map of the pack, and where the recording starts in it, if it is packed
+    pack: mmap.mmap | None = field(default=None, compare=False, repr=False)
+    offset: int = 0
+
+    @classmethod
+    def load(cls, speech_id: int, encoding: str = audio.MASTER_ENCODING) -> StoredRecording | None:
+        """Look up a recording in the database and storage, if it has been recorded."""
+        if encoding == audio.MASTER_ENCODING:
+            source = models.Speech.objects.select_related("blob").filter(id=speech_id).first()
+        else:
+            source = models.SpeechRendition.objects.select_related("blob").filter(speech_id=speech_id, encoding=encoding).first()
+            if source is None:
+                source = create_rendition(speech_id, encoding)
+        if source is None:
+            return None
+
+        if source.blob is not None:
+            return cls.from_blob(source.blob, encoding)
+
+        recording = source.recording
+        if not recording:
+            return None
+        storage = recording.storage
+        try:
+            size = storage.size(recording.name)
+            modified = storage.get_modified_time(recording.name)
+        except FileNotFoundError:
+            return None
+
+        etag = f'"{speech_id:x}-{encoding}-{size:x}-{int(modified.timestamp() * 1_000_000):x}"'
+        return cls(name=recording.name, encoding=encoding, size=size, modified=modified, etag=etag)
+
+    @classmethod
+    def from_blob(cls, blob: models.AudioBlob, encoding: str) -> StoredRecording | None:
+        """Get a packed recording, mapping its pack ready to be read."""
+        try:
+            pack = packstore.pack_map(blob.pack, blob.offset + blob.size)
+        except FileNotFoundError:
+            logger.exception("Missing pack %s for %s", blob.pack, blob.sha256)
+            return None
+        # The content is addressed by its hash, so that is all the validator needs
+        return cls(name=blob.pack, encoding=encoding, size=blob.size, modified=blob.created, etag=f'"{blob.sha256}"', pack=pack, offset=blob.offset)
+
+    @property
+    def packed(self) -> bool:
+        """Whether the recording is read from a pack, which can be done without blocking."""
+        return self.pack is not None
+
+    def read(self, start: int, length: int) -> bytes:
+        """Read part of the recording."""
+        if self.pack is not None:
+            return self.pack[self.offset + start : self.offset + start + length]
+        with self.open() as f:
+            f.seek(start)
+            return f.read(length)
+
+    def view(self, start: int, length: int) -> memoryview:
+        """Get part of a packed recording, without copying it out of the pack's map."""
+        if self.pack is None:
+            raise ValueError(self.name)
+        return memoryview(self.pack)[self.offset + start : self.offset + start + length]
+
+    def open(self) -> File:
+        """Open a recording that isn't packed."""
+        return recording_storage().open(self.name, "rb")
+
+    def path(self) -> str:
+        """Get the recording's path on disk, if it isn't packed."""
+        return recording_storage().path(self.name)
+
+
+def read_recording(source: models.Speech | models.SpeechRendition) -> bytes:
+    """Read the whole of a recording, packed or not."""
+    if source.blob_id is not None:
+        return packstore.read(source.blob)
+    with source.recording.open("rb") as f:
+        return f.read()
+
+
+def recording_storage() -> Storage:
+    """Get the storage speech recordings are kept in."""
+    return models.Speech._meta.get_field("recording").storage  # noqa: SLF001
+
+
+async def aget_recording(speech_id: int, encoding: str = audio.MASTER_ENCODING) -> StoredRecording | None:
+    """Look up a stored recording, only leaving the event loop if it isn't cached."""
+    stored = recording_cache.get((speech_id, encoding))
+    if stored is None:
+        stored = await sync_to_async(StoredRecording.load)(speech_id, encoding)
+        if stored is not None:
+            recording_cache.put((speech_id, encoding), stored)
+    return stored
+
+
+class LruCache(Generic[K, V]):
+    """Bounded least-recently-used map, safe to use from any thread."""
+
+    def __init__(self, size: int) -> None:
+        """Prepare the cache."""
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> V | None:
+        """Get a cached value, if there is one."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        """Cache a value, evicting the least recently used if the cache is full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: K, match: Callable[[V], bool] | None = None) -> None:
+        """Remove a value from the cache, only if it matches if `match` is given."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None and (match is None or match(value)):
+                del self._entries[key]
+
+    def discard_matching(self, match: Callable[[V], bool]) -> None:
+        """Remove every value that matches from the cache."""
+        with self._lock:
+            for key in [key for key, value in self._entries.items() if match(value)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """Remove everything from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+
+# (NPC ID, text hash) to speech, for the call logic
+speech_cache: LruCache[tuple[int | None, str], SpeechEntry] = LruCache(settings.SPEECH_CACHE_SIZE)
+
+# (Speech ID, encoding) to stored recording, for serving recordings
+recording_cache: LruCache[tuple[int, str], StoredRecording] = LruCache(settings.SPEECH_CACHE_SIZE)
+
+
+def get_or_create(npc_id: int | None, text: str) -> tuple[SpeechEntry, bool]:
+    """Find the speech for an NPC saying some text, adding it if this is the first time."""
+    text_hash = models.Speech.hash_text(text)
+    entry = speech_cache.get((npc_id, text_hash))
+    if entry is not None:
+        return entry, False
+    return _load(npc_id, text, text_hash)
+
+
+async def aget_or_create(npc_id: int | None, text: str) -> tuple[SpeechEntry, bool]:
+    """Find the speech for an NPC saying some text, only leaving the event loop if it isn't cached."""
+    text_hash = models.Speech.hash_text(text)
+    entry = speech_cache.get((npc_id, text_hash))
+    if entry is not None:
+        return entry, False
+    return await sync_to_async(_load)(npc_id, text, text_hash)
+
+
+def _load(npc_id: int | None, text: str, text_hash: str) -> tuple[SpeechEntry, bool]:
+    """Find speech in the database by its hash, adding it if there isn't any."""
+    speech = models.Speech.objects.filter(NPC_id=npc_id, text_hash=text_hash).order_by("pk").first()
+    created = speech is None
+    if created:
+        speech = models.Speech.objects.create(NPC_id=npc_id, text=text)
+
+    entry = SpeechEntry.from_speech(speech)
+    speech_cache.put((npc_id, text_hash), entry)
+    return entry, created
+
+
+def store_recording(entry: SpeechEntry, pcm: bytes, is_tts: bool) -> SpeechEntry:  # noqa: FBT001
+    """Pack the master recording for some speech, and every encoding it is served in."""
+    speech = models.Speech.objects.get(pk=entry.id)
+    speech.tts = is_tts
+    speech.blob = packstore.put(pcm)
+    speech.recording = ""
+    speech.save(update_fields=["tts", "blob", "recording"])
+
+    for encoding in audio.ENCODINGS:
+        if encoding != audio.MASTER_ENCODING:
+            _store_rendition(speech, encoding, audio.transcode(pcm, encoding))
+    return SpeechEntry.from_speech(speech)
+
+
+def _store_rendition(speech: models.Speech, encoding: str, data: bytes) -> models.SpeechRendition:
+    """Pack speech in an encoding, replacing any previous recording in it."""
+    rendition = models.SpeechRendition.objects.filter(speech=speech, encoding=encoding).first()
+    if rendition is None:
+        rendition = models.SpeechRendition(speech=speech, encoding=encoding)
+    rendition.blob = packstore.put(data)
+    rendition.recording = ""
+    rendition.save()
+    return rendition
+
+
+def create_rendition(speech_id: int, encoding: str) -> models.SpeechRendition | None:
+    """Transcode the master recording into an encoding that is missing, such as one added since it was recorded."""
+    speech = models.Speech.objects.select_related("blob").filter(id=speech_id).first()
+    if speech is None or not (speech.blob_id or speech.recording) or encoding not in audio.ENCODINGS:
+        return None
+
+    logger.warning("Transcoding speech %s to %s on request", speech_id, encoding)
+    try:
+        pcm = read_recording(speech)
+    except FileNotFoundError:
+        return None
+    return _store_rendition(speech, encoding, audio.transcode(pcm, encoding))
+
+
+astore_recording = sync_to_async(store_recording)
+
+# Recordings being synthesised, by speech ID. They can be streamed from here
+# until they are stored.
+streams: dict[int, GrowingRecording[SpeechEntry]] = {}
+
+
+def start_synthesis(tts: Tts, entry: SpeechEntry, text: str) -> GrowingRecording[SpeechEntry]:
+    """Start generating TTS for speech, unless it already is, and get the recording as it arrives."""
+    recording = streams.get(entry.id)
+    if recording is None:
+        recording = GrowingRecording()
+        streams[entry.id] = recording
+        recording.task = asyncio.create_task(_synthesise(tts, entry, text, recording))
+    return recording
+
+
+async def asynthesise(tts: Tts, entry: SpeechEntry, text: str) -> SpeechEntry:
+    """Generate and store TTS for speech, sharing the work with anyone else doing the same at once."""
+    return await start_synthesis(tts, entry, text).result()
+
+
+async def _synthesise(tts: Tts, entry: SpeechEntry, text: str, recording: GrowingRecording[SpeechEntry]) -> None:
+    """Stream TTS for speech into a growing recording, then store it."""
+    try:
+        async for chunk in tts.stream(text):
+            recording.append(chunk)
+        stored = await astore_recording(entry, recording.audio(), True)  # noqa: FBT003
+    except asyncio.CancelledError as e:
+        recording.finish(error=e)
+        raise
+    except Exception as e:
+        logger.exception("Failed to synthesise speech %s: %s", entry.id, text)
+        recording.finish(error=e)
+    else:
+        recording.finish(stored)
+    finally:
+        # The stored recording is served from now on
+        if streams.get(entry.id) is recording:
+            del streams[entry.id]
+
+
+@receiver(post_save, sender=models.Speech)
+def _speech_saved(instance: models.Speech, update_fields: frozenset[str] | None, **_: Any) -> None:  # noqa: ANN401
+    """Keep the cache in step with speech added or edited outside of calls."""
+    if update_fields is None or not update_fields.isdisjoint({"NPC", "text", "text_hash"}):
+        # Its old text, or NPC, isn't this speech any more
+        speech_cache.discard_matching(lambda entry: entry.id == instance.id)
+    speech_cache.put((instance.NPC_id, instance.text_hash), SpeechEntry.from_speech(instance))
+    recording_cache.discard((instance.id, audio.MASTER_ENCODING))
+
+
+@receiver(post_delete, sender=models.Speech)
+def _speech_deleted(instance: models.Speech, **_: Any) -> None:  # noqa: ANN401
+    """Forget deleted speech."""
+    speech_cache.discard((instance.NPC_id, instance.text_hash), lambda entry: entry.id == instance.id)
+    for encoding in audio.ENCODINGS:
+        recording_cache.discard((instance.id, encoding))
+
+
+@receiver(post_save, sender=models.SpeechRendition)
+@receiver(post_delete, sender=models.SpeechRendition)
+def _rendition_changed(instance: models.SpeechRendition, **_: Any) -> None:  # noqa: ANN401
+    """Serve the current recording in an encoding."""
+    recording_cache.discard((instance.speech_id, instance.encoding))
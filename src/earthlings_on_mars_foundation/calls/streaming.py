@@ -0,0 +1,112 @@
+"""In-memory recordings that can be read while they are still being written."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import threading
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+T = TypeVar("T")
+
+
+class GrowingRecording(Generic[T]):
+    """Audio that is still arriving, which any number of readers can follow from the start.
+
+    Readers may be on any event loop, so they are woken thread-safely. When the writer finishes, it can attach a result (e.g. where the audio
+    was stored) for anyone waiting on `result`.
+    """
+
+    def __init__(self) -> None:
+        """Prepare an empty recording."""
+        self.chunks: list[bytes] = []
+        self.size = 0
+        self.finished = False
+
+        self._result: T | None = None
+        self._error: BaseException | None = None
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = []
+        self._lock = threading.Lock()
+
+        # Task writing the recording, kept here so it isn't garbage collected
+        self.task: asyncio.Task | None = None
+
+    def append(self, chunk: bytes) -> None:
+        """Add audio to the end of the recording."""
+        with self._lock:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+        self._wake()
+
+    def finish(self, result: T | None = None, error: BaseException | None = None) -> None:
+        """Mark the recording as complete, or failed if there is an error."""
+        with self._lock:
+            self.finished = True
+            self._result = result
+            self._error = error
+        self._wake()
+
+    def audio(self) -> bytes:
+        """Get all the audio so far."""
+        with self._lock:
+            return b"".join(self.chunks)
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """Read the recording from the start, waiting for more audio until it is finished."""
+        seen = 0
+        while True:
+            with self._lock:
+                new = self.chunks[seen:]
+                finished = self.finished
+                error = self._error
+            seen += len(new)
+
+            for chunk in new:
+                yield chunk
+
+            if finished:
+                if error is not None:
+                    raise error
+                return
+            if not new:
+                await self._wait(seen)
+
+    async def result(self) -> T | None:
+        """Wait until the recording is finished, and get the writer's result."""
+        while True:
+            with self._lock:
+                if self.finished:
+                    if self._error is not None:
+                        raise self._error
+                    return self._result
+                seen = len(self.chunks)
+            await self._wait(seen)
+
+    async def _wait(self, seen: int) -> None:
+        """Wait for more than `seen` chunks, or the recording to finish."""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        with self._lock:
+            if self.finished or len(self.chunks) > seen:
+                return
+            self._waiters.append((loop, waiter))
+        await waiter
+
+    def _wake(self) -> None:
+        """Wake up everyone waiting for a change."""
+        with self._lock:
+            waiters = self._waiters
+            self._waiters = []
+        for loop, waiter in waiters:
+            # The reader's loop may have closed since it started waiting
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(_resolve, waiter)
+
+
+def _resolve(waiter: asyncio.Future[None]) -> None:
+    """Wake a waiter, unless it already gave up."""
+    if not waiter.done():
+        waiter.set_result(None)
@@ -1,3 +1,1262 @@
-"""TODO: Tests."""
+"""Tests for the calls app."""
 
-# Create your tests here.
+from __future__ import annotations
+
+import asyncio
+import datetime
+import re
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+from unittest import mock
+
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from calls import admin, audio, directory, eligibility, models, packstore, pregenerate, speech
+from calls.calllog import CallLogBuffer
+from calls.consumers import ERROR_PROMPT, NEW_RECRUIT_PROMPT, NPC_PROMPTS, OPERATOR_NPC_ID, OPERATOR_PROMPTS
+from calls.consumers_asterisk import PLAY_ATTEMPTS, AsteriskCallConsumer, DigitCollector, RESTRequestError
+from calls.consumers_jambonz import JambonzCallConsumer
+from calls.context import RecruitContext
+from calls.lua import AsyncLuaRuntime, ChunkCache, LuaBudget, LuaBudgetExceededError, LuaRuntimePool, get_executor, state_from_table, table_from_state
+from calls.prefetch import PromptPrefetcher
+from calls.tts import FakeBackend, Tts
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from lupa import LuaError, LuaMemoryError, LuaSyntaxError
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+
+class SimulatedJambonzSession(JambonzCallConsumer):
+    """Jambonz consumer connected to a simulated Jambonz server."""
+
+    def __init__(self, call_log: models.CallLog, digits: str, delay: float) -> None:
+        """Prepare the simulated session."""
+        super().__init__()
+        self.callLog = call_log
+        self.log_buffer = CallLogBuffer(call_log)
+        self.digits = digits
+        self.delay = delay
+
+    async def send_json(self, content: dict[str, Any], close: bool = False) -> None:  # noqa: ARG002, FBT001, FBT002
+        """Reply to gathers after the player takes a while to enter their digits."""
+        for verb in content["data"]:
+            if "gather" in verb:
+                asyncio.create_task(self._reply(verb["gather"]["actionHook"]))  # noqa: RUF006
+
+    async def _reply(self, hook: str) -> None:
+        """Send the result of a gather back to the consumer."""
+        await asyncio.sleep(self.delay)
+        await self.receive_json(
+            {
+                "type": "verb:hook",
+                "msgid": hook,
+                "hook": hook,
+                "data": {"digits": self.digits, "reason": "dtmfDetected"},
+            },
+        )
+
+
+class SimulatedAsteriskSession(AsteriskCallConsumer):
+    """Asterisk consumer connected to a simulated Asterisk, which replies to REST requests straight away or when told to."""
+
+    def __init__(self, status_code: int | None = 200) -> None:
+        """Prepare the simulated session, replying with `status_code` unless it is None."""
+        super().__init__()
+        self.callLog = models.CallLog(call_id="channel")
+        self.status_code = status_code
+        self.requests: list[dict[str, Any]] = []
+
+    async def send_json(self, content: dict[str, Any], close: bool = False) -> None:  # noqa: ARG002, FBT001, FBT002
+        """Record a REST request, and reply to it."""
+        self.requests.append(content)
+        if self.status_code is not None:
+            asyncio.create_task(self.reply(content, self.status_code))  # noqa: RUF006
+
+    async def reply(self, request: dict[str, Any], status_code: int) -> None:
+        """Send the response to a REST request back to the consumer."""
+        await self.receive_json({"type": "RESTResponse", "request_id": request["request_id"], "status_code": status_code})
+
+
+class DigitCollectorTests(TestCase):
+    """Collecting DTMF digits from Asterisk events."""
+
+    async def collect(self, collector: DigitCollector, events: list[str | float | None]) -> tuple[tuple[str, str], float]:
+        """Feed a collector digits, pauses in seconds, or None for the prompt finishing, and get its result and how long it took."""
+        start = time.monotonic()
+        for event in events:
+            if event is None:
+                collector.prompt_finished()
+            elif isinstance(event, str):
+                collector.add(event)
+            else:
+                await asyncio.sleep(event)
+        return await collector.result, time.monotonic() - start
+
+    async def test_max_digits(self) -> None:
+        """The gather should finish as soon as the most digits wanted have been entered."""
+        collector = DigitCollector(1, 4, inter_digit_timeout=10, prompt_timeout=10)
+        result, elapsed = await self.collect(collector, ["1", "2", "3", "4", "5"])
+        self.assertEqual(result, ("1234", "dtmfDetected"))
+        self.assertLess(elapsed, 1)
+
+    async def test_inter_digit_timeout(self) -> None:
+        """Once enough digits are entered, the gather should finish when no more arrive in time, each digit restarting the timer."""
+        collector = DigitCollector(1, 4, inter_digit_timeout=0.1, prompt_timeout=10)
+        result, elapsed = await self.collect(collector, ["1", 0.06, "2", 0.06, "3"])
+        self.assertEqual(result, ("123", "dtmfDetected"))
+        self.assertGreater(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+
+    async def test_prompt_timeout(self) -> None:
+        """Without enough digits, the gather should time out once the prompt has finished, giving no digits."""
+        collector = DigitCollector(4, 4, inter_digit_timeout=0.05, prompt_timeout=0.1)
+        result, elapsed = await self.collect(collector, ["1", 0.2, None])
+        self.assertEqual(result, ("", "timeout"))
+        self.assertGreater(elapsed, 0.25)
+
+    async def test_terminator(self) -> None:
+        """The terminator should end the gather without being collected, but only once enough digits are entered."""
+        collector = DigitCollector(2, 4, inter_digit_timeout=10, prompt_timeout=10)
+        result, _ = await self.collect(collector, ["#", "1", "#", "2", "#", "3"])
+        self.assertEqual(result, ("12", "dtmfDetected"))
+
+
+class AsteriskTeardownTests(TestCase):
+    """Tearing down Asterisk calls."""
+
+    async def test_hangup_during_playback(self) -> None:
+        """Closing the websocket mid-playback should end the call straight away, not wait for replies that can't arrive."""
+        session = SimulatedAsteriskSession()
+        session.call_connected = True
+        session.call_task = asyncio.create_task(session._play("sound:hello", "Hello"))  # noqa: SLF001
+        await asyncio.sleep(0.01)
+
+        # A request still waiting for a reply when the websocket closes
+        session.status_code = None
+        pending = await session._request("GET", "channels")  # noqa: SLF001
+
+        start = time.monotonic()
+        await session.disconnect(1000)
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.assertTrue(session.call_task.cancelled())
+        with self.assertRaises(ConnectionError):
+            pending.result()
+        self.assertEqual(session.pending_requests, {})
+        self.assertEqual(session.playback_trackers, {})
+
+    async def test_cancelled_playback_is_stopped(self) -> None:
+        """Cancelling a playback while the call is up should stop it, without waiting for Asterisk to reply."""
+        session = SimulatedAsteriskSession()
+        play = asyncio.create_task(session._play("sound:hello", "Hello"))  # noqa: SLF001
+        await asyncio.sleep(0.01)
+        session.status_code = None
+
+        play.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await play
+        self.assertEqual(session.requests[-1]["method"], "DELETE")
+        self.assertTrue(session.requests[-1]["uri"].startswith("playbacks/"))
+        self.assertEqual(session.playback_trackers, {})
+
+
+class AsteriskRequestTests(TestCase):
+    """Sending REST requests to Asterisk over the websocket."""
+
+    async def test_responses_are_matched_by_request_id(self) -> None:
+        """Responses arriving out of order should each go to the request they answer."""
+        session = SimulatedAsteriskSession(status_code=None)
+        sends = [asyncio.create_task(session._send("GET", f"channels/{i}")) for i in range(3)]  # noqa: SLF001
+        await asyncio.sleep(0.01)
+
+        for request, status_code in zip(reversed(session.requests), (200, 204, 201), strict=True):
+            await session.reply(request, status_code)
+        responses = await asyncio.gather(*sends)
+
+        self.assertEqual([response["status_code"] for response in responses], [201, 204, 200])
+        self.assertEqual([response["request_id"] for response in responses], [request["request_id"] for request in session.requests])
+        self.assertEqual(session.pending_requests, {})
+
+    async def test_errors_and_timeouts(self) -> None:
+        """Error responses should raise, and requests without a response should time out."""
+        session = SimulatedAsteriskSession(status_code=404)
+        with self.assertRaises(RESTRequestError) as raised:
+            await session._send("DELETE", "playbacks/gone")  # noqa: SLF001
+        self.assertEqual(raised.exception.response["status_code"], 404)
+
+        session.status_code = None
+        with self.assertRaises(TimeoutError):
+            await session._send("GET", "channels", reply_timeout=0.05)  # noqa: SLF001
+        self.assertEqual(session.pending_requests, {})
+
+    async def test_timeout_is_a_query_string(self) -> None:
+        """ARI's own timeout parameters should be sent as query strings, not taken as how long to wait for a reply."""
+        session = SimulatedAsteriskSession()
+        await session._send("POST", "channels/channel/dial", timeout=30)  # noqa: SLF001
+
+        self.assertEqual(session.requests[0]["query_strings"], [{"name": "timeout", "value": 30}])
+
+    async def test_playback_is_retried(self) -> None:
+        """A prompt that can't be started should be tried again, then skipped."""
+        session = SimulatedAsteriskSession(status_code=500)
+        session.scope = {"headers": [(b"host", b"eomf.example")]}
+        with mock.patch.object(session, "_speech_url", mock.AsyncMock(return_value="/call/speech/1.alaw")):
+            await session._say("Hello", npc=models.NPC(name="Captain"))  # noqa: SLF001
+
+        self.assertEqual(len(session.requests), PLAY_ATTEMPTS)
+        self.assertEqual({request["uri"] for request in session.requests}, {"channels/channel/play"})
+        self.assertEqual(session.playback_trackers, {})
+
+
+class PlaybackTrackerTests(TestCase):
+    """Matching PlaybackFinished events to the playbacks waiting for them."""
+
+    async def test_finished_events(self) -> None:
+        """Each PlaybackFinished should only finish its own playback, and stray or repeated events should be ignored."""
+        session = SimulatedAsteriskSession()
+        plays = [asyncio.create_task(session._play(f"sound:{i}", str(i))) for i in range(2)]  # noqa: SLF001
+        await asyncio.sleep(0.01)
+        first, second = ({q["name"]: q["value"] for q in request["query_strings"]}["playbackId"] for request in session.requests)
+
+        async def finished(playback_id: str) -> None:
+            await session.receive_json({"type": "PlaybackFinished", "playback": {"id": playback_id}})
+            await asyncio.sleep(0.01)
+
+        await finished("stray")
+        await finished(second)
+        self.assertFalse(plays[0].done())
+        self.assertTrue(await plays[1])
+
+        await finished(second)
+        await finished(first)
+        self.assertTrue(await plays[0])
+        await finished(first)
+        self.assertEqual(session.playback_trackers, {})
+
+
+class JambonzGatherTests(TestCase):
+    """Gathering digits over the Jambonz websocket."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create the NPC being called."""
+        cls.npc = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+
+    async def test_concurrent_gathers_do_not_serialise(self) -> None:
+        """Many sessions waiting on gathers at once should all finish in about one gather's time."""
+        sessions = 50
+        delay = 0.2
+
+        consumers = []
+        for session in range(sessions):
+            call_log = await models.CallLog.objects.acreate(call_id=f"call-{session}", NPC=self.npc)
+            consumers.append(SimulatedJambonzSession(call_log, f"{session:04}", delay))
+
+        start = time.monotonic()
+        results = await asyncio.gather(*(consumer._gather("Enter your recruit number", max_digits=4) for consumer in consumers))  # noqa: SLF001
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(results, [(f"{session:04}", "dtmfDetected") for session in range(sessions)])
+        self.assertLess(elapsed, delay * 5)
+        for consumer in consumers:
+            self.assertEqual(consumer.hook_waiters, {})
+
+
+class CallSetupTests(TestCase):
+    """Starting the call logic."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create the operator and the NPC being called."""
+        cls.operator = models.NPC.objects.create(id=OPERATOR_NPC_ID, name="Operator", extension=100, introduction="Operator here")
+        cls.npc = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+
+    async def test_npc_found_while_authenticating(self) -> None:
+        """An NPC only found from the dialplan while the caller authenticates should still be loaded for the call."""
+        recruit = await models.Recruit.objects.acreate()
+        session = SimulatedJambonzSession(await models.CallLog.objects.acreate(call_id="call"), "", 0)
+        session.call_connected = True
+
+        async def authenticate(**_: Any) -> models.Recruit:  # noqa: ANN401
+            session.log_buffer.update(NPC_id=self.npc.id)
+            return recruit
+
+        with (
+            mock.patch.object(session, "_authenticate", authenticate),
+            mock.patch.object(session, "_say", mock.AsyncMock()) as say,
+            mock.patch.object(session, "_hangup", mock.AsyncMock()),
+        ):
+            await session._new_call()  # noqa: SLF001
+
+        said = [call.args[0] for call in say.call_args_list]
+        self.assertIn(self.npc.introduction, said)
+        self.assertNotIn(ERROR_PROMPT, said)
+
+
+class CallLogBufferTests(TestCase):
+    """Buffering updates to the call log."""
+
+    async def test_updates_are_written_together(self) -> None:
+        """Many updates during a call should be written in a single save when the call ends."""
+        call_log = await models.CallLog.objects.acreate(call_id="call")
+        buffer = CallLogBuffer(call_log)
+        buffer.start()
+
+        for duration in range(1, 11):
+            buffer.update(duration=duration)
+        buffer.update(digits=4)
+        buffer.update(completed=True, success=True)
+
+        # Updates that change nothing don't need writing
+        buffer.update(duration=10, digits=4)
+        buffer.update(completed=True)
+
+        # Nothing is written until the buffer is flushed
+        stored = await models.CallLog.objects.aget(call_id="call")
+        self.assertEqual(stored.duration, 0)
+
+        await buffer.aclose()
+
+        stored = await models.CallLog.objects.aget(call_id="call")
+        self.assertEqual((stored.duration, stored.digits, stored.completed, stored.success), (10, 4, True, True))
+        self.assertEqual((buffer.counts.requested, buffer.counts.performed, buffer.counts.saved), (12, 1, 11))
+
+    async def test_in_progress_calls_are_written_periodically(self) -> None:
+        """Updates to a call that is still in progress should be written every interval."""
+        call_log = await models.CallLog.objects.acreate(call_id="call")
+        buffer = CallLogBuffer(call_log, interval=0.05)
+        buffer.start()
+
+        buffer.update(duration=5)
+        await asyncio.sleep(0.2)
+
+        stored = await models.CallLog.objects.aget(call_id="call")
+        self.assertEqual(stored.duration, 5)
+        self.assertEqual(buffer.counts.performed, 1)
+
+        await buffer.aclose()
+
+
+class MissionOutcomeTests(TestCase):
+    """Recording the outcome of missions."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create an NPC with a chain of missions."""
+        cls.npc = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+        cls.followup = cls.create_mission("Followup", points=1)
+        cls.missions = [cls.create_mission(f"Mission {i}", points=i + 1, followup_mission=cls.followup) for i in range(50)]
+
+    @classmethod
+    def create_mission(cls, name: str, **kwargs: Any) -> models.Mission:  # noqa: ANN401
+        """Create a mission issued by the NPC."""
+        return models.Mission.objects.create(
+            name=name,
+            give_text=name,
+            reminder_text="Reminder",
+            completion_text="Done",
+            issued_by=cls.npc,
+            type=models.MissionTypes.LOCATION,
+            repeatable=False,
+            **kwargs,
+        )
+
+    async def test_concurrent_completions_keep_every_score(self) -> None:
+        """Completing many missions at once from separate calls should not lose any score updates."""
+        recruit = await models.Recruit.objects.acreate()
+        await models.RecruitNPC.objects.acreate(recruit=recruit, NPC=self.npc, score=100)
+        for mission in self.missions:
+            await models.RecruitMission.objects.acreate(recruit=recruit, mission=mission)
+
+        # Each call loads its own snapshot before any of them finish, so scores kept in memory would be stale
+        contexts = [await RecruitContext.aload(recruit) for _ in self.missions]
+        await asyncio.gather(
+            *(
+                context.afinish_mission(next(rm for rm in context.open_missions() if rm.mission_id == mission.id), completed=True)
+                for context, mission in zip(contexts, self.missions, strict=True)
+            ),
+        )
+
+        recruit_npc = await models.RecruitNPC.objects.aget(recruit=recruit, NPC=self.npc)
+        self.assertEqual(recruit_npc.score, 100 + sum(mission.points for mission in self.missions))
+        self.assertEqual(await models.RecruitMission.objects.filter(recruit=recruit, mission=self.followup).acount(), len(self.missions))
+
+    def test_completions_update_in_the_database(self) -> None:
+        """Finishing a mission should update the score and the mission with SQL that can't lose a concurrent update.
+
+        The tests above run their calls one after another on a single database connection, so this checks the SQL itself.
+        """
+        recruit = models.Recruit.objects.create()
+        models.RecruitNPC.objects.create(recruit=recruit, NPC=self.npc, score=100)
+        models.RecruitMission.objects.create(recruit=recruit, mission=self.missions[0])
+        context = async_to_sync(RecruitContext.aload)(recruit)
+
+        with CaptureQueriesContext(connection) as queries:
+            context._finish_mission(context.open_missions()[0], completed=True)  # noqa: SLF001
+
+        updates = [query["sql"] for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertTrue(any(re.match(r'UPDATE "calls_recruitnpc" SET "score" = \("calls_recruitnpc"\."score" \+ \d+\) WHERE', sql) for sql in updates), updates)
+        self.assertTrue(any(sql.startswith('UPDATE "calls_recruitmission"') and '"finished" IS NULL' in sql for sql in updates), updates)
+
+    async def test_mission_is_only_scored_once(self) -> None:
+        """Two calls finishing the same mission should only score it once."""
+        recruit = await models.Recruit.objects.acreate()
+        await models.RecruitMission.objects.acreate(recruit=recruit, mission=self.missions[0])
+
+        contexts = [await RecruitContext.aload(recruit) for _ in range(2)]
+        results = await asyncio.gather(*(context.afinish_mission(context.open_missions()[0], completed=True) for context in contexts))
+
+        recruit_npc = await models.RecruitNPC.objects.aget(recruit=recruit, NPC=self.npc)
+        self.assertEqual(recruit_npc.score, self.missions[0].points)
+        self.assertEqual(sum(result is not None for result in results), 1)
+
+    async def test_changes_only_write_their_fields(self) -> None:
+        """Calls changing different fields of the same mission should not overwrite each other's changes."""
+        recruit = await models.Recruit.objects.acreate()
+        await models.RecruitMission.objects.acreate(recruit=recruit, mission=self.missions[0], state={"calls": 1})
+
+        first, second = [await RecruitContext.aload(recruit) for _ in range(2)]
+        first.open_missions()[0].state = {"calls": 2}
+        first.changed(first.open_missions()[0], "state")
+        second.open_missions()[0].code_tries = 1
+        second.changed(second.open_missions()[0], "code_tries")
+        await first.asave()
+        await second.asave()
+
+        recruit_mission = await models.RecruitMission.objects.aget(recruit=recruit)
+        self.assertEqual((recruit_mission.state, recruit_mission.code_tries), ({"calls": 2}, 1))
+        self.assertFalse(second.dirty)
+
+    async def test_count_is_saved(self) -> None:
+        """The count entered for a count mission should be stored along with it being completed."""
+        recruit = await models.Recruit.objects.acreate()
+        mission = await models.Mission.objects.acreate(
+            name="Count",
+            give_text="Count",
+            reminder_text="How many?",
+            completion_text="Done",
+            issued_by=self.npc,
+            type=models.MissionTypes.COUNT,
+            repeatable=False,
+            points=1,
+        )
+        await models.RecruitMission.objects.acreate(recruit=recruit, mission=mission)
+
+        call_log = await models.CallLog.objects.acreate(call_id="call", NPC=self.npc)
+        session = SimulatedJambonzSession(call_log, "42", 0)
+        session.recruit_context = await RecruitContext.aload(recruit)
+        await session._check_count_mission(session.recruit_context.open_missions()[0])  # noqa: SLF001
+
+        recruit_mission = await models.RecruitMission.objects.aget(recruit=recruit, mission=mission)
+        self.assertEqual((recruit_mission.count_value, recruit_mission.completed), (42, True))
+
+
+    async def test_lua_syntax_error_only_fails_its_mission(self) -> None:
+        """A Lua mission that doesn't compile should be left as it was, without ending the call."""
+        recruit = await models.Recruit.objects.acreate()
+        mission = await models.Mission.objects.acreate(
+            name="Broken",
+            give_text="Broken",
+            reminder_text="Reminder",
+            completion_text="Done",
+            issued_by=self.npc,
+            type=models.MissionTypes.LUA,
+            lua="this is not lua",
+            repeatable=False,
+            points=1,
+        )
+        await models.RecruitMission.objects.acreate(recruit=recruit, mission=mission)
+
+        session = SimulatedJambonzSession(await models.CallLog.objects.acreate(call_id="call", NPC=self.npc), "", 0)
+        session.recruit_context = await RecruitContext.aload(recruit)
+        self.assertTrue(await session._check_lua_mission(session.recruit_context.open_missions()[0]))  # noqa: SLF001
+        self.assertFalse(session.recruit_context.dirty)
+
+class MissionEligibilityTests(TestCase):
+    """Choosing the next mission to give a recruit."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create a small game with prerequisites, followups, start locations and time limits."""
+        cls.captain = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+        cls.doctor = models.NPC.objects.create(name="Doctor", extension=1001, introduction="Hello")
+        cls.bridge = models.Location.objects.create(name="Bridge", extension=2000)
+        cls.engines = models.Location.objects.create(name="Engines", extension=2001)
+
+        cls.intro = cls.create_mission("Intro", cls.captain, priority=5)
+        cls.after_intro = cls.create_mission("After intro", cls.captain, priority=9)
+        cls.followup = cls.create_mission("Followup", cls.captain, priority=1)
+        cls.on_bridge = cls.create_mission("On the bridge", cls.captain, priority=7, only_start_from=cls.bridge)
+        cls.repeatable = cls.create_mission("Repeatable", cls.captain, priority=3, repeatable=True)
+        cls.create_mission("Not yet", cls.captain, priority=10, not_before=datetime.datetime.now(tz=datetime.UTC) + datetime.timedelta(days=1))
+        cls.checkup = cls.create_mission("Checkup", cls.doctor, priority=5, followup_mission=cls.followup)
+
+        models.MissionPrerequisite.objects.create(mission=cls.after_intro, prerequisite=cls.intro)
+        models.MissionPrerequisite.objects.create(mission=cls.followup, prerequisite=cls.intro)
+
+    @classmethod
+    def create_mission(cls, name: str, npc: models.NPC, **kwargs: Any) -> models.Mission:  # noqa: ANN401
+        """Create a mission issued by an NPC."""
+        kwargs.setdefault("repeatable", False)
+        return models.Mission.objects.create(
+            name=name,
+            give_text=name,
+            reminder_text="Reminder",
+            completion_text="Done",
+            issued_by=npc,
+            type=models.MissionTypes.LOCATION,
+            points=1,
+            **kwargs,
+        )
+
+    def setUp(self) -> None:
+        """Start each test without a loaded mission graph."""
+        eligibility.invalidate_mission_graph()
+
+    def create_recruit(self, finished: list[models.Mission], failed: tuple[models.Mission, ...] = (), in_progress: tuple[models.Mission, ...] = ()) -> models.Recruit:
+        """Create a recruit who has finished, failed and started the given missions."""
+        recruit = models.Recruit.objects.create()
+        now = datetime.datetime.now(tz=datetime.UTC)
+        for mission in finished:
+            models.RecruitMission.objects.create(recruit=recruit, mission=mission, finished=now, completed=True)
+        for mission in failed:
+            models.RecruitMission.objects.create(recruit=recruit, mission=mission, finished=now, completed=False)
+        for mission in in_progress:
+            models.RecruitMission.objects.create(recruit=recruit, mission=mission)
+        return recruit
+
+    def test_matches_sql_query(self) -> None:
+        """The mission graph should pick the same missions as the SQL query it replaced."""
+        recruits = [
+            self.create_recruit([]),
+            self.create_recruit([self.intro]),
+            self.create_recruit([], failed=(self.intro,)),
+            self.create_recruit([self.intro, self.followup]),
+            self.create_recruit([self.intro, self.followup, self.after_intro]),
+            self.create_recruit([self.intro, self.followup, self.after_intro, self.on_bridge, self.repeatable]),
+        ]
+        graph = eligibility.get_mission_graph()
+
+        # Each mission has at most one prerequisite, as the SQL query miscounted several
+        for recruit in recruits:
+            for npc in (self.captain, self.doctor):
+                for location in (None, self.bridge, self.engines):
+                    with self.subTest(recruit=recruit.id, npc=npc.name, location=location and location.name):
+                        expected = eligibility.query_next_mission(recruit.id, npc.id, location and location.id)
+                        node = graph.next_mission(npc.id, location and location.id, eligibility.RecruitProgress.load(recruit))
+                        self.assertEqual(None if node is None else node.id, None if expected is None else expected.id)
+
+    def test_skips_missions_in_progress(self) -> None:
+        """A mission the recruit is already doing should not be given again, even if it is repeatable."""
+        recruit = self.create_recruit([self.intro, self.followup, self.after_intro, self.on_bridge], in_progress=(self.repeatable,))
+        graph = eligibility.get_mission_graph()
+
+        self.assertIsNone(graph.next_mission(self.captain.id, self.bridge.id, eligibility.RecruitProgress.load(recruit)))
+
+    def test_reloaded_after_changes(self) -> None:
+        """Editing missions or their prerequisites should reload the mission graph."""
+        graph = eligibility.get_mission_graph()
+        self.assertIs(eligibility.get_mission_graph(), graph)
+
+        extra = self.create_mission("Extra", self.doctor, priority=1)
+        graph = eligibility.get_mission_graph()
+        self.assertIn(extra.id, graph.missions)
+
+        models.MissionPrerequisite.objects.create(mission=extra, prerequisite=self.checkup)
+        graph = eligibility.get_mission_graph()
+        self.assertEqual(graph.missions[extra.id].prerequisites, {self.checkup.id})
+
+        models.MissionPrerequisite.objects.filter(mission=extra).delete()
+        graph = eligibility.get_mission_graph()
+        self.assertEqual(graph.missions[extra.id].prerequisites, set())
+
+        extra.delete()
+        self.assertNotIn(extra.id, eligibility.get_mission_graph().missions)
+
+    def test_reloaded_after_loading_from_repo(self) -> None:
+        """Loading the game from the repo should reload the mission graph."""
+        graph = eligibility.get_mission_graph()
+
+        with mock.patch("calls.admin.load_locations"), mock.patch("calls.admin.load_npcs"):
+            admin.actual_load_from_repo()
+
+        self.assertIsNot(eligibility.get_mission_graph(), graph)
+
+
+class ExtensionDirectoryTests(TestCase):
+    """Routing calls to NPCs and locations by extension."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create NPCs and locations with extensions."""
+        cls.captain = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+        cls.doctor = models.NPC.objects.create(name="Doctor", extension=1001, introduction="Hello")
+        cls.bridge = models.Location.objects.create(name="Bridge", extension=2000)
+
+    def setUp(self) -> None:
+        """Start each test without a loaded directory."""
+        directory.invalidate_directory()
+
+    def test_lookup(self) -> None:
+        """Extensions should be found whether they arrive as text or numbers."""
+        extensions = directory.get_directory()
+
+        self.assertEqual(extensions.npc_id("1000"), self.captain.id)
+        self.assertEqual(extensions.npc_id(1001), self.doctor.id)
+        self.assertEqual(extensions.location_id("2000"), self.bridge.id)
+        self.assertIsNone(extensions.npc_id("2000"))
+        self.assertIsNone(extensions.location_id(1000))
+        with self.assertRaises(ValueError):
+            extensions.location_id("anonymous")
+
+    def test_shared_extension_goes_to_first(self) -> None:
+        """When several NPCs share an extension, calls should go to the first one created."""
+        models.NPC.objects.create(name="Impostor", extension=1000, introduction="Hello")
+
+        self.assertEqual(directory.get_directory().npc_id(1000), self.captain.id)
+
+    async def test_async_lookup(self) -> None:
+        """The directory should be loaded once and then shared without leaving the event loop."""
+        extensions = await directory.aget_directory()
+
+        self.assertIs(await directory.aget_directory(), extensions)
+        self.assertEqual(extensions.npc_id("1001"), self.doctor.id)
+
+    def test_reloaded_after_changes(self) -> None:
+        """Editing NPCs or locations should reload the directory."""
+        extensions = directory.get_directory()
+        self.assertIs(directory.get_directory(), extensions)
+
+        self.doctor.extension = 1002
+        self.doctor.save()
+        self.assertIsNone(directory.get_directory().npc_id(1001))
+        self.assertEqual(directory.get_directory().npc_id(1002), self.doctor.id)
+
+        engines = models.Location.objects.create(name="Engines", extension=2001)
+        self.assertEqual(directory.get_directory().location_id(2001), engines.id)
+
+        engines.delete()
+        self.assertIsNone(directory.get_directory().location_id(2001))
+
+        self.doctor.delete()
+        self.assertIsNone(directory.get_directory().npc_id(1002))
+
+    def test_reloaded_after_loading_from_repo(self) -> None:
+        """Loading the game from the repo should reload the directory."""
+        extensions = directory.get_directory()
+
+        with mock.patch("calls.admin.load_locations"), mock.patch("calls.admin.load_npcs"):
+            admin.actual_load_from_repo()
+
+        self.assertIsNot(directory.get_directory(), extensions)
+
+
+class SpeechLookupTests(TestCase):
+    """Looking up the speech for what an NPC says."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create the NPC speaking."""
+        cls.npc = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+
+    def setUp(self) -> None:
+        """Start each test with an empty cache."""
+        speech.speech_cache.clear()
+
+    def test_text_is_normalised(self) -> None:
+        """Text that only differs by whitespace should be spoken by the same speech."""
+        entry, created = speech.get_or_create(self.npc.id, "Caller  verified!")
+        self.assertTrue(created)
+
+        speech.speech_cache.clear()
+        same, created = speech.get_or_create(self.npc.id, " Caller verified!\n")
+        self.assertFalse(created)
+        self.assertEqual(same.id, entry.id)
+
+    def test_cached_lookups_avoid_the_database(self) -> None:
+        """Looking up the same speech again should not query the database."""
+        entry, _ = speech.get_or_create(self.npc.id, "Caller verified!")
+        with self.assertNumQueries(0):
+            self.assertEqual(speech.get_or_create(self.npc.id, "Caller verified!"), (entry, False))
+
+    def test_edited_text_is_looked_up_again(self) -> None:
+        """Editing a line's text should stop the old text finding it, so the old text gets speech of its own."""
+        entry, _ = speech.get_or_create(self.npc.id, "Caller verified!")
+        edited = models.Speech.objects.get(pk=entry.id)
+        edited.text = "Caller rejected!"
+        edited.save()
+
+        self.assertEqual(speech.get_or_create(self.npc.id, "Caller rejected!"), (speech.SpeechEntry.from_speech(edited), False))
+        old, created = speech.get_or_create(self.npc.id, "Caller verified!")
+        self.assertTrue(created)
+        self.assertNotEqual(old.id, entry.id)
+
+    async def test_concurrent_synthesis_is_shared(self) -> None:
+        """Callers reaching the same unrecorded line at once should share a single synthesis and recording."""
+
+        class CountingBackend(FakeBackend):
+            synthesised = 0
+
+            async def stream(self, text: str, voice_id: str) -> AsyncIterator[bytes]:
+                CountingBackend.synthesised += 1
+                async for chunk in super().stream(text, voice_id):
+                    yield chunk
+
+        entry, _ = await speech.aget_or_create(self.npc.id, "Caller verified!")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            results = await asyncio.gather(*(speech.asynthesise(Tts(CountingBackend(duration=0.1)), entry, "Caller verified!") for _ in range(20)))
+
+        self.assertEqual(CountingBackend.synthesised, 1)
+        self.assertEqual(len({result.recording for result in results}), 1)
+        self.assertTrue(results[0].recording)
+
+    async def test_same_line_is_synthesised_once(self) -> None:
+        """NPCs with the same voice saying the same line at once should share its synthesis, and its stored audio."""
+        other = await models.NPC.objects.acreate(name="Engineer", extension=1001, introduction="Hi")
+        entries = [(await speech.aget_or_create(npc_id, "Caller verified!"))[0] for npc_id in (self.npc.id, other.id)]
+        tts = Tts(FakeBackend(duration=0.1, first_chunk_delay=0.01, chunk_delay=0.01))
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            results = await asyncio.gather(*(speech.asynthesise(tts, entry, "Caller verified!") for entry in entries))
+
+        self.assertEqual(tts.shared, 1)
+        self.assertNotEqual(results[0].id, results[1].id)
+        self.assertEqual(results[0].recording, results[1].recording)
+
+    async def test_prefetched_prompts_are_cached(self) -> None:
+        """Lines prefetched for a recruit should be looked up before they are said."""
+        followup = await models.Mission.objects.acreate(
+            name="Followup",
+            give_text="Next, the moon",
+            reminder_text="Remind",
+            completion_text="Done",
+            issued_by=self.npc,
+            type=models.MissionTypes.LOCATION,
+            points=1,
+            repeatable=False,
+        )
+        mission = await models.Mission.objects.acreate(
+            name="Mission",
+            give_text="Go to Mars",
+            reminder_text="Still waiting",
+            completion_text="Well done",
+            issued_by=self.npc,
+            type=models.MissionTypes.LOCATION,
+            points=1,
+            repeatable=False,
+            followup_mission=followup,
+        )
+        recruit = await models.Recruit.objects.acreate()
+        await models.RecruitMission.objects.acreate(recruit=recruit, mission=mission)
+
+        prefetcher = PromptPrefetcher(synthesise=False)
+        prefetcher.prefetch_for_recruit(self.npc.id, None, await RecruitContext.aload(recruit))
+        while prefetcher._tasks:  # noqa: SLF001
+            await asyncio.wait(set(prefetcher._tasks))  # noqa: SLF001
+
+        self.assertEqual(prefetcher.prefetched, 3)
+        for text in ("Still waiting", "Well done", "Next, the moon"):
+            self.assertIsNotNone(speech.speech_cache.get((self.npc.id, models.Speech.hash_text(text))))
+
+    async def test_speech_streams_while_synthesising(self) -> None:
+        """Audio should be served as it is synthesised, then from the stored recording."""
+        tts = Tts(FakeBackend(duration=1.0, chunk_size=800, first_chunk_delay=0.05, chunk_delay=0.05))
+        entry, _ = await speech.aget_or_create(self.npc.id, "Caller verified!")
+        url = reverse("speech_stream", kwargs={"recording_id": entry.id, "encoding": "alaw"})
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            start = time.monotonic()
+            recording = speech.start_synthesis(tts, entry, "Caller verified!")
+            response = await self.async_client.get(url)
+
+            first_chunk = None
+            audio = b""
+            async for chunk in response.streaming_content:
+                first_chunk = first_chunk or time.monotonic() - start
+                audio += chunk
+            total = time.monotonic() - start
+
+            # Transcoded to A-law silence as it streams
+            self.assertEqual(audio, b"\xd5" * 8000)
+            self.assertLess(first_chunk, total / 2)
+
+            stored = await recording.result()
+            self.assertTrue(stored.recording)
+            self.assertNotIn(entry.id, speech.streams)
+
+            response = await self.async_client.get(url)
+            self.assertEqual(response.content, audio)
+
+
+@override_settings(SPEECH_SENDFILE_HEADER="")
+class PregenerationTests(TestCase):
+    """Generating speech for game text ahead of calls."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        """Create NPCs and a mission to call another NPC, with a followup."""
+        cls.operator = models.NPC.objects.create(id=OPERATOR_NPC_ID, name="Operator", extension=100, introduction="Operator here")
+        cls.captain = models.NPC.objects.create(name="Captain", extension=1000, introduction="Hello")
+        cls.engineer = models.NPC.objects.create(name="Engineer", extension=1001, introduction=" ")
+        followup = models.Mission.objects.create(
+            name="Followup",
+            give_text="Now fix the engine",
+            reminder_text="The engine, please",
+            completion_text="Fixed",
+            issued_by=cls.engineer,
+            type=models.MissionTypes.LOCATION,
+            points=1,
+            repeatable=False,
+        )
+        models.Mission.objects.create(
+            name="Call the engineer",
+            give_text="Call the engineer",
+            reminder_text="Have you called the engineer?",
+            completion_text="Thanks for calling",
+            cancel_text="Never mind",
+            issued_by=cls.captain,
+            type=models.MissionTypes.NPC,
+            call_another=cls.engineer,
+            followup_mission=followup,
+            points=1,
+            repeatable=False,
+        )
+
+    def setUp(self) -> None:
+        """Use a temporary media directory and an empty cache."""
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        speech.speech_cache.clear()
+
+    def test_game_utterances(self) -> None:
+        """Every line known before a call should be listed once, for the NPC who says it."""
+        utterances = pregenerate.game_utterances()
+
+        self.assertEqual(len(utterances), len(set(utterances)))
+        expected = {
+            (self.captain.id, "Hello"),
+            (self.captain.id, "Call the engineer"),
+            (self.captain.id, "Have you called the engineer?"),
+            (self.captain.id, "Never mind"),
+            (self.engineer.id, "Thanks for calling"),
+            (self.engineer.id, "Now fix the engine"),
+            (self.engineer.id, "The engine, please"),
+            (self.engineer.id, "Fixed"),
+            (self.operator.id, "Operator here"),
+            *((npc.id, prompt) for npc in (self.operator, self.captain, self.engineer) for prompt in NPC_PROMPTS),
+            *((self.operator.id, prompt) for prompt in OPERATOR_PROMPTS),
+        }
+        self.assertEqual({(utterance.npc_id, utterance.text) for utterance in utterances}, expected)
+
+    async def test_existing_recordings_are_skipped(self) -> None:
+        """Only lines without a recording should be synthesised, so a second run has nothing to do."""
+        utterances = await sync_to_async(pregenerate.game_utterances)()
+        entry, _ = await speech.aget_or_create(self.captain.id, "Hello")
+        await sync_to_async(speech.store_recording)(entry, b"\x00\x00" * 800, is_tts=False)
+        tts = Tts(FakeBackend(duration=0.01, first_chunk_delay=0, chunk_delay=0))
+
+        report = await pregenerate.apregenerate(tts, utterances)
+        self.assertEqual((report.existing, report.generated, report.failed), (1, len(utterances) - 1, 0))
+        self.assertEqual(await models.Speech.objects.filter(blob=None).acount(), 0)
+
+        report = await pregenerate.apregenerate(tts, utterances)
+        self.assertEqual((report.existing, report.generated, report.failed), (len(utterances), 0, 0))
+
+    def test_one_background_run_at_a_time(self) -> None:
+        """Starting generation while it is already running should leave the running one to finish."""
+        release = threading.Event()
+
+        async def generate(*_: Any) -> None:  # noqa: ANN401
+            await sync_to_async(release.wait)()
+
+        with mock.patch.object(pregenerate, "apregenerate", generate), override_settings(TTS_BACKEND="fake"):
+            self.assertEqual(pregenerate.start_in_background(), len(pregenerate.game_utterances()))
+            self.assertIsNone(pregenerate.start_in_background())
+            release.set()
+            pregenerate._background.join()  # noqa: SLF001
+
+
+class SpeechMediaTests(TestCase):
+    """Serving stored speech recordings."""
+
+    def setUp(self) -> None:
+        """Store a recording."""
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+
+        speech.speech_cache.clear()
+        speech.recording_cache.clear()
+        self.audio = bytes(range(256)) * 4
+        entry, _ = speech.get_or_create(None, "Caller verified!")
+        speech.store_recording(entry, self.audio, is_tts=True)
+        self.entry = entry
+        self.url = reverse("speech", kwargs={"recording_id": entry.id, "encoding": "sln"})
+
+    def test_recording_is_cacheable(self) -> None:
+        """Recordings should have validators and caching headers, and revalidate with a 304."""
+        response = self.client.get(self.url)
+        self.assertEqual(response.content, self.audio)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("Last-Modified", response)
+
+        response = self.client.get(self.url, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_byte_ranges(self) -> None:
+        """Byte ranges should be served as partial content."""
+        response = self.client.get(self.url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.audio[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.audio)}")
+
+        response = self.client.get(self.url, headers={"Range": "bytes=-16"})
+        self.assertEqual(response.content, self.audio[-16:])
+
+        response = self.client.get(self.url, headers={"Range": f"bytes={len(self.audio)}-"})
+        self.assertEqual(response.status_code, 416)
+
+    async def test_loose_files_are_streamed(self) -> None:
+        """Recordings stored in their own file should be streamed from it, a block at a time."""
+        name = await sync_to_async(speech.recording_storage().save)("legacy.sln", ContentFile(self.audio))
+        await models.Speech.objects.filter(pk=self.entry.id).aupdate(blob=None, recording=name)
+        speech.recording_cache.clear()
+
+        with mock.patch("calls.views.SPEECH_FILE_BLOCK_SIZE", 100):
+            response = await self.async_client.get(self.url, headers={"Range": "bytes=10-409"})
+            self.assertTrue(response.streaming)
+            blocks = [block async for block in response.streaming_content]
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(blocks), self.audio[10:410])
+        self.assertEqual(len(blocks), 4)
+
+    def test_only_safe_methods(self) -> None:
+        """Speech should only be served for GET and HEAD."""
+        stream_url = reverse("speech_stream", kwargs={"recording_id": self.entry.id, "encoding": "sln"})
+        for url in (self.url, stream_url):
+            self.assertEqual(self.client.post(url).status_code, 405)
+            self.assertEqual(self.client.head(url)["Content-Length"], str(len(self.audio)))
+
+    def test_missing_speech(self) -> None:
+        """Unknown speech should not be found."""
+        self.assertEqual(self.client.get(reverse("speech", kwargs={"recording_id": 999, "encoding": "sln"})).status_code, 404)
+        self.assertEqual(self.client.get(reverse("speech", kwargs={"recording_id": self.entry.id, "encoding": "mp3"})).status_code, 404)
+
+    def test_encodings(self) -> None:
+        """Every encoding should be served from a recording transcoded when the speech was stored."""
+        for encoding in ("alaw", "ulaw"):
+            response = self.client.get(reverse("speech", kwargs={"recording_id": self.entry.id, "encoding": encoding}))
+            self.assertEqual(response.content, audio.transcode(self.audio, encoding))
+            self.assertEqual(len(response.content), len(self.audio) // 2)
+
+        response = self.client.get(reverse("speech", kwargs={"recording_id": self.entry.id, "encoding": "sln16"}))
+        self.assertEqual(len(response.content), len(self.audio) * 2)
+
+        response = self.client.get(reverse("speech", kwargs={"recording_id": self.entry.id, "encoding": "wav"}))
+        self.assertEqual(response["Content-Type"], "audio/wav")
+        self.assertEqual(response.content[:4], b"RIFF")
+        self.assertEqual(response.content[44:], self.audio)
+        self.assertEqual(models.SpeechRendition.objects.filter(speech_id=self.entry.id).count(), 4)
+
+
+@override_settings(SPEECH_SENDFILE_HEADER="", SPEECH_PACK_DIR="")
+class PackStoreTests(TestCase):
+    """Storing speech audio by its content in packs."""
+
+    def setUp(self) -> None:
+        """Use a temporary media directory."""
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        speech.speech_cache.clear()
+        speech.recording_cache.clear()
+
+    def test_identical_audio_is_stored_once(self) -> None:
+        """Speech with the same audio should share it, in every encoding."""
+        pcm = bytes(range(256)) * 8
+        first = speech.store_recording(speech.get_or_create(None, "Caller verified!")[0], pcm, is_tts=True)
+        second = speech.store_recording(speech.get_or_create(None, "Caller  verified.")[0], pcm, is_tts=True)
+
+        self.assertEqual(first.recording, second.recording)
+        self.assertEqual(models.AudioBlob.objects.count(), len(audio.ENCODINGS))
+        self.assertEqual(speech.read_recording(models.Speech.objects.get(pk=second.id)), pcm)
+
+    def test_compaction(self) -> None:
+        """Audio nothing refers to any more should be removed, and its space reclaimed."""
+        entry, _ = speech.get_or_create(None, "Caller verified!")
+        speech.store_recording(entry, b"\x00\x10" * 4000, is_tts=True)
+        speech.store_recording(entry, b"\x00\x20" * 4000, is_tts=True)
+        packs = list(packstore.pack_dir().iterdir())
+        self.assertEqual(len(packs), 1)
+
+        with mock.patch.object(packstore, "COMPACTION_GRACE", datetime.timedelta(minutes=-1)):
+            report = packstore.compact(threshold=0.25)
+
+        self.assertEqual(report.blobs_removed, len(audio.ENCODINGS))
+        self.assertEqual(report.packs_rewritten, 1)
+        self.assertFalse(packs[0].exists())
+        live = sum(blob.size for blob in models.AudioBlob.objects.all())
+        self.assertEqual(sum(pack.stat().st_size for pack in packstore.pack_dir().iterdir()), live)
+
+        response = self.client.get(reverse("speech", kwargs={"recording_id": entry.id, "encoding": "sln"}))
+        self.assertEqual(response.content, b"\x00\x20" * 4000)
+
+
+    def test_recreated_pack_is_mapped_again(self) -> None:
+        """A pack removed and created again under the same name should not be read through the old map."""
+        pack = packstore.pack_dir() / f"0{packstore.PACK_SUFFIX}"
+        pack.parent.mkdir(parents=True)
+        pack.write_bytes(b"old audio")
+        self.assertEqual(packstore.pack_map(pack.name, 9)[:9], b"old audio")
+
+        pack.unlink()
+        self.assertEqual(packstore.pack_map(pack.name, 9)[:9], b"old audio")
+
+        pack.write_bytes(b"new audio")
+        self.assertEqual(packstore.pack_map(pack.name, 9)[:9], b"new audio")
+
+
+class AudioTests(TestCase):
+    """Transcoding speech between encodings."""
+
+    def test_g711_round_trip(self) -> None:
+        """Every A-law and μ-law code should decode to a sample that encodes back to it."""
+        codes = np.arange(256, dtype=np.uint8)
+        self.assertTrue((audio.ALAW_ENCODE[audio.ALAW_DECODE.view(np.uint16)] == codes).all())
+        # μ-law has two codes for silence, which encode to the same one
+        ulaw = audio.ULAW_ENCODE[audio.ULAW_DECODE.view(np.uint16)]
+        self.assertEqual(int((ulaw != codes).sum()), 1)
+
+    def test_chunks_split_samples(self) -> None:
+        """A sample split between chunks should be transcoded once it is whole."""
+        pcm = np.arange(-1000, 1000, 7, dtype="<i2").tobytes()
+        transcoder = audio.ChunkTranscoder("ulaw")
+        streamed = b"".join(transcoder.feed(pcm[i : i + 33]) for i in range(0, len(pcm), 33))
+        self.assertEqual(streamed, audio.transcode(pcm, "ulaw"))
+
+
+class PromptTemplateTests(TestCase):
+    """Saying prompts with values as a sequence of clips."""
+
+    def test_render(self) -> None:
+        """Values should be said digit by digit, between the fixed text."""
+        self.assertEqual(
+            NEW_RECRUIT_PROMPT.render(recruit=42),
+            ["OK let's see, scanner says you're recruit", "zero", "zero", "four", "two", "You got that?", "zero", "zero", "four", "two", "don't forget it!"],
+        )
+
+    def test_clips_are_shared(self) -> None:
+        """Every recruit number should be said with the same clips, which are all known ahead of time."""
+        clips = set(NEW_RECRUIT_PROMPT.clips())
+        for recruit in (0, 7, 1234, 9999):
+            self.assertLessEqual(set(NEW_RECRUIT_PROMPT.render(recruit=recruit)), clips)
+
+
+class LuaChunkTests(TestCase):
+    """Compiling mission Lua once and running it from the cache."""
+
+    def test_compiled_once_per_version(self) -> None:
+        """A script should only be compiled again when it changes."""
+        cache = ChunkCache()
+        chunk = cache.get(1, "state.calls = 1")
+        self.assertIs(cache.get(1, "state.calls = 1"), chunk)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        edited = cache.get(1, "state.calls = 2")
+        self.assertNotEqual(edited.key, chunk.key)
+        self.assertEqual(cache.stats()["chunks"], 1)
+
+        with self.assertRaises(LuaSyntaxError):
+            cache.get(2, "state.calls = (")
+
+    async def test_run_chunk(self) -> None:
+        """Compiled chunks should run with the runtime's globals, loading their bytecode once."""
+        runtime = AsyncLuaRuntime(unpack_returned_tuples=True)
+        runtime.globals().state = runtime.table_from({"calls": 1})
+        chunk = ChunkCache().get(1, "state.calls = state.calls + 1")
+
+        await runtime.run_chunk(chunk)
+        await runtime.run_chunk(chunk)
+        self.assertEqual(runtime.globals().state.calls, 3)
+        self.assertEqual(len(runtime._functions), 1)  # noqa: SLF001
+
+    async def test_pooled_runtimes_are_scrubbed(self) -> None:
+        """Runtimes should be reused, without anything a mission left behind."""
+        pool = LuaRuntimePool(size=1)
+        chunk = ChunkCache().get(
+            1,
+            "leaked = state.calls; string.upper = nil; getmetatable('').__index = {upper = function() return 'pwned' end}; setmetatable(_G, {__newindex = error})",
+        )
+
+        async with pool.lease() as lua:
+            lua.globals().state = lua.table_from({"calls": 1})
+            await lua.run_chunk(chunk)
+            first = lua
+
+        async with pool.lease() as lua:
+            self.assertIs(lua, first)
+            self.assertIsNone(lua.globals().leaked)
+            self.assertIsNone(lua.globals().state)
+            self.assertEqual(lua.globals().string.upper("ok"), "OK")
+            self.assertEqual(await lua.run_chunk(ChunkCache().get(2, "return ('ok'):upper()")), "OK")
+            lua.globals().anything = 1
+
+        self.assertEqual(pool.created, 1)
+
+    async def test_sandbox(self) -> None:
+        """Missions should only be able to use the standard library and what they are given."""
+        pool = LuaRuntimePool(size=1)
+        with self.assertRaises(AttributeError):
+            async with pool.lease() as lua:
+                self.assertIsNone(lua.globals().io)
+                self.assertIsNone(lua.globals().require)
+                self.assertIsNone(lua.globals().os.execute)
+                self.assertIsNotNone(lua.globals().os.time)
+
+                lua.globals().recruit_mission = models.RecruitMission(state={})
+                await lua.run_chunk(ChunkCache().get(1, "return recruit_mission._meta"))
+
+        # A runtime that failed isn't reused
+        self.assertEqual(pool._idle, [])  # noqa: SLF001
+
+    async def test_budget(self) -> None:
+        """Scripts should be stopped when they run too long or use too much memory, even if they catch the error."""
+        pool = LuaRuntimePool(size=1)
+        cache = ChunkCache()
+        budget = LuaBudget(instructions=100_000, seconds=60)
+        for source in ("while true do end", "while true do pcall(function() while true do end end) end"):
+            with self.assertRaisesMessage(LuaBudgetExceededError, "instruction limit"):
+                async with pool.lease() as lua:
+                    await lua.run_chunk(cache.get(1, source), budget=budget)
+
+        with self.assertRaisesMessage(LuaBudgetExceededError, "time limit"):
+            async with pool.lease() as lua:
+                await lua.run_chunk(cache.get(2, "while true do end"), budget=LuaBudget(instructions=10**12, seconds=0.05))
+
+        with self.settings(LUA_MAX_MEMORY=1024 * 1024), self.assertRaises(LuaMemoryError):
+            async with pool.lease() as lua:
+                await lua.run_chunk(cache.get(3, "local t = {} for i = 1, 1e6 do t[i] = string.rep('x', 100) .. i end"), budget=budget)
+
+        async with pool.lease() as lua:
+            self.assertEqual(await lua.run_chunk(cache.get(4, "return 1 + 1"), budget=budget), 2)
+
+    async def test_edited_scripts_replace_old_versions(self) -> None:
+        """A runtime should only keep the latest version of each mission's script loaded."""
+        cache = ChunkCache()
+        async with LuaRuntimePool(size=1).lease() as lua:
+            for source in ("return 1", "return 2"):
+                chunk = cache.get(1, source)
+                await lua.run_chunk(chunk)
+            await lua.run_chunk(cache.get(2, "return 3"))
+
+            self.assertEqual(set(lua._functions), {chunk.key, cache.get(2, "return 3").key})  # noqa: SLF001
+
+    async def test_time_limit_only_counts_running(self) -> None:
+        """Time spent waiting for a free Lua thread should not count towards a script's time limit."""
+        executor = get_executor()
+        release = threading.Event()
+        for _ in range(executor._max_workers):  # noqa: SLF001
+            executor.submit(release.wait)
+        asyncio.get_running_loop().call_later(0.3, release.set)
+
+        async with LuaRuntimePool(size=1).lease() as lua:
+            source = "local n = 0 for i = 1, 10000 do n = n + i end return n"
+            result = await lua.run_chunk(ChunkCache().get(1, source), budget=LuaBudget(instructions=10**9, seconds=0.1))
+        self.assertEqual(result, 50005000)
+
+    async def test_cancel_does_not_block(self) -> None:
+        """Cancelling a check while its script is running should not wait for the script on the event loop."""
+        pool = LuaRuntimePool(size=1)
+        chunk = ChunkCache().get(1, "while true do end")
+
+        async def check() -> None:
+            async with pool.lease() as lua:
+                await lua.run_chunk(chunk, budget=LuaBudget(instructions=10**12, seconds=0.5))
+
+        task = asyncio.create_task(check())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        start = time.monotonic()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(pool._idle, [])  # noqa: SLF001
+
+        # Let the script run out its budget
+        await asyncio.sleep(0.5)
+
+    async def test_memory_limit_is_on_top_of_setup(self) -> None:
+        """Scripts should get the whole memory limit, whatever setting up the sandbox used."""
+        cache = ChunkCache()
+        source = "local t = {} for i = 1, %d do t[i] = string.rep('x', 1000) .. i end return #t"
+        with self.settings(LUA_MAX_MEMORY=64 * 1024):
+            async with LuaRuntimePool(size=1).lease() as lua:
+                self.assertEqual(await lua.run_chunk(cache.get(1, source % 56)), 56)
+
+            with self.assertRaises(LuaMemoryError):
+                async with LuaRuntimePool(size=1).lease() as lua:
+                    await lua.run_chunk(cache.get(2, source % 80))
+
+    async def test_bridge(self) -> None:
+        """Bridged functions should be awaited on the event loop, giving their results to the script without holding a thread."""
+        said = []
+
+        async def say(text: str) -> None:
+            said.append(text)
+
+        async def gather(text: str) -> tuple[str, str]:
+            await asyncio.sleep(0)
+            said.append(text)
+            return "1234", "dtmfDetected"
+
+        chunk = ChunkCache().get(1, """
+            python.coroutine(say("Hello"))
+            local digits, reason = gather("Enter a code")
+            say(digits .. " " .. reason)
+            coroutine.wrap(function() say("Not from here") end)()
+        """)
+        async with LuaRuntimePool(size=1).lease() as lua:
+            lua.globals().say = lua.bridge(say)
+            lua.globals().gather = lua.bridge(gather)
+            with self.assertRaisesMessage(LuaError, "can only be called by the mission itself"):
+                await lua.run_chunk(chunk)
+
+        self.assertEqual(said, ["Hello", "Enter a code", "1234 dtmfDetected"])
+
+    async def test_state_conversion(self) -> None:
+        """Nested state should go to Lua and back as JSON, and anything that can't be stored should be refused."""
+        state = {"calls": 1, "visited": ["bridge", "engine room"], "codes": {"door": 1234, "tries": [1, 2.5]}, "found": []}
+        chunk = ChunkCache().get(
+            1,
+            "state.calls = state.calls + 1; table.insert(state.visited, 'airlock'); table.remove(state.codes.tries); table.remove(state.codes.tries); state.notes = {}",
+        )
+
+        async with LuaRuntimePool(size=1).lease() as lua:
+            lua.globals().state = table_from_state(lua, state)
+            await lua.run_chunk(ChunkCache().get(3, "return"))
+            self.assertEqual(state_from_table(lua, lua.globals().state), state)
+
+            await lua.run_chunk(chunk)
+            self.assertEqual(
+                state_from_table(lua, lua.globals().state),
+                {"calls": 2, "visited": ["bridge", "engine room", "airlock"], "codes": {"door": 1234, "tries": []}, "found": [], "notes": {}},
+            )
+
+            for source, message in (
+                ("state.f = print", "state.f is a function"),
+                ("state.loop = {}; state.loop.loop = state.loop", "nested more than"),
+                ("state[{}] = 1", "state has a table key"),
+            ):
+                lua.globals().state = table_from_state(lua, {})
+                await lua.run_chunk(ChunkCache().get(2, source))
+                with self.assertRaisesMessage(LuaError, message):
+                    state_from_table(lua, lua.globals().state)
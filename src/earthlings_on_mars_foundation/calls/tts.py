@@ -1,30 +1,175 @@
+import asyncio
+import logging
 import os
+import weakref
+from collections.abc import AsyncIterator
+from typing import Protocol
+
+import httpx
 from cartesia import AsyncCartesia
+from calls import audio
+from calls.streaming import GrowingRecording
+from django.conf import settings
 # from cartesia.tts import OutputFormat_Raw, TtsRequestIdSpecifier
 
-class Tts:
+logger = logging.getLogger("eomf.calls.tts")
+
+VOICE_ID = "694f9389-aac1-45b6-b726-9d9369183238"
+
+# Seconds an idle connection to the TTS API is kept open for reuse
+KEEPALIVE_EXPIRY = 60
+
+
+class TtsBackend(Protocol):
+    """Something that can turn text into 8kHz signed 16-bit little-endian PCM."""
+
+    def stream(self, text: str, voice_id: str) -> AsyncIterator[bytes]:
+        """Synthesise text, yielding audio as it arrives."""
+        ...
+
 
-    def __init__(self) -> None:
+class CartesiaBackend:
+    """Synthesise speech with the Cartesia API, over a keep-alive connection pool."""
+
+    def __init__(self, max_connections: int) -> None:
+        """Prepare the client, with up to `max_connections` kept open."""
         api_key = os.getenv("CARTESIA_API_KEY")
         if not api_key:
             raise Exception("Missing cartesia API key envvar CARTESIA_API_KEY")
-        self.client = AsyncCartesia(api_key=api_key)
+        self.client = AsyncCartesia(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=KEEPALIVE_EXPIRY),
+            ),
+        )
 
-    async def audio_bytes(self, text: str):
-        b = bytearray()
+    async def stream(self, text: str, voice_id: str) -> AsyncIterator[bytes]:
+        """Synthesise text, yielding audio as it arrives."""
         async for output in self.client.tts.bytes(
             model_id="sonic-2",
             transcript=text,
-            voice={"id": "694f9389-aac1-45b6-b726-9d9369183238"},
+            voice={"id": voice_id},
             language="en",
             output_format={
                 "container": "raw",
-                "sample_rate": 8000,
-                "encoding": "pcm_alaw",
+                "sample_rate": audio.SAMPLE_RATE,
+                "encoding": "pcm_s16le",
             },
         ):
-            b += output
-        return bytes(b)
+            yield output
+
+
+class FakeBackend:
+    """Offline stand-in for Cartesia, producing silence with configurable timing."""
+
+    # One sample of silence
+    SILENCE = b"\x00\x00"
+
+    def __init__(self, duration: float = 1.0, chunk_size: int = 800, first_chunk_delay: float = 0.1, chunk_delay: float = 0.05) -> None:
+        """Prepare the backend."""
+        self.duration = duration
+        self.chunk_size = chunk_size
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+
+    async def stream(self, text: str, voice_id: str) -> AsyncIterator[bytes]:  # noqa: ARG002
+        """Synthesise text, yielding a chunk of silence every `chunk_delay` seconds."""
+        remaining = round(self.duration * audio.SAMPLE_RATE)
+        await asyncio.sleep(self.first_chunk_delay)
+        while remaining > 0:
+            chunk = min(remaining, self.chunk_size)
+            remaining -= chunk
+            yield self.SILENCE * chunk
+            if remaining > 0:
+                await asyncio.sleep(self.chunk_delay)
+
+
+class Tts:
+    """Speech synthesis through a backend, with a limit on how much runs at once.
+
+    Requests beyond the limit queue in order until a slot is free. Identical requests share one synthesis, so the same line said by
+    NPCs with the same voice is only synthesised once.
+    """
+
+    def __init__(self, backend: TtsBackend, concurrency: int = 8, voice_id: str = VOICE_ID) -> None:
+        """Prepare the service."""
+        self.backend = backend
+        self.concurrency = concurrency
+        self.voice_id = voice_id
+        self.queued = 0
+        self.shared = 0
+
+        self._slots = asyncio.Semaphore(concurrency)
+        # Synthesis in progress for each (voice, text)
+        self._flights: dict[tuple[str, str], GrowingRecording[None]] = {}
+
+    @classmethod
+    def from_settings(cls) -> "Tts":
+        """Create the service configured by TTS_BACKEND and TTS_CONCURRENCY."""
+        concurrency = settings.TTS_CONCURRENCY
+        backend = FakeBackend() if settings.TTS_BACKEND == "fake" else CartesiaBackend(max_connections=concurrency)
+        return cls(backend, concurrency)
+
+    async def stream(self, text: str) -> AsyncIterator[bytes]:
+        """Synthesise text, yielding audio as it arrives.
+
+        If the same text is already being synthesised, its audio is followed from the start instead.
+        """
+        key = (self.voice_id, text)
+        recording = self._flights.get(key)
+        if recording is None:
+            recording = GrowingRecording()
+            self._flights[key] = recording
+            recording.task = asyncio.create_task(self._synthesise(key, recording))
+        else:
+            self.shared += 1
+
+        async for chunk in recording.iter_chunks():
+            yield chunk
+
+    async def _synthesise(self, key: tuple[str, str], recording: GrowingRecording[None]) -> None:
+        """Synthesise text into a recording, once a slot is free."""
+        voice_id, text = key
+        try:
+            if self._slots.locked():
+                logger.info("Queueing TTS behind %s running and %s queued", self.concurrency, self.queued)
+
+            self.queued += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self.queued -= 1
+
+            try:
+                async for output in self.backend.stream(text, voice_id):
+                    recording.append(output)
+            finally:
+                self._slots.release()
+        except BaseException as e:
+            # Passed on to everyone following the recording, and logged by them
+            recording.finish(error=e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            recording.finish()
+        finally:
+            if self._flights.get(key) is recording:
+                del self._flights[key]
+
+
+# Clients are tied to the event loop they were created on, so there is one
+# service per loop. Under the ASGI server that means one per process.
+_services: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tts]" = weakref.WeakKeyDictionary()
+
+
+def get_tts() -> Tts:
+    """Get the shared TTS service for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    service = _services.get(loop)
+    if service is None:
+        service = Tts.from_settings()
+        _services[loop] = service
+    return service
 
 
 # vim: tw=0 ts=4 sw=4
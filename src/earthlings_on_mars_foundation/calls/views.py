@@ -1,7 +1,38 @@
 """Standard HTTP requests."""
 
-from calls import models
-from django.http import FileResponse, HttpRequest, HttpResponse, HttpResponseNotFound
+from __future__ import annotations
+
+import contextlib
+import re
+from typing import TYPE_CHECKING
+
+from asgiref.sync import sync_to_async
+from calls import audio
+from calls import speech as speech_module
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, HttpResponseNotFound, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from calls.speech import StoredRecording
+    from calls.streaming import GrowingRecording
+
+# Recordings are never changed once stored, so they can be cached forever
+SPEECH_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+SPEECH_CONTENT_TYPE = "application/octet-stream"
+
+# Encodings with a more specific content type than raw audio
+SPEECH_CONTENT_TYPES = {"wav": "audio/wav"}
+
+# Bytes read from a recording's file at a time, when it is streamed by Django
+SPEECH_FILE_BLOCK_SIZE = 64 * 1024
+
+_BYTE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
 
 
 def index(_: HttpRequest) -> HttpResponse:
@@ -9,11 +40,137 @@ def index(_: HttpRequest) -> HttpResponse:
     return HttpResponse("Hello, world.")
 
 
-def speech(request: HttpRequest, recording_id: int) -> HttpResponse:
-    """Look up a speech file and return it."""
+def _byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse a Range header for a single byte range, into its first and last byte.
+
+    Anything that isn't a single byte range (including multiple ranges) is ignored, and the whole recording is served. Raises ValueError if
+    the range is outside of the recording.
+    """
+    match = _BYTE_RANGE.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+
+    if not first:
+        # Suffix range, the last N bytes
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+@require_safe
+async def speech(request: HttpRequest, recording_id: str, encoding: str = audio.MASTER_ENCODING) -> HttpResponse:
+    """Look up a speech file in an encoding and return it."""
+    if encoding not in audio.ENCODINGS:
+        return HttpResponseNotFound()
+    try:
+        stored = await speech_module.aget_recording(int(recording_id), encoding)
+    except ValueError:
+        return HttpResponseNotFound()
+    if stored is None:
+        return HttpResponseNotFound()
+
+    response = get_conditional_response(request, etag=stored.etag, last_modified=int(stored.modified.timestamp()))
+    if response is None:
+        response = await _recording_response(request, stored)
+
+    response["ETag"] = stored.etag
+    response["Last-Modified"] = http_date(stored.modified.timestamp())
+    response["Cache-Control"] = SPEECH_CACHE_CONTROL
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+async def _recording_response(request: HttpRequest, stored: StoredRecording) -> HttpResponse:
+    """Serve a recording, or the requested part of it."""
+    content_type = SPEECH_CONTENT_TYPES.get(stored.encoding, SPEECH_CONTENT_TYPE)
+
+    if settings.SPEECH_SENDFILE_HEADER and not stored.packed:
+        # Let the web server send the file (and handle any range) without copying it through Django
+        response = HttpResponse(content_type=content_type)
+        if settings.SPEECH_SENDFILE_HEADER == "X-Sendfile":
+            response["X-Sendfile"] = stored.path()
+        else:
+            response[settings.SPEECH_SENDFILE_HEADER] = settings.SPEECH_SENDFILE_PREFIX + stored.name
+        return response
+
+    start, end, status = 0, stored.size - 1, 200
+
+    if "Range" in request.headers and request.headers.get("If-Range", stored.etag) == stored.etag:
+        try:
+            byte_range = _byte_range(request.headers["Range"], stored.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stored.size}"
+            return response
+        if byte_range is not None:
+            (start, end), status = byte_range, 206
+
+    length = end - start + 1
+    if request.method == "HEAD":
+        response = HttpResponse(status=status, content_type=content_type)
+    elif stored.packed:
+        # Already mapped into memory, so there's no need to leave the event loop, and it is only copied into the response
+        response = HttpResponse(stored.view(start, length), status=status, content_type=content_type)
+    else:
+        # Read a block at a time rather than all at once. FileResponse isn't used, as Django would read its synchronous
+        # iterator into a list under ASGI.
+        response = StreamingHttpResponse(_file_blocks(stored, start, length), status=status, content_type=content_type)
+    response["Content-Length"] = length
+    if status == 206:  # noqa: PLR2004
+        response["Content-Range"] = f"bytes {start}-{end}/{stored.size}"
+    return response
+
+
+@require_safe
+async def speech_stream(request: HttpRequest, recording_id: str, encoding: str = audio.MASTER_ENCODING) -> HttpResponse:
+    """Stream speech that is still being synthesised, or return it if it has been stored."""
     try:
-        # TODO make async?
-        recording = models.Speech.objects.get(id=recording_id)
-        return FileResponse(recording.recording)
-    except models.Recruit.DoesNotExist:
+        recording = speech_module.streams.get(int(recording_id))
+    except ValueError:
         return HttpResponseNotFound()
+
+    if recording is not None and encoding not in audio.STREAMABLE_ENCODINGS:
+        # Encodings with a header or resampling are only served once the whole recording is stored
+        with contextlib.suppress(Exception):
+            await recording.result()
+        recording = None
+
+    if recording is None:
+        return await speech(request, recording_id, encoding)
+
+    # The length isn't known yet, so this is sent chunked as the audio arrives
+    return StreamingHttpResponse(_transcode_chunks(recording, encoding), content_type=SPEECH_CONTENT_TYPE)
+
+
+async def _transcode_chunks(recording: GrowingRecording, encoding: str) -> AsyncIterator[bytes]:
+    """Encode a recording's audio as it arrives."""
+    transcoder = audio.ChunkTranscoder(encoding)
+    async for chunk in recording.iter_chunks():
+        yield transcoder.feed(chunk)
+
+
+async def _file_blocks(stored: StoredRecording, start: int, length: int) -> AsyncIterator[bytes]:
+    """Read part of a recording's file, a block at a time."""
+    f = await sync_to_async(stored.open)()
+    try:
+        await sync_to_async(f.seek)(start)
+        while length > 0:
+            block = await sync_to_async(f.read)(min(length, SPEECH_FILE_BLOCK_SIZE))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+    finally:
+        await sync_to_async(f.close)()
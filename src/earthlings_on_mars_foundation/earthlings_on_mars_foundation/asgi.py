@@ -6,6 +6,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
+import contextlib
 import os
 
 from django.core.asgi import get_asgi_application
@@ -20,6 +21,17 @@ os.environ.setdefault(
 )
 django_asgi_app = get_asgi_application()
 
+from calls.directory import get_directory  # noqa: E402
+from calls.eligibility import get_mission_graph  # noqa: E402
+from django.db import DatabaseError  # noqa: E402
+
+# Load the extension directory and mission graph before the first call
+# arrives. If the database isn't ready yet, they are loaded on first use
+# instead.
+with contextlib.suppress(DatabaseError):
+    get_directory()
+    get_mission_graph()
+
 from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
 from django.core.asgi import get_asgi_application  # noqa: E402
 
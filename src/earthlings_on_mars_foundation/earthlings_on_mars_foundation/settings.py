@@ -266,6 +266,62 @@ USE_I18N = True
 USE_TZ = True
 
 
+###############################################################################
+# Speech                                                                      #
+###############################################################################
+
+# Number of (NPC, text) to speech recording lookups kept in memory
+SPEECH_CACHE_SIZE = int(os.getenv("SPEECH_CACHE_SIZE", "4096"))
+
+# Header telling the web server in front of Django to send speech recordings
+# itself, e.g. "X-Accel-Redirect" for nginx or "X-Sendfile" for Apache.
+# Recordings are sent by Django if this is empty.
+SPEECH_SENDFILE_HEADER = os.getenv("SPEECH_SENDFILE_HEADER", "")
+
+# Internal location the web server serves MEDIA_ROOT from, for X-Accel-Redirect
+SPEECH_SENDFILE_PREFIX = os.getenv("SPEECH_SENDFILE_PREFIX", "/protected-media/")
+
+# Directory speech audio pack files are kept in, "packs" under MEDIA_ROOT if
+# empty. They are served by Django, not the web server.
+SPEECH_PACK_DIR = os.getenv("SPEECH_PACK_DIR", "")
+
+# Size in bytes after which a new pack file is started
+SPEECH_PACK_SIZE = int(os.getenv("SPEECH_PACK_SIZE", str(256 * 1024 * 1024)))
+
+# Encoding speech is played to callers in, one of "alaw", "ulaw", "sln",
+# "sln16" or "wav", to match what each platform's trunks expect
+ASTERISK_SPEECH_ENCODING = os.getenv("ASTERISK_SPEECH_ENCODING", "alaw")
+JAMBONZ_SPEECH_ENCODING = os.getenv("JAMBONZ_SPEECH_ENCODING", "wav")
+
+# Text to speech backend, "cartesia" or "fake" for an offline stand-in that produces silence
+TTS_BACKEND = os.getenv("TTS_BACKEND", "cartesia")
+
+# Utterances synthesised at once by each process, any more wait in a queue
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "8"))
+
+
+###############################################################################
+# Lua                                                                         #
+###############################################################################
+
+# Sandboxed Lua runtimes kept ready for checking Lua missions, by each process
+LUA_RUNTIME_POOL_SIZE = int(os.getenv("LUA_RUNTIME_POOL_SIZE", "8"))
+
+# Threads running Lua in each process, apart from those Django uses for the database
+LUA_EXECUTOR_THREADS = int(os.getenv("LUA_EXECUTOR_THREADS", "8"))
+
+# Lua instructions a mission check can run before it is stopped
+LUA_INSTRUCTION_LIMIT = int(os.getenv("LUA_INSTRUCTION_LIMIT", "1000000"))
+
+# Seconds a mission check can spend running Lua before it is stopped, not
+# counting time waiting for the call, e.g. for something to be said
+LUA_TIME_LIMIT = float(os.getenv("LUA_TIME_LIMIT", "1.0"))
+
+# Bytes of memory a mission check's runtime can use on top of what its
+# libraries and sandbox use. Missions it has loaded count against this
+LUA_MAX_MEMORY = int(os.getenv("LUA_MAX_MEMORY", str(16 * 1024 * 1024)))
+
+
 ###############################################################################
 # Logging                                                                     #
 ###############################################################################